@@ -0,0 +1,138 @@
+"""
+Microbenchmark comparing the legacy per-row blank/dark space detection with the vectorized one.
+
+It first checks the blank page detection against pages it must keep (bilevel scans, dark title pages) and pages
+it must flag (blank scans), and fails if any verdict is wrong.
+
+Run it from the `books_manager` folder:
+
+    python -m benchmarks.blank_detection_benchmark --width 900 --height 30000
+"""
+import argparse
+import io
+import timeit
+
+import numpy as np
+from PIL import Image
+
+from manga_manager.manga_page_analysis import analyze_page, detect_blank_or_dark_bands
+
+
+def legacy_detect_blank_or_dark_spaces(image: Image.Image, threshold_light=240, threshold_dark=15) -> list[int]:
+    """Reference implementation that crops and walks every row of pixels in Python."""
+    spaces = []
+    width, height = image.size
+    grayscale_img = image.convert("L")
+
+    for y in range(height):
+        row = grayscale_img.crop((0, y, width, y + 1))
+        if all(pixel > threshold_light for pixel in row.getdata()) or all(
+                pixel < threshold_dark for pixel in row.getdata()):
+            spaces.append(y)
+    return spaces
+
+
+def legacy_split_bands(image: Image.Image, min_gap=20) -> list[tuple[int, int]]:
+    """Reference band computation built on top of the legacy detection."""
+    split_positions = [0] + legacy_detect_blank_or_dark_spaces(image) + [image.height]
+    return [
+        (split_positions[i - 1], split_positions[i])
+        for i in range(1, len(split_positions))
+        if split_positions[i] - split_positions[i - 1] > min_gap
+    ]
+
+
+def vectorized_split_bands(image: Image.Image, min_gap=20) -> list[tuple[int, int]]:
+    """Band computation using a single grayscale conversion and whole-array reductions."""
+    grayscale = np.asarray(image.convert("L"), dtype=np.uint8)
+    return detect_blank_or_dark_bands(grayscale, min_gap=min_gap)
+
+
+def build_webtoon_strip(width: int, height: int, panel_height: int = 1200, gutter_height: int = 120,
+                        seed: int = 0) -> Image.Image:
+    """Builds a tall colored strip of noisy panels separated by white and black gutters."""
+    rng = np.random.default_rng(seed)
+    strip = rng.integers(40, 220, size=(height, width, 3), dtype=np.uint8)
+    y = panel_height
+    gutter_color = 255
+    while y < height:
+        strip[y:y + gutter_height] = gutter_color
+        gutter_color = 0 if gutter_color == 255 else 255
+        y += gutter_height + panel_height
+    return Image.fromarray(strip, mode="RGB")
+
+
+def _jpeg_round_trip(array: np.ndarray, quality: int = 85) -> Image.Image:
+    buffer = io.BytesIO()
+    Image.fromarray(array, mode='L').save(buffer, format='JPEG', quality=quality)
+    return Image.open(io.BytesIO(buffer.getvalue()))
+
+
+def build_blank_detection_cases(width: int = 1200, height: int = 1800, seed: int = 0) -> dict[str, tuple]:
+    """Pages with the blank verdict they must get: (image, expected is_blank) by case name."""
+    rng = np.random.default_rng(seed)
+
+    # Bilevel scan: only black and white pixels, panel borders, a few strokes and a speech line
+    bilevel = np.full((height, width), 255, dtype=np.uint8)
+    for top, bottom in ((60, 860), (940, 1740)):
+        bilevel[top:bottom, 60:66] = bilevel[top:bottom, width - 66:width - 60] = 0
+        bilevel[top:top + 6, 60:width - 60] = bilevel[bottom - 6:bottom, 60:width - 60] = 0
+    for x in range(200, 900, 35):
+        bilevel[300:700, x:x + 3] = 0
+    bilevel[1200:1212, 300:800] = 0
+
+    # Black title page with a line of white text
+    dark_title = np.zeros((height, width), dtype=np.uint8)
+    for x in range(350, 850, 28):
+        dark_title[880:920, x:x + 14] = 255
+
+    # Blank pages as scanned: paper or black with sensor noise, saved as JPEG
+    white_scan = np.clip(rng.normal(245, 4, size=(height, width)), 0, 255).astype(np.uint8)
+    black_scan = np.clip(rng.normal(8, 4, size=(height, width)), 0, 255).astype(np.uint8)
+
+    return {
+        'bilevel page': (Image.fromarray(bilevel, mode='L').convert('1'), False),
+        'dark title page': (_jpeg_round_trip(dark_title), False),
+        'blank white scan': (_jpeg_round_trip(white_scan), True),
+        'blank black scan': (_jpeg_round_trip(black_scan), True),
+    }
+
+
+def check_blank_detection() -> list[str]:
+    """Names of the cases whose blank verdict is wrong."""
+    failures = []
+    for name, (image, expected_blank) in build_blank_detection_cases().items():
+        analysis = analyze_page(image)
+        print(f'{name}: content ratio {analysis.content_ratio:.5f}, blank: {analysis.is_blank}')
+        if analysis.is_blank != expected_blank:
+            failures.append(name)
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--width', type=int, default=900)
+    parser.add_argument('--height', type=int, default=30000)
+    parser.add_argument('--repeat', type=int, default=3, help='Repetitions of the vectorized implementation.')
+    args = parser.parse_args()
+
+    failures = check_blank_detection()
+    if failures:
+        raise SystemExit(f'Wrong blank page verdict for: {", ".join(failures)}.')
+
+    image = build_webtoon_strip(args.width, args.height)
+
+    legacy_seconds = timeit.timeit(lambda: legacy_split_bands(image), number=1)
+    vectorized_seconds = timeit.timeit(lambda: vectorized_split_bands(image), number=args.repeat) / args.repeat
+
+    if legacy_split_bands(image) != vectorized_split_bands(image):
+        raise SystemExit('Vectorized bands differ from the legacy implementation.')
+
+    print(f'Strip size: {args.width}x{args.height}')
+    print(f'Legacy per-row detection: {legacy_seconds:.3f} s')
+    print(f'Vectorized detection:     {vectorized_seconds:.4f} s')
+    print(f'Speedup:                  {legacy_seconds / vectorized_seconds:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+"""
+Benchmark suite for the manga and book pipelines, run on a synthetic corpus.
+
+Every stage (`split_and_crop_image`, denoise, encode, canvas write, `is_text_pdf`) is timed on its own and every
+end-to-end path (`process_pdf`, `process_image_folder`, `process_archive`, `reduce_pdf_margins`) runs in a fresh
+process, so its peak RSS is measured in isolation. Results are saved as JSON; pass a previous result with `--compare` to print
+the change of every measure.
+
+Run it from the `books_manager` folder:
+
+    python -m benchmarks.pipeline_benchmark --output before.json
+    python -m benchmarks.pipeline_benchmark --output after.json --compare before.json
+
+The segment cache, the checkpoints and the classification cache are disabled unless they are explicitly set
+in the environment, so repeated runs measure the same work.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import tempfile
+import time
+from dataclasses import asdict
+from datetime import datetime, timezone
+
+import numpy as np
+
+# Settings are read from the environment when first imported
+os.environ.setdefault('USE_SEGMENT_CACHE', 'false')
+os.environ.setdefault('USE_CHECKPOINTS', 'false')
+os.environ.setdefault('CREATE_EPUB_FILES', 'false')
+os.environ.setdefault('CLASSIFICATION_CACHE_PATH', os.path.join(tempfile.gettempdir(), 'benchmark_classification.json'))
+
+from benchmarks.synthetic_corpus import Corpus, generate_corpus, add_spec_arguments, spec_from_arguments
+from common.instrumentation import peak_rss_mb
+
+PERCENTILES = (50, 90, 99)
+
+
+def summarize(latencies: list[float]) -> dict:
+    """Count, throughput and latency percentiles (in milliseconds) of a list of durations in seconds."""
+    if not latencies:
+        return {'count': 0}
+    samples = np.asarray(latencies) * 1000
+    total_seconds = float(samples.sum()) / 1000
+    summary = {
+        'count': len(latencies),
+        'total_seconds': round(total_seconds, 4),
+        'items_per_second': round(len(latencies) / total_seconds, 3) if total_seconds else None,
+        'mean_ms': round(float(samples.mean()), 3),
+        'max_ms': round(float(samples.max()), 3),
+    }
+    for percentile in PERCENTILES:
+        summary[f'p{percentile}_ms'] = round(float(np.percentile(samples, percentile)), 3)
+    return summary
+
+
+def timed(function, *args, **kwargs) -> tuple[float, object]:
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def extract_sources(pdf_path: str) -> list[tuple[int, int, bytes]]:
+    """Encoded images of a PDF as (page_num, img_index, image_data)."""
+    import fitz
+
+    from manga_manager.manga_pdf_operations import doc_pages_generator
+    with fitz.open(pdf_path) as doc:
+        return list(doc_pages_generator(doc))
+
+
+def benchmark_stages(corpus: Corpus, repeat: int) -> dict:
+    """Time every processing stage on its own, on the images of the corpus."""
+    from common.pdf_classification import classify_pdf
+    from manga_manager.manga_denoise_operations import denoise_image_array
+    from manga_manager.manga_images_operations import (
+        convert_for_processing, enhance_image_for_screen, encode_image_to_jpeg, load_image_by_str_data,
+        split_and_crop_image
+    )
+    from manga_manager.manga_page_analysis import analyze_page
+    from manga_manager.manga_pdf_writers import PDF_WRITER_BACKENDS, create_pdf_writer
+
+    latencies: dict[str, list[float]] = {
+        'analyze_page': [], 'split_and_crop_image': [], 'denoise': [], 'encode': [], 'is_text_pdf': []
+    }
+    split_images = []
+    for pdf_path in (corpus.manga_pdf, corpus.webtoon_pdf, corpus.noisy_pdf):
+        for page_num, img_index, image_data in extract_sources(pdf_path):
+            with load_image_by_str_data(image_data) as image:
+                seconds, analysis = timed(analyze_page, image)
+                latencies['analyze_page'].append(seconds)
+                image = convert_for_processing(image, monochrome=not analysis.is_colored)
+                seconds, images = timed(split_and_crop_image, image, page_num, img_index, analysis)
+                latencies['split_and_crop_image'].append(seconds)
+                split_images.extend(images)
+
+    # Denoise is timed on screen-sized noisy pages, which is what it receives inside the pipeline
+    for _, _, image_data in extract_sources(corpus.noisy_pdf):
+        with load_image_by_str_data(image_data) as image:
+            screen_image = enhance_image_for_screen(image.convert('L'))
+        seconds, _ = timed(denoise_image_array, np.asarray(screen_image))
+        latencies['denoise'].append(seconds)
+
+    encoded_segments = []
+    for _ in range(repeat):
+        encoded_segments = []
+        for split_image in split_images:
+            seconds, jpeg_data = timed(encode_image_to_jpeg, split_image)
+            latencies['encode'].append(seconds)
+            encoded_segments.append(jpeg_data)
+
+    for backend in PDF_WRITER_BACKENDS:
+        latencies[f'canvas_write_{backend}'] = []
+        latencies[f'canvas_save_{backend}'] = []
+        with tempfile.TemporaryDirectory() as temporary_folder:
+            for _ in range(repeat):
+                pdf_writer = create_pdf_writer(os.path.join(temporary_folder, 'out.pdf'), backend=backend)
+                for jpeg_data in encoded_segments:
+                    seconds, _ = timed(pdf_writer.add_jpeg_page, jpeg_data)
+                    latencies[f'canvas_write_{backend}'].append(seconds)
+                seconds, _ = timed(pdf_writer.close)
+                latencies[f'canvas_save_{backend}'].append(seconds)
+
+    for _ in range(repeat):
+        for pdf_path in (corpus.manga_pdf, corpus.webtoon_pdf, corpus.noisy_pdf, corpus.book_pdf):
+            seconds, _ = timed(classify_pdf, pdf_path, cache=None)
+            latencies['is_text_pdf'].append(seconds)
+
+    for split_image in split_images:
+        split_image.close()
+    return {name: summarize(stage_latencies) for name, stage_latencies in latencies.items()}
+
+
+def _run_end_to_end(path_name: str, input_path: str, output_folder: str) -> dict:
+    """Run one end-to-end path. Executed in a fresh process so its peak RSS is its own."""
+    output_path = os.path.join(output_folder, f'{path_name}.pdf')
+    result = {'input_bytes': os.path.getsize(input_path) if os.path.isfile(input_path) else sum(
+        entry.stat().st_size for entry in os.scandir(input_path)
+    )}
+    try:
+        if path_name == 'reduce_pdf_margins':
+            from book_manager.book_pdf_operations import reduce_pdf_margins
+            seconds, _ = timed(reduce_pdf_margins, input_path, output_path)
+        elif path_name == 'process_image_folder':
+            from manga_manager.manga_pdf_operations import process_image_folder
+            seconds, _ = timed(process_image_folder, input_path, output_path)
+        elif path_name == 'process_archive':
+            from manga_manager.manga_pdf_operations import process_archive
+            seconds, _ = timed(process_archive, input_path, output_path)
+        else:
+            from manga_manager.manga_pdf_operations import process_pdf
+            seconds, _ = timed(process_pdf, input_path, output_path)
+        result['seconds'] = round(seconds, 4)
+        if not os.path.exists(output_path):
+            raise RuntimeError(f'{output_path} was not created.')
+        import fitz
+        with fitz.open(output_path) as output_doc:
+            result['output_pages'] = output_doc.page_count
+        result['output_bytes'] = os.path.getsize(output_path)
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+    result['peak_rss_mb'] = round(peak_rss_mb(), 1)
+    return result
+
+
+def benchmark_end_to_end(corpus: Corpus) -> dict:
+    """Run every end-to-end path in its own process and report its throughput and peak RSS."""
+    import zipfile
+
+    import fitz
+
+    paths = {
+        'process_pdf_manga': corpus.manga_pdf,
+        'process_pdf_webtoon': corpus.webtoon_pdf,
+        'process_pdf_noisy': corpus.noisy_pdf,
+        'process_image_folder': corpus.image_folder,
+        'process_archive': corpus.archive,
+        'reduce_pdf_margins': corpus.book_pdf,
+    }
+    results = {}
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as output_folder:
+        for path_name, input_path in paths.items():
+            if os.path.isdir(input_path):
+                input_pages = len(os.listdir(input_path))
+            elif zipfile.is_zipfile(input_path):
+                with zipfile.ZipFile(input_path) as archive:
+                    input_pages = len(archive.namelist())
+            else:
+                with fitz.open(input_path) as input_doc:
+                    input_pages = input_doc.page_count
+            with context.Pool(processes=1) as pool:
+                result = pool.apply(_run_end_to_end, (path_name, input_path, output_folder))
+            result['input_pages'] = input_pages
+            if 'error' not in result and result.get('seconds'):
+                result['pages_per_second'] = round(input_pages / result['seconds'], 3)
+            results[path_name] = result
+            print(f'{path_name}: {result}')
+    return results
+
+
+def settings_snapshot() -> dict:
+    """Settings that change the measured work, recorded so that runs can be compared fairly."""
+    import settings
+    return {
+        name: getattr(settings, name) for name in dir(settings)
+        if name.isupper() and isinstance(getattr(settings, name), (bool, int, float, str))
+    }
+
+
+def compare(current: dict, baseline: dict) -> None:
+    """Print the ratio current/baseline of the main measure of every stage and path."""
+    print(f'\nComparison with {baseline["meta"]["timestamp"]} (ratio < 1 is faster/smaller):')
+    for name, summary in current['stages'].items():
+        previous = baseline.get('stages', {}).get(name, {})
+        if summary.get('p50_ms') and previous.get('p50_ms'):
+            print(f'  stage {name:28s} p50 {previous["p50_ms"]:9.3f} -> {summary["p50_ms"]:9.3f} ms '
+                  f'({summary["p50_ms"] / previous["p50_ms"]:.2f}x)')
+    for name, result in current['end_to_end'].items():
+        previous = baseline.get('end_to_end', {}).get(name, {})
+        for measure in ('seconds', 'peak_rss_mb', 'output_bytes'):
+            if result.get(measure) and previous.get(measure):
+                print(f'  {name:28s} {measure:14s} {previous[measure]:>12} -> {result[measure]:>12} '
+                      f'({result[measure] / previous[measure]:.2f}x)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', default='pipeline_benchmark.json', help='Path of the JSON results.')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare with.')
+    parser.add_argument('--corpus', help='Folder to generate the corpus in (a temporary folder by default).')
+    parser.add_argument('--repeat', type=int, default=3, help='Repetitions of the cheap stages.')
+    parser.add_argument('--skip-stages', action='store_true')
+    parser.add_argument('--skip-end-to-end', action='store_true')
+    add_spec_arguments(parser)
+    args = parser.parse_args()
+
+    spec = spec_from_arguments(args)
+    with tempfile.TemporaryDirectory() as temporary_folder:
+        corpus_folder = args.corpus or temporary_folder
+        seconds, corpus = timed(generate_corpus, corpus_folder, spec)
+        print(f'Corpus generated in {seconds:.2f}s at {corpus_folder}')
+
+        results = {
+            'meta': {
+                'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'corpus': asdict(spec),
+                'settings': settings_snapshot(),
+            },
+            'stages': {} if args.skip_stages else benchmark_stages(corpus, max(1, args.repeat)),
+            'end_to_end': {} if args.skip_end_to_end else benchmark_end_to_end(corpus),
+        }
+        results['meta']['stages_peak_rss_mb'] = round(peak_rss_mb(), 1)
+
+    with open(args.output, 'w', encoding='utf-8') as output_handler:
+        json.dump(results, output_handler, indent=2)
+    print(f'Results saved to {args.output}')
+
+    for name, summary in results['stages'].items():
+        if summary.get('count'):
+            print(f'  {name:28s} n={summary["count"]:4d}  p50={summary["p50_ms"]:9.3f} ms  '
+                  f'p90={summary["p90_ms"]:9.3f} ms  p99={summary["p99_ms"]:9.3f} ms')
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as baseline_handler:
+            compare(results, json.load(baseline_handler))
+
+
+if __name__ == '__main__':
+    main()
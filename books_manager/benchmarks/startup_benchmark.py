@@ -0,0 +1,99 @@
+"""
+Startup benchmark: time to import `main` and to run it on an empty input folder, each in a fresh interpreter.
+
+It also checks that none of the heavy libraries (cv2, numpy, PyMuPDF, Pillow, reportlab) is loaded by importing
+`main`, since they must only be imported by the subsystems that need them. The exit status is 1 when a heavy
+library is loaded or when the median run time exceeds `--max-ms`, so it can guard against startup regressions:
+
+    python -m benchmarks.startup_benchmark --max-ms 400
+
+Run it from the `books_manager` folder.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Folder of main.py, the runs happen in a temporary folder so their log file does not land in the sources
+BOOKS_MANAGER_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ('cv2', 'numpy', 'fitz', 'pymupdf', 'PIL', 'reportlab', 'natsort')
+
+_LOADED_HEAVY_MODULES = (
+    'import json, sys; import main; '
+    f'print(json.dumps([name for name in {HEAVY_MODULES!r} if name in sys.modules]))'
+)
+
+
+def time_command(command: list[str], env: dict, cwd: str, repeat: int) -> list[float]:
+    """Wall time, in milliseconds, of each of `repeat` runs of a command."""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, env=env, cwd=cwd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        durations.append((time.perf_counter() - start) * 1000)
+    return durations
+
+
+def summarize(durations: list[float]) -> dict:
+    return {
+        'runs': len(durations),
+        'min_ms': round(min(durations), 1),
+        'median_ms': round(statistics.median(durations), 1),
+        'max_ms': round(max(durations), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=10, help='Runs of each measure.')
+    parser.add_argument('--max-ms', type=float, default=0.0,
+                        help='Fail when the median run on an empty folder takes longer (0 disables the check).')
+    parser.add_argument('--output', help='Path of the JSON results.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temporary_folder:
+        env = dict(
+            os.environ,
+            INPUT_MANGAS_FOLDER_PATH=os.path.join(temporary_folder, 'input'),
+            OUTPUT_MANGAS_FOLDER_PATH=os.path.join(temporary_folder, 'output'),
+            PYTHONPATH=BOOKS_MANAGER_FOLDER,
+        )
+        os.makedirs(env['INPUT_MANGAS_FOLDER_PATH'])
+        repeat = max(1, args.repeat)
+        results = {
+            'interpreter': summarize(time_command([sys.executable, '-c', 'pass'], env, temporary_folder, repeat)),
+            'import_main': summarize(time_command(
+                [sys.executable, '-c', 'import main'], env, temporary_folder, repeat
+            )),
+            'empty_run': summarize(time_command(
+                [sys.executable, os.path.join(BOOKS_MANAGER_FOLDER, 'main.py')], env, temporary_folder, repeat
+            )),
+        }
+        loaded = subprocess.run([sys.executable, '-c', _LOADED_HEAVY_MODULES], env=env, cwd=temporary_folder,
+                                check=True, capture_output=True, text=True)
+        results['heavy_modules_loaded'] = json.loads(loaded.stdout.strip().splitlines()[-1])
+
+    for name in ('interpreter', 'import_main', 'empty_run'):
+        summary = results[name]
+        print(f'{name:12s} min={summary["min_ms"]:8.1f} ms  median={summary["median_ms"]:8.1f} ms  '
+              f'max={summary["max_ms"]:8.1f} ms')
+    print(f'Heavy modules loaded by importing main: {results["heavy_modules_loaded"] or "none"}')
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_handler:
+            json.dump(results, output_handler, indent=2)
+
+    failed = bool(results['heavy_modules_loaded'])
+    if args.max_ms and results['empty_run']['median_ms'] > args.max_ms:
+        print(f'Median empty run {results["empty_run"]["median_ms"]} ms exceeds {args.max_ms} ms.')
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+"""
+Generator of reproducible synthetic corpora for the benchmarks.
+
+Every document is drawn from a seeded random generator, so the same arguments always produce the same files:
+
+- grayscale manga pages with panels separated by white gutters,
+- tall colored webtoon strips with white and black gutters,
+- noisy grayscale scans,
+- text-heavy book PDFs,
+- folders of manga page images,
+- CBZ archives of the same pages.
+
+Run it from the `books_manager` folder to write a corpus to disk:
+
+    python -m benchmarks.synthetic_corpus /tmp/corpus --pages 12
+"""
+import argparse
+import io
+import os
+import zipfile
+from dataclasses import dataclass, asdict
+
+import fitz  # PyMuPDF
+import numpy as np
+from PIL import Image
+
+LOREM_WORDS = (
+    'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore et dolore '
+    'magna aliqua ut enim ad minim veniam quis nostrud exercitation ullamco laboris nisi aliquip ex ea commodo'
+).split()
+
+
+@dataclass(frozen=True)
+class CorpusSpec:
+    """Size of every kind of document in a synthetic corpus."""
+    pages: int = 12
+    page_width: int = 1600
+    page_height: int = 2400
+    strips: int = 4
+    strip_width: int = 900
+    strip_height: int = 8000
+    noise_sigma: float = 18.0
+    book_pages: int = 40
+    jpeg_quality: int = 90
+    seed: int = 0
+
+
+@dataclass(frozen=True)
+class Corpus:
+    """Paths of the documents of a generated corpus."""
+    folder_path: str
+    manga_pdf: str
+    webtoon_pdf: str
+    noisy_pdf: str
+    book_pdf: str
+    image_folder: str
+    archive: str
+
+
+def _encode_jpeg(array: np.ndarray, quality: int) -> bytes:
+    with io.BytesIO() as buffer:
+        Image.fromarray(array).save(buffer, format='JPEG', quality=quality)
+        return buffer.getvalue()
+
+
+def _panel_texture(rng: np.random.Generator, height: int, width: int, channels: int = 0) -> np.ndarray:
+    """Screen-tone like texture: smooth gradients, ink lines and a little grain."""
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, None]
+    x = np.linspace(0, 1, width, dtype=np.float32)[None, :]
+    base = 150 + 60 * np.sin(2 * np.pi * (x * rng.uniform(1, 4) + y * rng.uniform(1, 4)))
+    base = base + rng.normal(0, 6, size=(height, width))
+    for _ in range(rng.integers(4, 12)):
+        if rng.random() < 0.5:
+            row = rng.integers(0, height)
+            base[row:row + 3] = 20
+        else:
+            col = rng.integers(0, width)
+            base[:, col:col + 3] = 20
+    texture = np.clip(base, 0, 255).astype(np.uint8)
+    if channels:
+        tints = rng.uniform(0.5, 1.0, size=channels).astype(np.float32)
+        texture = np.clip(texture[:, :, None] * tints, 0, 255).astype(np.uint8)
+    return texture
+
+
+def manga_page(rng: np.random.Generator, width: int, height: int, gutter: int = 40) -> np.ndarray:
+    """Grayscale page with a margin and a grid of panels separated by white gutters."""
+    page = np.full((height, width), 255, dtype=np.uint8)
+    margin = width // 16
+    rows = int(rng.integers(2, 5))
+    row_edges = np.linspace(margin, height - margin, rows + 1).astype(int)
+    for top, bottom in zip(row_edges[:-1], row_edges[1:]):
+        columns = int(rng.integers(1, 4))
+        column_edges = np.linspace(margin, width - margin, columns + 1).astype(int)
+        for left, right in zip(column_edges[:-1], column_edges[1:]):
+            panel_top, panel_bottom = top + gutter // 2, bottom - gutter // 2
+            panel_left, panel_right = left + gutter // 2, right - gutter // 2
+            page[panel_top:panel_bottom, panel_left:panel_right] = _panel_texture(
+                rng, panel_bottom - panel_top, panel_right - panel_left
+            )
+            # Panel border
+            page[panel_top:panel_top + 4, panel_left:panel_right] = 0
+            page[panel_bottom - 4:panel_bottom, panel_left:panel_right] = 0
+            page[panel_top:panel_bottom, panel_left:panel_left + 4] = 0
+            page[panel_top:panel_bottom, panel_right - 4:panel_right] = 0
+    return page
+
+
+def webtoon_strip(rng: np.random.Generator, width: int, height: int, gutter: int = 160) -> np.ndarray:
+    """Tall colored strip of panels separated by alternating white and black gutters."""
+    strip = np.full((height, width, 3), 255, dtype=np.uint8)
+    top, gutter_color = gutter, 0
+    while top < height - gutter:
+        panel_height = int(rng.integers(height // 10, height // 4))
+        bottom = min(height - gutter, top + panel_height)
+        strip[top:bottom, gutter // 4:width - gutter // 4] = _panel_texture(
+            rng, bottom - top, width - gutter // 2, channels=3
+        )
+        strip[bottom:bottom + gutter] = gutter_color
+        gutter_color = 255 if gutter_color == 0 else 0
+        top = bottom + gutter
+    return strip
+
+
+def noisy_scan(rng: np.random.Generator, width: int, height: int, sigma: float) -> np.ndarray:
+    """Manga page with gaussian sensor noise and a slightly gray paper tone."""
+    page = manga_page(rng, width, height).astype(np.float32) * 0.92
+    page += rng.normal(0, sigma, size=page.shape)
+    return np.clip(page, 0, 255).astype(np.uint8)
+
+
+def _images_pdf(pdf_path: str, pages: list[np.ndarray], quality: int) -> None:
+    with fitz.open() as doc:
+        for page_array in pages:
+            height, width = page_array.shape[:2]
+            page = doc.new_page(width=width, height=height)
+            page.insert_image(page.rect, stream=_encode_jpeg(page_array, quality))
+        doc.save(pdf_path)
+
+
+def book_pdf(pdf_path: str, pages: int, rng: np.random.Generator) -> None:
+    """Text-only PDF with wide margins, like a scanned-less ebook export."""
+    with fitz.open() as doc:
+        for page_num in range(pages):
+            page = doc.new_page(width=595, height=842)
+            paragraph = ' '.join(rng.choice(LOREM_WORDS, size=420))
+            page.insert_textbox(fitz.Rect(90, 90, 505, 752), f'Chapter {page_num + 1}\n\n{paragraph}', fontsize=11)
+        doc.save(pdf_path)
+
+
+def generate_corpus(folder_path: str, spec: CorpusSpec = CorpusSpec()) -> Corpus:
+    """Write every document of a corpus to `folder_path` and return their paths."""
+    os.makedirs(folder_path, exist_ok=True)
+    rng = np.random.default_rng(spec.seed)
+    corpus = Corpus(
+        folder_path=folder_path,
+        manga_pdf=os.path.join(folder_path, 'manga_grayscale.pdf'),
+        webtoon_pdf=os.path.join(folder_path, 'webtoon_color.pdf'),
+        noisy_pdf=os.path.join(folder_path, 'noisy_scans.pdf'),
+        book_pdf=os.path.join(folder_path, 'book_text.pdf'),
+        image_folder=os.path.join(folder_path, 'manga_folder'),
+        archive=os.path.join(folder_path, 'manga_archive.cbz'),
+    )
+
+    manga_pages = [manga_page(rng, spec.page_width, spec.page_height) for _ in range(spec.pages)]
+    _images_pdf(corpus.manga_pdf, manga_pages, spec.jpeg_quality)
+
+    # The first page of a document is never split, so it gets a regular page before the strips
+    strips = [manga_page(rng, spec.strip_width, spec.strip_width * 4 // 3)]
+    strips += [webtoon_strip(rng, spec.strip_width, spec.strip_height) for _ in range(spec.strips)]
+    _images_pdf(corpus.webtoon_pdf, strips, spec.jpeg_quality)
+
+    noisy_pages = [noisy_scan(rng, spec.page_width, spec.page_height, spec.noise_sigma) for _ in range(spec.pages)]
+    _images_pdf(corpus.noisy_pdf, noisy_pages, spec.jpeg_quality)
+
+    book_pdf(corpus.book_pdf, spec.book_pages, rng)
+
+    os.makedirs(corpus.image_folder, exist_ok=True)
+    with zipfile.ZipFile(corpus.archive, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for page_index, page_array in enumerate(manga_pages):
+            jpeg_data = _encode_jpeg(page_array, spec.jpeg_quality)
+            with open(os.path.join(corpus.image_folder, f'{page_index + 1:03d}.jpg'), 'wb') as image_handler:
+                image_handler.write(jpeg_data)
+            archive.writestr(f'volume/{page_index + 1:03d}.jpg', jpeg_data)
+    return corpus
+
+
+def add_spec_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add one command line option per field of `CorpusSpec`."""
+    for name, default in asdict(CorpusSpec()).items():
+        parser.add_argument(f'--{name.replace("_", "-")}', type=type(default), default=default)
+
+
+def spec_from_arguments(args: argparse.Namespace) -> CorpusSpec:
+    return CorpusSpec(**{name: getattr(args, name) for name in asdict(CorpusSpec())})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('folder_path')
+    add_spec_arguments(parser)
+    args = parser.parse_args()
+    corpus = generate_corpus(args.folder_path, spec_from_arguments(args))
+    for name, path in asdict(corpus).items():
+        print(f'{name}: {path}')
+
+
+if __name__ == '__main__':
+    main()
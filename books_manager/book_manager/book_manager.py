@@ -1,31 +1,40 @@
 import logging
 import os
+import time
 
+import fitz  # PyMuPDF
+
+from common import instrumentation
 from common.epub_operations import convert_pdf_to_epub
 from common.files_operations import get_file_size
-from settings import file_size_comparison, CREATE_EPUB_FILES
+from common.processing_results import FileProcessingResult
+from common.pymupdf_access import PYMUPDF_LOCK, open_pdf_document
+from settings import CREATE_EPUB_FILES
 from book_manager.book_pdf_operations import reduce_pdf_margins
 from book_manager.book_str_operations import extract_book_name_from_path
 
 logger = logging.getLogger('_books_manager_')
 
 
-def process_book(file_path: str, destiny_folder_path: str) -> None:
+def process_book(file_path: str, destiny_folder_path: str, doc: fitz.Document | None = None) -> FileProcessingResult:
     """
     Process a PDF file considered as a book.
 
     :param file_path: Path to the input PDF file.
     :param destiny_folder_path: Path to the output folder where the processed book will be saved.
+    :param doc: The input PDF already opened, to avoid parsing it again. It is closed before the input is deleted.
+    :return: The sizes, timing and error (if any) of the processed book.
     """
-    try:
-        # Create output folder path, file name, and extracts book name from the file name
-        file_name_with_extension = os.path.basename(file_path)
-
-        # Extract the book name from the file name
-        book_name = extract_book_name_from_path(file_name_with_extension.replace('.pdf', ''))
+    start_time = time.perf_counter()
+    # Create output folder path, file name, and extracts book name from the file name
+    file_name_with_extension = os.path.basename(file_path)
 
+    # Extract the book name from the file name
+    book_name = extract_book_name_from_path(file_name_with_extension.replace('.pdf', ''))
+    result = FileProcessingResult(file_path=file_path, name=book_name, kind='book')
+    try:
         # Record the original file size for comparison
-        file_size_comparison[f'{book_name} original'] = file_size_comparison.get(f'{book_name} original', 0) + get_file_size(file_path)
+        result.original_size = get_file_size(file_path)
 
         # Create the output folder path
         output_folder_path = os.path.join(destiny_folder_path, book_name)
@@ -39,21 +48,42 @@ def process_book(file_path: str, destiny_folder_path: str) -> None:
         logger.info(f'Starting text extraction and processing for {file_name_with_extension}')
 
         # Split and save the text PDF (placeholder function)
-        reduce_pdf_margins(
-            pdf_path=file_path,  # Input PDF file
-            output_path=new_pdf_path,  # Output PDF file path
-        )
+        with instrumentation.file_stage('margins'):
+            reduce_pdf_margins(
+                pdf_path=file_path,  # Input PDF file
+                output_path=new_pdf_path,  # Output PDF file path
+                doc=doc,
+            )
 
-        # Clean up: delete the original PDF file
-        os.remove(file_path)
+        # The output is committed atomically, keep the original if it was not produced
+        if not os.path.isfile(new_pdf_path):
+            raise RuntimeError(f'Output {new_pdf_path} was not created, keeping the original {file_path}.')
+
+        # Cropping keeps every page
+        with open_pdf_document(new_pdf_path, doc) as page_count_doc, PYMUPDF_LOCK:
+            result.pages = result.output_pages = page_count_doc.page_count
 
         if CREATE_EPUB_FILES:
-            convert_pdf_to_epub(new_pdf_path, new_pdf_path.replace('.pdf', '.epub'))
+            # Reuse the document already in memory instead of parsing the new PDF again
+            with instrumentation.file_stage('epub'):
+                convert_pdf_to_epub(new_pdf_path, new_pdf_path.replace('.pdf', '.epub'), doc=doc)
+
+        # Release the input before deleting it, open files cannot be removed on Windows
+        if doc is not None:
+            with PYMUPDF_LOCK:
+                doc.close()
+
+        # Clean up: delete the original PDF file
+        os.remove(file_path)
 
         # Update the new file size for comparison
-        file_size_comparison[f'{book_name} new'] = file_size_comparison.get(f'{book_name} new', 0) + get_file_size(new_pdf_path)
+        result.new_size = get_file_size(new_pdf_path)
 
         logger.info(f'Successfully processed {file_name_with_extension} and cleaned up temporary files.')
 
     except Exception as e:
         logger.error(f'Error processing {file_path}: {e}', exc_info=True)
+        result.error = str(e)
+
+    result.elapsed_seconds = time.perf_counter() - start_time
+    return result
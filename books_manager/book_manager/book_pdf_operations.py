@@ -1,55 +1,179 @@
 import fitz  # PyMuPDF
 import logging
+import math
+import os
 
-from settings import FINAL_DOCUMENT_WIDTH, FINAL_DOCUMENT_HEIGHT
+from common.pymupdf_access import PYMUPDF_LOCK, open_pdf_document
+from settings import (FINAL_DOCUMENT_WIDTH, FINAL_DOCUMENT_HEIGHT, IMAGE_QUALITY, OPTIMIZE_BOOKS,
+                      BOOK_IMAGE_RESOLUTION_FACTOR, REMOVE_CONTENT_OUTSIDE_CROP)
 
 logger = logging.getLogger('_books_manager_')
 
+# Images are only recompressed when they would shrink to this scale or less, smaller gains are not worth the
+# generation loss of a new JPEG
+DOWNSAMPLE_MAX_SCALE = 0.75
 
-def reduce_pdf_margins(pdf_path: str, output_path: str, new_width: int = FINAL_DOCUMENT_WIDTH, new_height: int = FINAL_DOCUMENT_HEIGHT):
+
+def crop_rect(rect: fitz.Rect, new_width: int, new_height: int) -> fitz.Rect:
+    """Centered rectangle of `new_width` x `new_height` inside `rect`, or `rect` itself if it is not larger."""
+    crop_margin_x = (rect.width - new_width) / 2
+    crop_margin_y = (rect.height - new_height) / 2
+    if crop_margin_x > 0 and crop_margin_y > 0:
+        return fitz.Rect(
+            rect.x0 + crop_margin_x, rect.y0 + crop_margin_y,
+            rect.x1 - crop_margin_x, rect.y1 - crop_margin_y
+        )
+    return rect
+
+
+def remove_content_outside(page: fitz.Page, new_rect: fitz.Rect) -> None:
+    """
+    Remove the text and drawings of a page that lie outside `new_rect`, so readers do not parse hidden content.
+
+    Images are kept whole: one crossing the crop edge is still partly visible, and blanking its hidden pixels
+    would mean decoding and encoding it again.
+    """
+    rect = page.rect
+    strips = [
+        fitz.Rect(rect.x0, rect.y0, rect.x1, new_rect.y0),
+        fitz.Rect(rect.x0, new_rect.y1, rect.x1, rect.y1),
+        fitz.Rect(rect.x0, new_rect.y0, new_rect.x0, new_rect.y1),
+        fitz.Rect(new_rect.x1, new_rect.y0, rect.x1, new_rect.y1),
+    ]
+    for strip in strips:
+        if not strip.is_empty:
+            page.add_redact_annot(strip, fill=False, cross_out=False)
+    page.apply_redactions(images=fitz.PDF_REDACT_IMAGE_NONE, graphics=fitz.PDF_REDACT_LINE_ART_REMOVE_IF_COVERED,
+                          text=fitz.PDF_REDACT_TEXT_REMOVE)
+
+
+def collect_image_scales(page: fitz.Page, new_rect: fitz.Rect, image_scales: dict[int, float],
+                         resolution_factor: float = BOOK_IMAGE_RESOLUTION_FACTOR) -> None:
+    """
+    Record the scale each image of a page needs to be displayed at the screen resolution.
+
+    The cropped page is shown fitted to the FINAL_DOCUMENT_WIDTH x FINAL_DOCUMENT_HEIGHT screen, an image needs
+    as many pixels as the screen gives to the area it is drawn in, times `resolution_factor`. An image drawn on
+    several pages or several times keeps the largest scale.
+
+    :param page: Page, before its boxes are changed.
+    :param new_rect: Area of the page that remains visible, in page coordinates.
+    :param image_scales: Scale needed by each image xref, updated in place.
+    :param resolution_factor: Pixels kept per screen pixel, to leave room for zoom.
+    """
+    pixels_per_point = min(FINAL_DOCUMENT_WIDTH / new_rect.width,
+                           FINAL_DOCUMENT_HEIGHT / new_rect.height) * resolution_factor
+    for xref, smask, width, height, bits_per_component, colorspace, *_ in page.get_images(full=True):
+        if smask or not colorspace or bits_per_component < 8:
+            # Transparent images, stencil masks and bilevel scans are left as they are
+            image_scales[xref] = math.inf
+            continue
+        for image_rect in page.get_image_rects(xref):
+            drawn_pixels = max(image_rect.width, image_rect.height) * pixels_per_point
+            scale = drawn_pixels / max(width, height, 1)
+            image_scales[xref] = max(scale, image_scales.get(xref, 0.0))
+
+
+def downsample_images(doc: fitz.Document, image_scales: dict[int, float], quality: int = IMAGE_QUALITY) -> int:
+    """
+    Replace the images that are larger than they are displayed by a JPEG at the resolution they need.
+
+    The image objects are updated in place, so every page drawing them keeps its placement and the images
+    shared by several pages stay shared. An image is only replaced when the new stream is smaller.
+
+    :return: Number of images replaced.
+    """
+    replaced = 0
+    for xref, scale in image_scales.items():
+        if scale > DOWNSAMPLE_MAX_SCALE:
+            continue
+        try:
+            with PYMUPDF_LOCK:
+                pixmap = fitz.Pixmap(doc, xref)
+                if pixmap.alpha:
+                    pixmap = fitz.Pixmap(pixmap, 0)
+                if pixmap.colorspace is None or pixmap.colorspace.n not in (1, 3):
+                    pixmap = fitz.Pixmap(fitz.csRGB, pixmap)
+                width = max(1, math.ceil(pixmap.width * scale))
+                height = max(1, math.ceil(pixmap.height * scale))
+                stream = fitz.Pixmap(pixmap, width, height, None).tobytes('jpeg', jpg_quality=quality)
+                if len(stream) >= len(doc.xref_stream_raw(xref)):
+                    continue
+
+                doc.update_stream(xref, stream, compress=False)
+                doc.xref_set_key(xref, 'Filter', '/DCTDecode')
+                doc.xref_set_key(xref, 'Width', str(width))
+                doc.xref_set_key(xref, 'Height', str(height))
+                doc.xref_set_key(xref, 'BitsPerComponent', '8')
+                doc.xref_set_key(xref, 'ColorSpace', '/DeviceGray' if pixmap.colorspace.n == 1 else '/DeviceRGB')
+                for key in ('DecodeParms', 'Decode', 'Intent'):
+                    doc.xref_set_key(xref, key, 'null')
+            replaced += 1
+        except Exception as e:
+            logger.error(f'Could not downsample image {xref}, keeping it: {e}')
+    return replaced
+
+
+def reduce_pdf_margins(pdf_path: str, output_path: str, new_width: int = FINAL_DOCUMENT_WIDTH,
+                       new_height: int = FINAL_DOCUMENT_HEIGHT, doc: fitz.Document | None = None,
+                       optimize: bool = OPTIMIZE_BOOKS,
+                       remove_content_outside_crop: bool = REMOVE_CONTENT_OUTSIDE_CROP):
     """
     Removes margins from a PDF and adjusts it to fit on a 7" 4:3 screen for better reading.
 
+    The output is only replaced once the new PDF is complete. Errors are logged and raised, an existing output
+    is left as it was.
+
     :param pdf_path: Path to the input PDF file.
     :param output_path: Path to save the modified PDF.
     :param new_width: New page width (in inches) for a 7" 4:3 format screen.
     :param new_height: New page height (in inches) for a 7" 4:3 format screen.
+    :param doc: The PDF already opened, to avoid parsing it again. It is modified in place and left open.
+    :param optimize: Downsample the embedded images to the screen resolution and save the PDF garbage-collected,
+                     deduplicated, deflated and with object streams.
+    :param remove_content_outside_crop: Remove the text and drawings hidden by the crop instead of keeping them.
     """
+    temporary_output_path = f'{output_path}.part'
     try:
-        # Open the original PDF
-        doc = fitz.open(pdf_path)
-        num_pages = doc.page_count
-
-        # Iterate through each page and crop margins
-        for page_num in range(num_pages):
-            page = doc.load_page(page_num)
-            rect = page.rect  # Get the rectangle dimensions of the page
-
-            # Adjust the bounding box by trimming some of the margins (can be fine-tuned)
-            # Example trimming, change as needed
-            crop_margin_x = (rect.width - new_width) / 2
-            crop_margin_y = (rect.height - new_height) / 2
-
-            # Apply the crop by adjusting the rectangle
-            if crop_margin_x > 0 and crop_margin_y > 0:
-                new_rect = fitz.Rect(
-                    rect.x0 + crop_margin_x, rect.y0 + crop_margin_y,
-                    rect.x1 - crop_margin_x, rect.y1 - crop_margin_y
-                )
-            else:
-                new_rect = rect
-
-            # Crop the page
-            page.set_cropbox(new_rect)
-            page.set_media_box(new_rect)
-            page.set_bleedbox(new_rect)
-            page.set_trimbox(new_rect)
-
-        # Save the modified PDF to the output path
-        doc.save(output_path)
-        doc.close()
-
-        print(f"PDF processed and saved at: {output_path}")
+        # Open the original PDF, it is closed on every path if it was opened here
+        with open_pdf_document(pdf_path, doc) as doc:
+            with PYMUPDF_LOCK:
+                num_pages = doc.page_count
+            image_scales: dict[int, float] = {}
+
+            # Iterate through each page and crop margins. The lock is taken per page, so other documents progress
+            for page_num in range(num_pages):
+                with PYMUPDF_LOCK:
+                    page = doc.load_page(page_num)
+                    rect = page.rect  # Get the rectangle dimensions of the page
+                    new_rect = crop_rect(rect, new_width, new_height)
+
+                    if remove_content_outside_crop and new_rect != rect:
+                        remove_content_outside(page, new_rect)
+                    if optimize:
+                        collect_image_scales(page, new_rect, image_scales)
+
+                    # Crop the page. The media box is in unrotated PDF coordinates, and setting it drops the
+                    # crop, bleed and trim boxes, which then default to it.
+                    page.set_mediabox((new_rect * page.derotation_matrix * ~page.transformation_matrix).normalize())
+
+            save_options = {}
+            if optimize:
+                replaced = downsample_images(doc, image_scales)
+                logger.info(f'Downsampled {replaced} of {len(image_scales)} images to the screen resolution.')
+                # garbage=4 also merges identical objects, such as fonts and images embedded several times
+                save_options = dict(garbage=4, deflate=True, deflate_images=True, deflate_fonts=True, use_objstms=1)
+
+            # Save the modified PDF to a temporary file and move it into place, so the output is never partial
+            with PYMUPDF_LOCK:
+                doc.save(temporary_output_path, **save_options)
+        os.replace(temporary_output_path, output_path)
+
+        logger.info(f"PDF processed and saved at: {output_path}")
 
     except Exception as e:
-        print(f"Error processing the PDF: {e}")
+        logger.error(f"Error processing the PDF: {e}")
+        raise
+    finally:
+        if os.path.exists(temporary_output_path):
+            os.remove(temporary_output_path)
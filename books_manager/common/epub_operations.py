@@ -1,78 +1,252 @@
 import os
 import logging
+import uuid
+import zipfile
+from datetime import datetime, timezone
+from io import BytesIO
+from xml.sax.saxutils import escape
+
 import fitz  # PyMuPDF
-from ebooklib import epub
+
+from common.pymupdf_access import PYMUPDF_LOCK, open_pdf_document
+from settings import EPUB_COMPRESSION_LEVEL, IMAGE_QUALITY
 
 # Set up logging
 logger = logging.getLogger('pdf_to_epub_converter')
 
 
-def convert_pdf_to_epub(pdf_path: str, epub_path: str):
+CONTAINER_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>
+"""
+
+
+class EpubImageWriter:
+    """
+    Streams a fixed-layout EPUB with one page per JPEG image, in the order the images are added.
+
+    Every image and its XHTML page are written to the zip container as soon as they are added, so memory stays
+    bounded regardless of the page count. Only the size of each page is kept, to write the manifest, the spine
+    and the navigation documents when the writer is closed.
+
+    It exposes the same `add_jpeg_page`/`close` interface as the PDF writers, so the EPUB can be produced from
+    the same stream of processed segments as the PDF.
+    """
+
+    def __init__(self, epub_path: str, title: str | None = None, compression_level: int = EPUB_COMPRESSION_LEVEL):
+        self.epub_path = epub_path
+        self.title = title or os.path.splitext(os.path.basename(epub_path))[0]
+        self.identifier = f'urn:uuid:{uuid.uuid5(uuid.NAMESPACE_URL, os.path.abspath(epub_path))}'
+        self.page_sizes: list[tuple[int, int]] = []
+        self._temporary_epub_path = f'{epub_path}.part'
+        self._zip_file = zipfile.ZipFile(
+            self._temporary_epub_path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=compression_level
+        )
+        # The mimetype must be the first entry and stored uncompressed
+        self._zip_file.writestr('mimetype', 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        self._zip_file.writestr('META-INF/container.xml', CONTAINER_XML)
+
+    @property
+    def page_count(self) -> int:
+        return len(self.page_sizes)
+
+    def add_jpeg_page(self, jpeg_data: bytes) -> None:
+        """Write an encoded JPEG and the XHTML page displaying it."""
+        from PIL import Image
+
+        # Only the header is parsed to read the size, the image is not decoded
+        with Image.open(BytesIO(jpeg_data)) as image:
+            width, height = image.size
+        self.page_sizes.append((width, height))
+        page_num = self.page_count
+
+        # JPEG data is already compressed, deflating it again only costs CPU
+        self._zip_file.writestr(f'OEBPS/{_image_name(page_num)}', jpeg_data, compress_type=zipfile.ZIP_STORED)
+        self._zip_file.writestr(f'OEBPS/{_page_name(page_num)}', _page_xhtml(page_num, width, height))
+
+    def close(self) -> None:
+        """Write the manifest, spine and navigation documents and atomically replace any previous EPUB."""
+        if self.page_count == 0:
+            logger.warning(f"No pages were added to {self.epub_path}, skipping it.")
+            self.abort()
+            return
+        self._zip_file.writestr('OEBPS/content.opf', self._content_opf())
+        self._zip_file.writestr('OEBPS/nav.xhtml', self._nav_xhtml())
+        self._zip_file.writestr('OEBPS/toc.ncx', self._toc_ncx())
+        self._zip_file.close()
+        os.replace(self._temporary_epub_path, self.epub_path)
+        logger.info(f"EPUB saved at: {self.epub_path}")
+
+    def abort(self) -> None:
+        """Discard the partially written EPUB."""
+        self._zip_file.close()
+        if os.path.exists(self._temporary_epub_path):
+            os.remove(self._temporary_epub_path)
+
+    def _content_opf(self) -> str:
+        modified = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        manifest_items = [
+            '<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>',
+            '<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>',
+        ]
+        spine_items = []
+        for page_num in range(1, self.page_count + 1):
+            cover_property = ' properties="cover-image"' if page_num == 1 else ''
+            manifest_items.append(
+                f'<item id="image_{page_num}" href="{_image_name(page_num)}" media-type="image/jpeg"{cover_property}/>'
+            )
+            manifest_items.append(
+                f'<item id="page_{page_num}" href="{_page_name(page_num)}" media-type="application/xhtml+xml"/>'
+            )
+            spine_items.append(f'<itemref idref="page_{page_num}"/>')
+        manifest = '\n    '.join(manifest_items)
+        spine = '\n    '.join(spine_items)
+        return f"""<?xml version="1.0" encoding="UTF-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="book-id"
+         prefix="rendition: http://www.idpf.org/vocab/rendition/#">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:identifier id="book-id">{self.identifier}</dc:identifier>
+    <dc:title>{escape(self.title)}</dc:title>
+    <dc:language>en</dc:language>
+    <meta property="dcterms:modified">{modified}</meta>
+    <meta property="rendition:layout">pre-paginated</meta>
+    <meta property="rendition:orientation">portrait</meta>
+    <meta property="rendition:spread">none</meta>
+    <meta name="cover" content="image_1"/>
+  </metadata>
+  <manifest>
+    {manifest}
+  </manifest>
+  <spine toc="ncx">
+    {spine}
+  </spine>
+</package>
+"""
+
+    def _nav_xhtml(self) -> str:
+        return f"""<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="en">
+<head><title>{escape(self.title)}</title></head>
+<body>
+  <nav epub:type="toc" id="toc">
+    <ol>
+      <li><a href="{_page_name(1)}">{escape(self.title)}</a></li>
+    </ol>
+  </nav>
+</body>
+</html>
+"""
+
+    def _toc_ncx(self) -> str:
+        return f"""<?xml version="1.0" encoding="UTF-8"?>
+<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">
+  <head>
+    <meta name="dtb:uid" content="{self.identifier}"/>
+  </head>
+  <docTitle><text>{escape(self.title)}</text></docTitle>
+  <navMap>
+    <navPoint id="navpoint_1" playOrder="1">
+      <navLabel><text>{escape(self.title)}</text></navLabel>
+      <content src="{_page_name(1)}"/>
+    </navPoint>
+  </navMap>
+</ncx>
+"""
+
+
+def _image_name(page_num: int) -> str:
+    return f'images/page_{page_num:05d}.jpg'
+
+
+def _page_name(page_num: int) -> str:
+    return f'pages/page_{page_num:05d}.xhtml'
+
+
+def _page_xhtml(page_num: int, width: int, height: int) -> str:
+    """XHTML of a fixed-layout page showing a single image that fills the viewport."""
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" lang="en">
+<head>
+  <title>Page {page_num}</title>
+  <meta name="viewport" content="width={width}, height={height}"/>
+  <style>body {{ margin: 0; padding: 0; }} img {{ display: block; width: {width}px; height: {height}px; }}</style>
+</head>
+<body><img src="../{_image_name(page_num)}" alt="Page {page_num}"/></body>
+</html>
+"""
+
+
+def convert_pdf_to_epub(pdf_path: str, epub_path: str, doc: fitz.Document | None = None):
     """
     Convert a PDF file to an EPUB file by extracting images and adding them to the EPUB.
 
     :param pdf_path: Path to the input PDF file.
     :param epub_path: Path to save the output EPUB file.
+    :param doc: The PDF already opened, to avoid parsing it again. Opened from `pdf_path` if not provided.
     """
     try:
-        if not os.path.exists(pdf_path):
+        if doc is None and not os.path.exists(pdf_path):
             logger.error(f"PDF file does not exist: {pdf_path}")
             raise FileNotFoundError(f"{pdf_path} not found.")
 
         logger.info(f"Starting conversion from PDF to EPUB: {pdf_path}")
 
-        # Create an EPUB book
-        book = epub.EpubBook()
-        book.set_identifier('id123456')
-        book.set_title('a')
-        book.set_language('en')
-
         # Open the PDF
-        with fitz.open(pdf_path) as doc:
-            if doc.page_count == 0:
+        with open_pdf_document(pdf_path, doc) as doc:
+            with PYMUPDF_LOCK:
+                page_count = doc.page_count
+            if page_count == 0:
                 logger.warning(f"PDF {pdf_path} has no pages.")
                 return
 
-            for page_num in range(len(doc)):
-                page = doc.load_page(page_num)
-                images = page.get_images(full=True)
-
-                if not images:
-                    logger.warning(f"No images found on page {page_num}.")
-                    continue
-
-                logger.info(f"Found {len(images)} images on page {page_num}.")
-
-                for img_index, img in enumerate(images):
-                    try:
-                        xref = img[0]
-                        base_image = doc.extract_image(xref)
-                        image_data = base_image["image"]
-                        image_name = f'image_{page_num + 1}_{img_index + 1}.jpg'
-
-                        # Save image to the EPUB
-                        img_item = epub.EpubImage()
-                        img_item.set_content(image_data)
-                        book.add_item(img_item)
-
-                        # Create a new chapter for each image
-                        chapter = epub.EpubHtml(title=f'Page {page_num + 1}', file_name=f'chap_{page_num + 1}.xhtml',
-                                                lang='en')
-                        chapter.content = f'<html><body><h1>Page {page_num + 1}</h1><img src="{image_name}" /></body></html>'
-                        book.add_item(chapter)
-                        book.spine.append(chapter)
-
-                    except Exception as e:
-                        logger.error(f"Failed to extract image {img_index} on page {page_num}: {e}")
+            # The writer opens the partial EPUB, it is discarded if the conversion does not complete
+            epub_writer = EpubImageWriter(epub_path)
+            try:
+                for page_num in range(page_count):
+                    with PYMUPDF_LOCK:
+                        images = doc.load_page(page_num).get_images(full=True)
+
+                    if not images:
+                        logger.warning(f"No images found on page {page_num}.")
                         continue
 
-        # Write the EPUB file
-        epub.write_epub(epub_path, book)
+                    logger.info(f"Found {len(images)} images on page {page_num}.")
+
+                    for img_index, img in enumerate(images):
+                        try:
+                            xref = img[0]
+                            with PYMUPDF_LOCK:
+                                base_image = doc.extract_image(xref)
+                            image_data = base_image["image"]
+                            if base_image["ext"] not in ('jpeg', 'jpg'):
+                                from PIL import Image
+
+                                # Pages are declared as JPEG in the EPUB manifest
+                                with Image.open(BytesIO(image_data)) as image, BytesIO() as image_buffer:
+                                    image.convert('RGB').save(image_buffer, format='JPEG', quality=IMAGE_QUALITY)
+                                    image_data = image_buffer.getvalue()
+                            epub_writer.add_jpeg_page(image_data)
+
+                        except Exception as e:
+                            logger.error(f"Failed to extract image {img_index} on page {page_num}: {e}")
+                            continue
+
+                # Write the EPUB file
+                epub_writer.close()
+            except BaseException:
+                epub_writer.abort()
+                raise
         logger.info(f"Conversion completed successfully. EPUB saved at: {epub_path}")
 
     except Exception as e:
         logger.error(f"Error occurred during PDF to EPUB conversion: {e}")
         raise
 
+
 # Example usage
 # convert_pdf_to_epub('path/to/your/input.pdf', 'path/to/your/output.epub')
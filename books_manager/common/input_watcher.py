@@ -0,0 +1,141 @@
+import logging
+import os
+import time
+from dataclasses import dataclass
+
+from common.files_operations import is_image_file
+from settings import ARCHIVE_EXTENSIONS, WATCH_SETTLE_SECONDS
+
+logger = logging.getLogger('_books_manager_')
+
+
+@dataclass(frozen=True)
+class EntrySignature:
+    """What changes while an input is still being written: its size, number of files and last modification."""
+    is_folder: bool
+    files: int
+    size_bytes: int
+    mtime_ns: int
+    valid: bool
+
+
+@dataclass
+class _Candidate:
+    signature: EntrySignature
+    stable_since: float
+
+
+def folder_signature(folder_path: str) -> EntrySignature:
+    """
+    Signature of a folder from its files, read with a single `scandir`.
+
+    Replacing a file in place changes neither the size nor the modification time of the folder, so the latest
+    modification time of its files is used.
+    """
+    files = size_bytes = mtime_ns = 0
+    only_images = True
+    with os.scandir(folder_path) as children:
+        for child in children:
+            stat = child.stat()
+            files += 1
+            size_bytes += stat.st_size
+            mtime_ns = max(mtime_ns, stat.st_mtime_ns)
+            only_images = only_images and child.is_file() and is_image_file(child.name)
+    return EntrySignature(True, files, size_bytes, max(mtime_ns, os.stat(folder_path).st_mtime_ns),
+                          only_images and files > 0)
+
+
+def entry_signature(entry: os.DirEntry) -> EntrySignature | None:
+    """
+    Signature of an entry of the input folder.
+
+    PDF files, CBZ/ZIP archives and folders holding only images are valid inputs. Returns None when the entry
+    vanished meanwhile.
+    """
+    try:
+        if entry.is_file():
+            stat = entry.stat()
+            valid = entry.name.lower().endswith(('.pdf',) + ARCHIVE_EXTENSIONS)
+            return EntrySignature(False, 1, stat.st_size, stat.st_mtime_ns, valid)
+        if not entry.is_dir():
+            return None
+        return folder_signature(entry.path)
+    except FileNotFoundError:
+        return None
+
+
+class InputWatcher:
+    """
+    Incremental watcher of the input folder, polled with `scandir`.
+
+    An entry is reported once its signature has not changed for `settle_seconds`, so files still being copied and
+    folders still receiving images are not picked up half-written. Entries that were already unchanged for that
+    long when first seen (e.g. left by a previous run) are reported on the first poll.
+
+    Reported entries are not reported again while they are being processed, nor afterwards unless they change
+    (a failed input stays in the folder until it is replaced).
+    """
+
+    def __init__(self, folder_path: str, settle_seconds: float = WATCH_SETTLE_SECONDS):
+        self.folder_path = folder_path
+        self.settle_seconds = settle_seconds
+        self._candidates: dict[str, _Candidate] = {}
+        self._handled: dict[str, EntrySignature | None] = {}
+        self._in_flight: set[str] = set()
+
+    def poll(self) -> list[str]:
+        """Scan the input folder and return the paths of the inputs that became ready since the last poll."""
+        now = time.monotonic()
+        seen: set[str] = set()
+        ready: list[str] = []
+        try:
+            with os.scandir(self.folder_path) as entries:
+                for entry in entries:
+                    if entry.name.startswith('.'):
+                        continue
+                    path = entry.path
+                    seen.add(path)
+                    if path in self._in_flight:
+                        continue
+                    signature = entry_signature(entry)
+                    if signature is None:
+                        continue
+                    if path in self._handled:
+                        if self._handled[path] == signature:
+                            continue
+                        del self._handled[path]
+                    candidate = self._candidates.get(path)
+                    if candidate is None or candidate.signature != signature:
+                        # Time since the last modification counts as already stable
+                        age = max(0.0, time.time() - signature.mtime_ns / 1e9)
+                        candidate = self._candidates[path] = _Candidate(signature, now - age)
+                    if now - candidate.stable_since < self.settle_seconds:
+                        continue
+                    del self._candidates[path]
+                    self._handled[path] = signature
+                    if signature.valid:
+                        ready.append(path)
+                        self._in_flight.add(path)
+                    else:
+                        logger.info(f'Ignoring {path}: it is neither a PDF, an archive nor a folder of images.')
+        except FileNotFoundError:
+            logger.warning(f'Input folder does not exist: {self.folder_path}.')
+
+        # Forget entries that disappeared, typically inputs deleted once processed
+        for known in (self._candidates, self._handled):
+            for path in [path for path in known if path not in seen]:
+                del known[path]
+        return ready
+
+    def mark_done(self, path: str) -> None:
+        """Mark a reported input as processed. If it is still there (it failed), it waits until it changes."""
+        self._in_flight.discard(path)
+        try:
+            with os.scandir(self.folder_path) as entries:
+                entry = next((entry for entry in entries if entry.path == path), None)
+        except FileNotFoundError:
+            entry = None
+        if entry is None:
+            self._handled.pop(path, None)
+        else:
+            self._handled[path] = entry_signature(entry)
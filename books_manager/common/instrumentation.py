@@ -0,0 +1,290 @@
+"""
+Per-file and per-page timings, bytes and memory of a run, written as a JSON-lines event stream and a summary.
+
+Every processed image records the seconds spent in each stage (extraction, decode, analysis, split, resize,
+denoise, encode, write) and its encoded size in and out. Every file adds its stage totals, sizes and peak
+memory, and the run ends with a summary file that monitoring can scrape.
+
+When USE_INSTRUMENTATION is disabled, `stage` and `file_stage` return a shared no-op context manager and
+nothing is written, so the probes left in the hot paths cost a single attribute check.
+"""
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+
+from settings import USE_INSTRUMENTATION, INSTRUMENTATION_EVENTS_PATH, INSTRUMENTATION_SUMMARY_PATH
+
+logger = logging.getLogger('_books_manager_')
+
+# Stages reported for every image, in pipeline order
+PAGE_STAGES = ('extraction', 'decode', 'analysis', 'split', 'resize', 'denoise', 'encode', 'write')
+
+# Environment variable carrying the run identifier to the worker processes
+_RUN_ID_VARIABLE = 'INSTRUMENTATION_RUN_ID'
+
+_NO_OP = nullcontext()
+_local = threading.local()
+_events_lock = threading.Lock()
+
+
+def peak_rss_mb() -> float:
+    """
+    Peak resident set size of the current process, in MB (ru_maxrss is in KB on Linux, bytes on macOS).
+
+    The `resource` module is POSIX only. On Windows the peak working set is read through psutil when it is
+    installed, 0 is reported otherwise.
+    """
+    if sys.platform == 'win32':
+        try:
+            import psutil
+        except ImportError:
+            return 0.0
+        memory_info = psutil.Process().memory_info()
+        return getattr(memory_info, 'peak_wset', memory_info.rss) / (1024 * 1024)
+
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def current_rss_mb() -> float:
+    """Current resident set size of the process, in MB. Falls back to the peak where /proc is not available."""
+    try:
+        with open('/proc/self/statm', encoding='ascii') as statm:
+            resident_pages = int(statm.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, IndexError, AttributeError):
+        return peak_rss_mb()
+
+
+def run_id() -> str:
+    return os.environ.get(_RUN_ID_VARIABLE, '')
+
+
+def emit_event(event_type: str, events_path: str = INSTRUMENTATION_EVENTS_PATH, **fields) -> None:
+    """
+    Append one event to the JSON-lines stream.
+
+    Each event is written with a single call on a file opened in append mode, so the lines of concurrent
+    threads and worker processes do not interleave.
+    """
+    event = {'event': event_type, 'time': round(time.time(), 3), 'run_id': run_id(), 'pid': os.getpid(), **fields}
+    line = json.dumps(event, separators=(',', ':')) + '\n'
+    try:
+        with _events_lock:
+            with open(events_path, 'a', encoding='utf-8') as events_handler:
+                events_handler.write(line)
+    except OSError as e:
+        logger.error(f'Could not write instrumentation event to {events_path}: {e}')
+
+
+class _StageTimer:
+    """Adds the duration of a block to a stage of a timings dictionary."""
+    __slots__ = ('timings', 'name', 'start')
+
+    def __init__(self, timings: dict[str, float], name: str):
+        self.timings = timings
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self) -> '_StageTimer':
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> bool:
+        self.timings[self.name] = self.timings.get(self.name, 0.0) + time.perf_counter() - self.start
+        return False
+
+
+class FileInstrumentation:
+    """
+    Stage totals, sizes and memory of one input file.
+
+    Pages are recorded by the pipeline writer, while the pipeline threads fill the timings of their own items,
+    so the totals are guarded by a lock.
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.stage_seconds: dict[str, float] = {}
+        self.pages = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.peak_rss_mb = current_rss_mb()
+        self._lock = threading.Lock()
+
+    def add_stage_seconds(self, timings: dict[str, float]) -> None:
+        with self._lock:
+            for name, seconds in timings.items():
+                self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) + seconds
+
+    def record_page(self, *, sequence: int, page_num: int, img_index: int, label: str, timings: dict[str, float],
+                    bytes_in: int, bytes_out: int, segments: int, resumed: bool = False,
+                    error: str | None = None) -> None:
+        """Add the timings of a written image to the file totals and emit its page event."""
+        rss_mb = current_rss_mb()
+        self.add_stage_seconds(timings)
+        with self._lock:
+            self.pages += 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.peak_rss_mb = max(self.peak_rss_mb, rss_mb)
+        emit_event(
+            'page',
+            file=self.file_path,
+            sequence=sequence,
+            page=page_num,
+            image=img_index,
+            label=label,
+            seconds={name: round(seconds, 6) for name, seconds in timings.items()},
+            bytes_in=bytes_in,
+            bytes_out=bytes_out,
+            segments=segments,
+            resumed=resumed,
+            error=error,
+            rss_mb=round(rss_mb, 1),
+        )
+
+    def complete(self, result) -> None:
+        """Copy the totals to the `FileProcessingResult` of the file and emit its file event."""
+        self.peak_rss_mb = max(self.peak_rss_mb, current_rss_mb())
+        result.stage_seconds = {name: round(seconds, 4) for name, seconds in self.stage_seconds.items()}
+        # Processors count the pages themselves, books have no per-page records
+        result.pages = result.pages or self.pages
+        result.peak_memory_mb = round(self.peak_rss_mb, 1)
+        emit_event(
+            'file',
+            file=self.file_path,
+            name=result.name,
+            seconds=round(result.elapsed_seconds, 4),
+            stage_seconds=result.stage_seconds,
+            pages=result.pages,
+            bytes_in=result.original_size,
+            bytes_out=result.new_size,
+            page_bytes_in=self.bytes_in,
+            page_bytes_out=self.bytes_out,
+            peak_rss_mb=result.peak_memory_mb,
+            error=result.error,
+        )
+
+
+def current_file() -> FileInstrumentation | None:
+    """Instrumentation of the file processed by the calling thread, None when disabled."""
+    return getattr(_local, 'file', None)
+
+
+@contextmanager
+def file_scope(file_path: str, enabled: bool = USE_INSTRUMENTATION):
+    """
+    Make a new `FileInstrumentation` the current one of the calling thread for the duration of the block.
+
+    Yields None when instrumentation is disabled.
+    """
+    if not enabled:
+        yield None
+        return
+    file_instrumentation = FileInstrumentation(file_path)
+    previous = getattr(_local, 'file', None)
+    _local.file = file_instrumentation
+    try:
+        yield file_instrumentation
+    finally:
+        _local.file = previous
+
+
+@contextmanager
+def recording(timings: dict[str, float], enabled: bool = USE_INSTRUMENTATION):
+    """Record the `stage` blocks run by the calling thread into `timings` for the duration of the block."""
+    if not enabled:
+        yield
+        return
+    previous = getattr(_local, 'timings', None)
+    _local.timings = timings
+    try:
+        yield
+    finally:
+        _local.timings = previous
+
+
+def stage(name: str):
+    """Time a block as a stage of the image being recorded by the calling thread, if any."""
+    if not USE_INSTRUMENTATION:
+        return _NO_OP
+    timings = getattr(_local, 'timings', None)
+    if timings is None:
+        return _NO_OP
+    return _StageTimer(timings, name)
+
+
+def file_stage(name: str):
+    """Time a block as a stage of the whole file processed by the calling thread (e.g. classification)."""
+    if not USE_INSTRUMENTATION:
+        return _NO_OP
+    file_instrumentation = getattr(_local, 'file', None)
+    if file_instrumentation is None:
+        return _NO_OP
+    return _StageTimer(file_instrumentation.stage_seconds, name)
+
+
+def start_run(enabled: bool = USE_INSTRUMENTATION, events_path: str = INSTRUMENTATION_EVENTS_PATH) -> None:
+    """Give the run an identifier, inherited by the worker processes, and emit its start event."""
+    if not enabled:
+        return
+    os.environ[_RUN_ID_VARIABLE] = f'{datetime.now(timezone.utc):%Y%m%dT%H%M%SZ}-{os.getpid()}'
+    events_folder = os.path.dirname(events_path)
+    if events_folder:
+        os.makedirs(events_folder, exist_ok=True)
+    emit_event('run_start', events_path)
+
+
+def write_run_summary(results: list, elapsed_seconds: float, enabled: bool = USE_INSTRUMENTATION,
+                      summary_path: str = INSTRUMENTATION_SUMMARY_PATH) -> dict | None:
+    """
+    Aggregate the results of a run, write them atomically to `summary_path` and emit the run end event.
+
+    :param results: The `FileProcessingResult` of every processed file.
+    :param elapsed_seconds: Wall time of the run.
+    :return: The summary, or None when instrumentation is disabled.
+    """
+    if not enabled:
+        return None
+    stage_seconds: dict[str, float] = {}
+    for result in results:
+        for name, seconds in result.stage_seconds.items():
+            stage_seconds[name] = stage_seconds.get(name, 0.0) + seconds
+    pages = sum(result.pages for result in results)
+    slowest = sorted(results, key=lambda result: result.elapsed_seconds, reverse=True)[:5]
+    summary = {
+        'run_id': run_id(),
+        'finished_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'elapsed_seconds': round(elapsed_seconds, 3),
+        'files': len(results),
+        'files_failed': sum(1 for result in results if not result.succeeded),
+        'pages': pages,
+        'pages_per_second': round(pages / elapsed_seconds, 3) if elapsed_seconds > 0 else None,
+        'bytes_in': sum(result.original_size for result in results),
+        'bytes_out': sum(result.new_size for result in results),
+        'stage_seconds': {name: round(seconds, 4) for name, seconds in stage_seconds.items()},
+        'peak_rss_mb': round(max([peak_rss_mb()] + [result.peak_memory_mb for result in results]), 1),
+        'slowest_files': [
+            {'file': result.file_path, 'seconds': round(result.elapsed_seconds, 3)} for result in slowest
+        ],
+    }
+    emit_event('run_end', **summary)
+    try:
+        summary_folder = os.path.dirname(summary_path)
+        if summary_folder:
+            os.makedirs(summary_folder, exist_ok=True)
+        temporary_path = f'{summary_path}.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as summary_handler:
+            json.dump(summary, summary_handler, indent=2)
+        os.replace(temporary_path, summary_path)
+    except OSError as e:
+        logger.error(f'Could not write the run summary to {summary_path}: {e}')
+    return summary
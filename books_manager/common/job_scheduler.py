@@ -0,0 +1,213 @@
+import heapq
+import logging
+import math
+import os
+from dataclasses import dataclass, field
+from datetime import timedelta
+
+from settings import ARCHIVE_EXTENSIONS, IMAGE_EXTENSIONS, PAGE_WORKERS
+
+logger = logging.getLogger('_books_manager_')
+
+# Cost model, in seconds of one file worker: manga work grows with the decoded pixels, text pages are cheap
+SECONDS_PER_MEGAPIXEL = 0.6
+SECONDS_PER_TEXT_PAGE = 0.02
+SECONDS_PER_FILE = 0.2
+# Used when the dimensions of an image can not be read from its header
+BYTES_PER_MEGAPIXEL = 300_000
+
+
+@dataclass
+class JobEstimate:
+    """Estimated cost of processing an input, computed from its metadata without decoding any image."""
+    file_path: str
+    pages: int
+    megapixels: float
+    size_bytes: int
+    cost_seconds: float
+
+
+@dataclass
+class PlannedJob:
+    """A job placed on a worker by the schedule, with its expected start and finish times since the run start."""
+    estimate: JobEstimate
+    worker: int
+    start_seconds: float
+    finish_seconds: float
+
+
+@dataclass
+class SchedulePlan:
+    """Order of submission of the inputs, number of workers and expected timeline of a run."""
+    workers: int
+    jobs: list[PlannedJob] = field(default_factory=list)
+
+    @property
+    def file_paths(self) -> list[str]:
+        """Inputs in submission order, largest first."""
+        return [job.estimate.file_path for job in self.jobs]
+
+    @property
+    def makespan_seconds(self) -> float:
+        return max((job.finish_seconds for job in self.jobs), default=0.0)
+
+    def format(self) -> str:
+        """Human readable table of the plan, printed by the `--plan` dry run."""
+        lines = [
+            f'Plan: {len(self.jobs)} files on {self.workers} workers, '
+            f'estimated makespan {timedelta(seconds=round(self.makespan_seconds))}',
+            f'{"cost (s)":>9} {"start":>9} {"ETA":>9} {"pages":>6} {"MP":>8} {"MB":>8}  file',
+        ]
+        for job in self.jobs:
+            estimate = job.estimate
+            lines.append(
+                f'{estimate.cost_seconds:9.1f} {timedelta(seconds=round(job.start_seconds))!s:>9} '
+                f'{timedelta(seconds=round(job.finish_seconds))!s:>9} {estimate.pages:6d} '
+                f'{estimate.megapixels:8.1f} {estimate.size_bytes / (1024 * 1024):8.1f}  '
+                f'{os.path.basename(estimate.file_path)}'
+            )
+        return '\n'.join(lines)
+
+
+def _cost_seconds(pages: int, text_pages: int, megapixels: float) -> float:
+    return SECONDS_PER_FILE + megapixels * SECONDS_PER_MEGAPIXEL + text_pages * SECONDS_PER_TEXT_PAGE
+
+
+def estimate_pdf_cost(pdf_path: str) -> JobEstimate:
+    """
+    Estimate the cost of a PDF from its page count and the dimensions of its images, read from the image
+    dictionaries of each page. Pages without images are counted as text pages.
+    """
+    from common.pymupdf_access import PYMUPDF_LOCK, open_pdf_document
+
+    size_bytes = os.path.getsize(pdf_path)
+    try:
+        with open_pdf_document(pdf_path) as doc, PYMUPDF_LOCK:
+            pages = doc.page_count
+            text_pages = 0
+            pixels = 0
+            for page in doc:
+                images = page.get_images(full=True)
+                if not images:
+                    text_pages += 1
+                pixels += sum(image[2] * image[3] for image in images)
+    except Exception as e:
+        logger.error(f'Could not read {pdf_path} to estimate its cost, using its size: {e}')
+        megapixels = size_bytes / BYTES_PER_MEGAPIXEL
+        return JobEstimate(pdf_path, 0, megapixels, size_bytes, _cost_seconds(0, 0, megapixels))
+    megapixels = pixels / 1_000_000
+    return JobEstimate(pdf_path, pages, megapixels, size_bytes, _cost_seconds(pages, text_pages, megapixels))
+
+
+def estimate_folder_cost(folder_path: str) -> JobEstimate:
+    """Estimate the cost of a folder of images from the dimensions in their headers, or from their size."""
+    from PIL import Image
+
+    pages = 0
+    pixels = 0
+    size_bytes = 0
+    with os.scandir(folder_path) as entries:
+        for entry in entries:
+            if not entry.is_file() or not entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            pages += 1
+            image_bytes = entry.stat().st_size
+            size_bytes += image_bytes
+            try:
+                # Opening an image only parses its header, the pixels are not decoded
+                with Image.open(entry.path) as image:
+                    pixels += image.width * image.height
+            except Exception as e:
+                logger.error(f'Could not read the header of {entry.path}, estimating it from its size: {e}')
+                pixels += image_bytes * 1_000_000 // BYTES_PER_MEGAPIXEL
+    megapixels = pixels / 1_000_000
+    return JobEstimate(folder_path, pages, megapixels, size_bytes, _cost_seconds(pages, 0, megapixels))
+
+
+def estimate_archive_cost(archive_path: str) -> JobEstimate:
+    """Estimate the cost of a CBZ/ZIP archive from the headers of its images, read without inflating them whole."""
+    import zipfile
+
+    from PIL import Image
+
+    from manga_manager.manga_archive_operations import archive_image_members
+
+    size_bytes = os.path.getsize(archive_path)
+    pixels = 0
+    try:
+        with zipfile.ZipFile(archive_path) as archive:
+            members = archive_image_members(archive)
+            for member in members:
+                try:
+                    # Only the first blocks of the member are inflated to parse the header
+                    with archive.open(member) as member_file, Image.open(member_file) as image:
+                        pixels += image.width * image.height
+                except Exception as e:
+                    logger.error(f'Could not read the header of {member.filename}, estimating it from its size: {e}')
+                    pixels += member.file_size * 1_000_000 // BYTES_PER_MEGAPIXEL
+    except Exception as e:
+        logger.error(f'Could not read {archive_path} to estimate its cost, using its size: {e}')
+        megapixels = size_bytes / BYTES_PER_MEGAPIXEL
+        return JobEstimate(archive_path, 0, megapixels, size_bytes, _cost_seconds(0, 0, megapixels))
+    megapixels = pixels / 1_000_000
+    return JobEstimate(archive_path, len(members), megapixels, size_bytes, _cost_seconds(len(members), 0, megapixels))
+
+
+def estimate_cost(file_path: str) -> JobEstimate:
+    if os.path.isdir(file_path):
+        return estimate_folder_cost(file_path)
+    if file_path.lower().endswith(ARCHIVE_EXTENSIONS):
+        return estimate_archive_cost(file_path)
+    return estimate_pdf_cost(file_path)
+
+
+def available_cores() -> int:
+    """Cores this process may run on, which can be fewer than the machine has (containers, affinity)."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def choose_worker_count(estimates: list[JobEstimate], cores: int | None = None,
+                        page_workers: int = PAGE_WORKERS) -> int:
+    """
+    Number of file workers worth running for a set of jobs.
+
+    Each file already keeps `page_workers` threads busy, so the cores are shared between files in groups of
+    that size. Workers beyond total cost / largest cost can not shorten the run, the largest job bounds it.
+    """
+    if not estimates:
+        return 1
+    cores = available_cores() if cores is None else cores
+    workers = max(1, cores // max(1, page_workers))
+    largest_cost = max(estimate.cost_seconds for estimate in estimates)
+    total_cost = sum(estimate.cost_seconds for estimate in estimates)
+    useful_workers = math.ceil(total_cost / largest_cost) if largest_cost > 0 else len(estimates)
+    return max(1, min(workers, len(estimates), useful_workers))
+
+
+def plan_schedule(file_paths: list[str], workers: int | None = None) -> SchedulePlan:
+    """
+    Estimate every input and order them largest first (LPT), so a giant volume never starts last and the cheap
+    books fill the gaps at the end of the run.
+
+    The timeline assigns each job, in that order, to the worker that becomes free first, which is what the
+    executor does with the submitted jobs.
+
+    :param file_paths: Inputs to process (PDF files or folders of images).
+    :param workers: Number of file workers, chosen from the estimates and the available cores if None.
+    """
+    estimates = sorted((estimate_cost(file_path) for file_path in file_paths),
+                       key=lambda estimate: estimate.cost_seconds, reverse=True)
+    workers = choose_worker_count(estimates) if workers is None else max(1, workers)
+    plan = SchedulePlan(workers)
+    free_at = [(0.0, worker) for worker in range(workers)]
+    for estimate in estimates:
+        start_seconds, worker = heapq.heappop(free_at)
+        finish_seconds = start_seconds + estimate.cost_seconds
+        plan.jobs.append(PlannedJob(estimate, worker, start_seconds, finish_seconds))
+        heapq.heappush(free_at, (finish_seconds, worker))
+    logger.info(f'Scheduled {len(plan.jobs)} files on {workers} workers, '
+                f'estimated makespan {plan.makespan_seconds:.1f}s.')
+    return plan
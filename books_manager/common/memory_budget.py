@@ -0,0 +1,140 @@
+import logging
+import threading
+import time
+
+from settings import MAX_MEMORY_MB
+
+logger = logging.getLogger('_books_manager_')
+
+_budget = None
+_budget_lock = threading.Lock()
+
+
+class _LocalCounter:
+    """Counter with the `value` attribute of a `multiprocessing.Value`, for budgets shared by threads only."""
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+
+class MemoryBudget:
+    """
+    Caps the estimated bytes of decoded images held at once by every document being processed.
+
+    Work is admitted by reserving its estimated decoded size, and waits while it does not fit in what the other
+    reservations leave. A reservation larger than the whole budget is admitted alone, once nothing else is
+    reserved, so it can not wait forever.
+
+    The condition and counter can be `multiprocessing` ones, so worker processes share a single budget.
+    """
+
+    def __init__(self, capacity_bytes: int, condition=None, used=None):
+        self.capacity_bytes = capacity_bytes
+        self._condition = condition if condition is not None else threading.Condition()
+        self._used = used if used is not None else _LocalCounter()
+
+    @property
+    def used_bytes(self) -> int:
+        return self._used.value
+
+    def _fits(self, nbytes: int) -> bool:
+        used = self._used.value
+        return used == 0 or used + nbytes <= self.capacity_bytes
+
+    def acquire(self, nbytes: int, should_stop=None, poll_seconds: float = 0.1, block: bool = True) -> bool:
+        """
+        Reserve `nbytes`, waiting while they do not fit in the budget.
+
+        :param nbytes: Estimated bytes of the work to admit.
+        :param should_stop: Optional callable checked while waiting, the wait is abandoned when it returns True.
+        :param poll_seconds: Interval at which `should_stop` is checked.
+        :param block: If False, the bytes are accounted at once even if they exceed the budget. Used for memory
+                      that is already committed, so that it throttles the next admissions without waiting itself.
+        :return: True if the bytes were reserved, False if the wait was abandoned.
+        """
+        with self._condition:
+            while block and not self._fits(nbytes):
+                if should_stop is not None and should_stop():
+                    return False
+                self._condition.wait(poll_seconds)
+            self._used.value += nbytes
+            return True
+
+    def release(self, nbytes: int) -> None:
+        if nbytes <= 0:
+            return
+        with self._condition:
+            self._used.value = max(0, self._used.value - nbytes)
+            self._condition.notify_all()
+
+
+class BudgetLease:
+    """
+    Reservations made for a single document.
+
+    Whatever the document still holds when it finishes, including reservations of items dropped by a failure,
+    is given back by `close`.
+    """
+
+    def __init__(self, budget: MemoryBudget | None):
+        self.budget = budget
+        self.held_bytes = 0
+        self.waited_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, nbytes: int, should_stop=None, block: bool = True) -> bool:
+        if self.budget is None:
+            return True
+        start = time.perf_counter()
+        acquired = self.budget.acquire(nbytes, should_stop, block=block)
+        with self._lock:
+            self.waited_seconds += time.perf_counter() - start
+            if acquired:
+                self.held_bytes += nbytes
+        return acquired
+
+    def release(self, nbytes: int) -> None:
+        if self.budget is None or nbytes <= 0:
+            return
+        with self._lock:
+            nbytes = min(nbytes, self.held_bytes)
+            self.held_bytes -= nbytes
+        self.budget.release(nbytes)
+
+    def close(self) -> None:
+        self.release(self.held_bytes)
+
+
+def create_shared_budget_state(max_memory_mb: int = MAX_MEMORY_MB) -> tuple | None:
+    """
+    Create the condition and counter of a budget shared by worker processes, None if the budget is disabled.
+
+    They must be handed to the workers when the pool starts, as arguments of `install_shared_budget`.
+    """
+    if max_memory_mb <= 0:
+        return None
+    import multiprocessing
+
+    return multiprocessing.Condition(), multiprocessing.Value('q', 0, lock=False)
+
+
+def install_shared_budget(state: tuple | None, max_memory_mb: int = MAX_MEMORY_MB) -> None:
+    """Make the budget of the current process use the shared condition and counter created by the main process."""
+    global _budget
+    if state is None or max_memory_mb <= 0:
+        return
+    condition, used = state
+    with _budget_lock:
+        _budget = MemoryBudget(max_memory_mb * 1024 * 1024, condition, used)
+
+
+def get_memory_budget(max_memory_mb: int = MAX_MEMORY_MB) -> MemoryBudget | None:
+    """The budget shared by every document of the process, None when MAX_MEMORY_MB is 0."""
+    global _budget
+    if max_memory_mb <= 0:
+        return None
+    with _budget_lock:
+        if _budget is None:
+            _budget = MemoryBudget(max_memory_mb * 1024 * 1024)
+        return _budget
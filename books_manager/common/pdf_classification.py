@@ -0,0 +1,220 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass, asdict
+
+import fitz  # PyMuPDF
+
+from common.pymupdf_access import PYMUPDF_LOCK, open_pdf_document
+from settings import (
+    TEXT_THRESHOLD,
+    CLASSIFICATION_SAMPLE_PAGES,
+    CLASSIFICATION_CACHE_PATH,
+    CLASSIFICATION_CACHE_MAX_ENTRIES
+)
+
+logger = logging.getLogger('_books_manager_')
+
+BOOK = 'book'
+MANGA = 'manga'
+
+# Part of the cache keys, increase it when the classification heuristics change so cached verdicts are dropped
+CLASSIFIER_VERSION = 1
+
+# Bytes read from the start and the end of a file to fingerprint it
+_FINGERPRINT_CHUNK_SIZE = 64 * 1024
+
+# Fraction of the page covered by images above which a page without text is considered an image page
+_IMAGE_PAGE_COVERAGE = 0.5
+
+
+@dataclass(frozen=True)
+class PdfClassification:
+    """Verdict on the kind of document a PDF holds."""
+    document_type: str
+    confidence: float
+
+    @property
+    def is_book(self) -> bool:
+        return self.document_type == BOOK
+
+
+def sample_page_numbers(page_count: int, sample_pages: int = CLASSIFICATION_SAMPLE_PAGES) -> list[int]:
+    """Pick up to `sample_pages` page numbers spread evenly over the document."""
+    if page_count <= sample_pages:
+        return list(range(page_count))
+    step = page_count / sample_pages
+    return sorted({int(i * step) for i in range(sample_pages)})
+
+
+def classify_page(page: fitz.Page, text_threshold: int = TEXT_THRESHOLD) -> str | None:
+    """
+    Classify a page as a text page (BOOK), an image page (MANGA) or None for an empty page.
+
+    Cheap signals read from the page resources are checked first: a page with images and no fonts is an image
+    page, a page with fonts and no images is a text page. Only pages having both are laid out to measure the
+    area covered by images and, if still undecided, to count their characters.
+    """
+    has_fonts = bool(page.get_fonts())
+    has_images = bool(page.get_images())
+
+    if not has_fonts and not has_images:
+        return None
+    if has_images and not has_fonts:
+        return MANGA
+    if has_fonts and not has_images:
+        return BOOK
+
+    page_area = abs(page.rect) or 1
+    image_area = sum(abs(fitz.Rect(image_info['bbox']) & page.rect) for image_info in page.get_image_info())
+    if image_area / page_area < _IMAGE_PAGE_COVERAGE:
+        return BOOK
+
+    # Full page images with a text layer: scanned books carry OCR text, manga only a few words
+    return BOOK if len(page.get_text("text").strip()) >= text_threshold else MANGA
+
+
+def classify_document(
+        doc: fitz.Document,
+        sample_pages: int = CLASSIFICATION_SAMPLE_PAGES,
+        text_threshold: int = TEXT_THRESHOLD
+) -> PdfClassification:
+    """
+    Classify an open PDF from a sample of its pages.
+
+    The confidence is the share of non-empty sampled pages that agree with the verdict.
+    """
+    votes = {BOOK: 0, MANGA: 0}
+    with PYMUPDF_LOCK:
+        for page_num in sample_page_numbers(doc.page_count, sample_pages):
+            page_type = classify_page(doc.load_page(page_num), text_threshold)
+            if page_type is not None:
+                votes[page_type] += 1
+
+    voted_pages = votes[BOOK] + votes[MANGA]
+    if voted_pages == 0:
+        return PdfClassification(MANGA, 0.0)
+    document_type = BOOK if votes[BOOK] >= votes[MANGA] else MANGA
+    return PdfClassification(document_type, round(votes[document_type] / voted_pages, 3))
+
+
+def file_fingerprint(file_path: str) -> str:
+    """Identify a file by its size, modification time and a hash of its first and last bytes."""
+    file_stat = os.stat(file_path)
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as file_handler:
+        digest.update(file_handler.read(_FINGERPRINT_CHUNK_SIZE))
+        if file_stat.st_size > _FINGERPRINT_CHUNK_SIZE:
+            file_handler.seek(max(_FINGERPRINT_CHUNK_SIZE, file_stat.st_size - _FINGERPRINT_CHUNK_SIZE))
+            digest.update(file_handler.read(_FINGERPRINT_CHUNK_SIZE))
+    return f'{file_stat.st_size}:{file_stat.st_mtime_ns}:{digest.hexdigest()}'
+
+
+def classification_key(fingerprint: str, sample_pages: int = CLASSIFICATION_SAMPLE_PAGES,
+                       text_threshold: int = TEXT_THRESHOLD) -> str:
+    """Cache key of a file: its fingerprint and everything that changes the verdict on it."""
+    return f'{fingerprint}|{sample_pages}|{text_threshold}|v{CLASSIFIER_VERSION}'
+
+
+class ClassificationCache:
+    """
+    JSON file mapping classification keys to their classification.
+
+    Only the `max_entries` most recently stored verdicts are kept, the inputs are deleted once processed so older
+    ones are rarely needed again. Saving merges the entries stored meanwhile by other processes before atomically
+    replacing the file, the file is only read again when another process changed it.
+    """
+
+    def __init__(self, cache_path: str = CLASSIFICATION_CACHE_PATH,
+                 max_entries: int = CLASSIFICATION_CACHE_MAX_ENTRIES):
+        self.cache_path = os.path.abspath(cache_path)
+        self.max_entries = max_entries
+        self._entries: dict[str, dict] | None = None
+        # Identity of the file when it was last read or written by this process
+        self._file_state: tuple[int, int, int] | None = None
+        self._lock = threading.Lock()
+
+    def _current_file_state(self) -> tuple[int, int, int] | None:
+        try:
+            file_stat = os.stat(self.cache_path)
+        except FileNotFoundError:
+            return None
+        # Every save replaces the file, so a new inode tells a change even within the timestamp resolution
+        return file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns
+
+    def _load(self) -> dict[str, dict]:
+        """Entries of the file, read again only if it changed since this process last read or wrote it."""
+        file_state = self._current_file_state()
+        if self._entries is not None and file_state == self._file_state:
+            return self._entries
+        try:
+            with open(self.cache_path, encoding='utf-8') as cache_handler:
+                self._entries = json.load(cache_handler)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self._entries = {}
+        self._file_state = file_state
+        return self._entries
+
+    def get(self, key: str) -> PdfClassification | None:
+        with self._lock:
+            entry = self._load().get(key)
+        if entry is None:
+            return None
+        return PdfClassification(entry['document_type'], entry['confidence'])
+
+    def put(self, key: str, classification: PdfClassification) -> None:
+        with self._lock:
+            entries = self._load()
+            entries[key] = {**asdict(classification), 'stored_at': time.time()}
+            if len(entries) > self.max_entries:
+                # Entries of older versions have no storage time, they go first
+                kept_keys = sorted(entries, key=lambda entry_key: entries[entry_key].get('stored_at', 0.0))
+                for evicted_key in kept_keys[:len(entries) - self.max_entries]:
+                    del entries[evicted_key]
+            try:
+                os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+                temporary_cache_path = f'{self.cache_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+                with open(temporary_cache_path, 'w', encoding='utf-8') as cache_handler:
+                    json.dump(entries, cache_handler)
+                os.replace(temporary_cache_path, self.cache_path)
+                self._file_state = self._current_file_state()
+            except OSError as e:
+                logger.error(f"Error saving classification cache {self.cache_path}: {e}")
+
+
+_classification_cache = ClassificationCache()
+
+
+def classify_pdf(
+        pdf_path: str,
+        sample_pages: int = CLASSIFICATION_SAMPLE_PAGES,
+        text_threshold: int = TEXT_THRESHOLD,
+        cache: ClassificationCache | None = _classification_cache,
+        doc: fitz.Document | None = None
+) -> PdfClassification:
+    """
+    Classify a PDF as a book or a manga, reusing the cached verdict if the file did not change.
+
+    :param pdf_path: Path to the PDF file.
+    :param sample_pages: Maximum number of pages inspected.
+    :param text_threshold: Minimum amount of characters for an ambiguous page to count as a text page.
+    :param cache: Cache of verdicts, or None to always inspect the file.
+    :param doc: The PDF already opened, inspected on a cache miss instead of opening the file again.
+    """
+    key = classification_key(file_fingerprint(pdf_path), sample_pages, text_threshold)
+    if cache is not None:
+        classification = cache.get(key)
+        if classification is not None:
+            logger.info(f"Using cached classification for {pdf_path}: {classification}")
+            return classification
+
+    with open_pdf_document(pdf_path, doc) as doc:
+        classification = classify_document(doc, sample_pages, text_threshold)
+    logger.info(f"Classified {pdf_path}: {classification}")
+
+    if cache is not None:
+        cache.put(key, classification)
+    return classification
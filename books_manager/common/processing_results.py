@@ -0,0 +1,33 @@
+from dataclasses import dataclass, field
+
+
+@dataclass
+class FileProcessingResult:
+    """
+    Outcome of processing a single input file (PDF or folder of images).
+
+    Instances are returned by the processors instead of mutating shared state, so they can travel back
+    from worker processes to the main process.
+    """
+    file_path: str
+    name: str
+    # 'manga' or 'book', empty when the file failed before being classified
+    kind: str = ''
+    original_size: int = 0
+    new_size: int = 0
+    # Source pages (or images) read and pages written
+    pages: int = 0
+    output_pages: int = 0
+    elapsed_seconds: float = 0.0
+    error: str | None = None
+    # Filled when instrumentation is enabled
+    stage_seconds: dict[str, float] = field(default_factory=dict)
+    peak_memory_mb: float = 0.0
+
+    @property
+    def pages_per_second(self) -> float:
+        return self.pages / self.elapsed_seconds if self.elapsed_seconds > 0 else 0.0
+
+    @property
+    def succeeded(self) -> bool:
+        return self.error is None
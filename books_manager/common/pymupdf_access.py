@@ -0,0 +1,31 @@
+import threading
+from contextlib import contextmanager
+
+# PyMuPDF is not thread-safe, not even across documents. With EXECUTION_MODE=thread, files are processed in
+# concurrent threads and every manga pipeline extracts and writes in threads of its own, so every PyMuPDF call
+# holds this lock. It is reentrant, so a function holding it can call another one that takes it. Long tasks
+# (cropping a book, extracting a manga) take it per page or per image, so the other documents keep progressing.
+PYMUPDF_LOCK = threading.RLock()
+
+
+@contextmanager
+def open_pdf_document(pdf_path: str, doc=None):
+    """
+    Open a PDF while holding `PYMUPDF_LOCK`, and close it the same way on exit.
+
+    :param pdf_path: Path of the PDF to open.
+    :param doc: The PDF already opened. It is used as-is and left open.
+    """
+    if doc is not None:
+        yield doc
+        return
+
+    import fitz  # PyMuPDF
+
+    with PYMUPDF_LOCK:
+        doc = fitz.open(pdf_path)
+    try:
+        yield doc
+    finally:
+        with PYMUPDF_LOCK:
+            doc.close()
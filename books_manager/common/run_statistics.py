@@ -0,0 +1,246 @@
+import logging
+import os
+import statistics
+import threading
+import time
+from dataclasses import dataclass, field
+
+from common.files_operations import convert_bytes
+from common.processing_results import FileProcessingResult
+from settings import (
+    USE_RUN_STATISTICS,
+    RUN_STATISTICS_PATH,
+    RUN_STATISTICS_HISTORY_FILES,
+    RUN_STATISTICS_REGRESSION_TOLERANCE
+)
+
+logger = logging.getLogger('_books_manager_')
+
+# Throughput of series processed faster than this is mostly timer noise, it is not compared
+MIN_COMPARED_SECONDS = 1.0
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started_at REAL NOT NULL,
+    finished_at REAL,
+    elapsed_seconds REAL,
+    pid INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    recorded_at REAL NOT NULL,
+    series TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    input_bytes INTEGER NOT NULL,
+    output_bytes INTEGER NOT NULL,
+    input_pages INTEGER NOT NULL,
+    output_pages INTEGER NOT NULL,
+    elapsed_seconds REAL NOT NULL,
+    pages_per_second REAL NOT NULL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS files_run ON files (run_id);
+CREATE INDEX IF NOT EXISTS files_series ON files (series, recorded_at);
+'''
+
+
+@dataclass
+class SeriesStatistics:
+    """
+    Totals of the files of a series processed in a run, and the medians of its earlier files to compare them with.
+
+    Failed files are only listed, they are not part of the totals.
+    """
+    name: str
+    files: int = 0
+    failed_files: list[str] = field(default_factory=list)
+    input_bytes: int = 0
+    output_bytes: int = 0
+    pages: int = 0
+    elapsed_seconds: float = 0.0
+    baseline_compression_ratio: float | None = None
+    baseline_pages_per_second: float | None = None
+
+    @property
+    def compression_ratio(self) -> float:
+        """Output bytes per input byte, lower is better."""
+        return self.output_bytes / self.input_bytes if self.input_bytes else 1.0
+
+    @property
+    def pages_per_second(self) -> float:
+        return self.pages / self.elapsed_seconds if self.elapsed_seconds > 0 else 0.0
+
+    def regressions(self, tolerance: float = RUN_STATISTICS_REGRESSION_TOLERANCE) -> list[str]:
+        """Measures worse than the earlier files of the series by more than `tolerance`."""
+        regressions = []
+        if self.baseline_compression_ratio and self.input_bytes and \
+                self.compression_ratio > self.baseline_compression_ratio * (1 + tolerance):
+            regressions.append(f'compression ratio {self.compression_ratio:.2f} vs '
+                               f'{self.baseline_compression_ratio:.2f} before')
+        if self.baseline_pages_per_second and self.pages and self.elapsed_seconds >= MIN_COMPARED_SECONDS and \
+                self.pages_per_second < self.baseline_pages_per_second * (1 - tolerance):
+            regressions.append(f'throughput {self.pages_per_second:.2f} vs '
+                               f'{self.baseline_pages_per_second:.2f} pages/s before')
+        return regressions
+
+
+def summarize_series(results: list[FileProcessingResult]) -> list[SeriesStatistics]:
+    """Totals per series of the files processed successfully, and their failed files, sorted by series name."""
+    series: dict[str, SeriesStatistics] = {}
+    for result in results:
+        totals = series.setdefault(result.name, SeriesStatistics(result.name))
+        if not result.succeeded:
+            totals.failed_files.append(os.path.basename(os.path.normpath(result.file_path)))
+            continue
+        totals.files += 1
+        totals.input_bytes += result.original_size
+        totals.output_bytes += result.new_size
+        totals.pages += result.pages
+        totals.elapsed_seconds += result.elapsed_seconds
+    return [series[name] for name in sorted(series)]
+
+
+def format_series_report(series_statistics: list[SeriesStatistics],
+                         tolerance: float = RUN_STATISTICS_REGRESSION_TOLERANCE) -> str:
+    """Human readable size change, throughput and regressions of every series."""
+    lines = []
+    for totals in series_statistics:
+        if not totals.files:
+            lines.append(f"{totals.name}: {len(totals.failed_files)} failed ({', '.join(totals.failed_files)}).")
+            continue
+        original_size_human = convert_bytes(totals.input_bytes)
+        new_size_human = convert_bytes(totals.output_bytes)
+        size_difference = totals.input_bytes - totals.output_bytes
+        percentage_change = (size_difference / totals.input_bytes) * 100 if totals.input_bytes else 0.0
+
+        if size_difference > 0:
+            line = (f"{totals.name}: Reduced from {original_size_human} to {new_size_human} "
+                    f"({abs(size_difference)} bytes smaller, {percentage_change:.2f}% smaller).")
+        elif size_difference < 0:
+            line = (f"{totals.name}: Increased from {original_size_human} to {new_size_human} "
+                    f"({abs(size_difference)} bytes larger, {abs(percentage_change):.2f}% larger).")
+        else:
+            line = f"{totals.name}: No change in size, remains {original_size_human}."
+        line += f" {totals.pages} pages in {totals.elapsed_seconds:.1f}s ({totals.pages_per_second:.2f} pages/s)."
+        regressions = totals.regressions(tolerance)
+        if regressions:
+            line += f" REGRESSION: {'; '.join(regressions)}."
+        if totals.failed_files:
+            line += f" {len(totals.failed_files)} failed ({', '.join(totals.failed_files)})."
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+class RunStatistics:
+    """
+    Persistent history of the processed files, in a SQLite database in WAL mode.
+
+    Every file is recorded in its own short transaction as soon as it completes, so an interrupted run keeps
+    what it did, and concurrent runs (a watch session and a manual run) can write to the same database.
+    """
+
+    def __init__(self, db_path: str = RUN_STATISTICS_PATH):
+        import sqlite3
+
+        self.db_path = os.path.abspath(db_path)
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        self._connection = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript(_SCHEMA)
+
+    def begin_run(self) -> int:
+        """Record the start of a run and return its id."""
+        with self._lock, self._connection:
+            cursor = self._connection.execute('INSERT INTO runs (started_at, pid) VALUES (?, ?)',
+                                              (time.time(), os.getpid()))
+            return cursor.lastrowid
+
+    def finish_run(self, run_id: int, elapsed_seconds: float) -> None:
+        with self._lock, self._connection:
+            self._connection.execute('UPDATE runs SET finished_at = ?, elapsed_seconds = ? WHERE id = ?',
+                                     (time.time(), elapsed_seconds, run_id))
+
+    def record_file(self, run_id: int, result: FileProcessingResult) -> None:
+        """Record the outcome of a file, failed ones included."""
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT INTO files (run_id, recorded_at, series, kind, file_name, input_bytes, output_bytes, '
+                'input_pages, output_pages, elapsed_seconds, pages_per_second, error) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (run_id, time.time(), result.name, result.kind, os.path.basename(result.file_path),
+                 result.original_size, result.new_size, result.pages, result.output_pages,
+                 result.elapsed_seconds, result.pages_per_second, result.error)
+            )
+
+    def add_baselines(self, series_statistics: list[SeriesStatistics], run_id: int,
+                      history_files: int = RUN_STATISTICS_HISTORY_FILES) -> None:
+        """Fill the baselines of each series with the medians of its latest successful files of earlier runs."""
+        with self._lock:
+            for totals in series_statistics:
+                rows = self._connection.execute(
+                    'SELECT input_bytes, output_bytes, pages_per_second FROM files '
+                    'WHERE series = ? AND run_id < ? AND error IS NULL AND input_bytes > 0 '
+                    'ORDER BY recorded_at DESC LIMIT ?',
+                    (totals.name, run_id, history_files)
+                ).fetchall()
+                if not rows:
+                    continue
+                totals.baseline_compression_ratio = statistics.median(
+                    output_bytes / input_bytes for input_bytes, output_bytes, _ in rows
+                )
+                throughputs = [pages_per_second for _, _, pages_per_second in rows if pages_per_second > 0]
+                if throughputs:
+                    totals.baseline_pages_per_second = statistics.median(throughputs)
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+class StatisticsRun:
+    """
+    The statistics of the current run: records the files as they complete and reports per series at the end.
+
+    Storage errors are logged and never fail the run, the report then only covers the current run.
+    """
+
+    def __init__(self, enabled: bool = USE_RUN_STATISTICS, db_path: str = RUN_STATISTICS_PATH):
+        self.results: list[FileProcessingResult] = []
+        self.store: RunStatistics | None = None
+        self.run_id: int | None = None
+        self._start = time.perf_counter()
+        if not enabled:
+            return
+        try:
+            self.store = RunStatistics(db_path)
+            self.run_id = self.store.begin_run()
+        except Exception as e:
+            logger.error(f'Could not open the run statistics at {db_path}: {e}')
+            self.store = None
+
+    def record(self, result: FileProcessingResult) -> None:
+        self.results.append(result)
+        if self.store is None:
+            return
+        try:
+            self.store.record_file(self.run_id, result)
+        except Exception as e:
+            logger.error(f'Could not record the statistics of {result.file_path}: {e}')
+
+    def finish(self) -> str:
+        """Close the run and return the report of its series, compared with their earlier files."""
+        series_statistics = summarize_series(self.results)
+        if self.store is not None:
+            try:
+                self.store.finish_run(self.run_id, time.perf_counter() - self._start)
+                self.store.add_baselines(series_statistics, self.run_id)
+            except Exception as e:
+                logger.error(f'Could not read the run statistics history: {e}')
+            finally:
+                self.store.close()
+        return format_series_report(series_statistics)
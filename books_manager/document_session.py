@@ -0,0 +1,69 @@
+import logging
+
+import fitz  # PyMuPDF
+
+from common import instrumentation
+from common.files_operations import is_pdf_file
+from common.pdf_classification import PdfClassification, classify_pdf, MANGA
+from common.pymupdf_access import PYMUPDF_LOCK
+from common.processing_results import FileProcessingResult
+
+logger = logging.getLogger('_books_manager_')
+
+
+class DocumentSession:
+    """
+    Holds an input (PDF file or folder of images) opened once for its whole processing.
+
+    A PDF is parsed a single time and the same document is used to classify it, to process it as a book or a
+    manga and to export the EPUB, instead of each step opening the file again.
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self._doc: fitz.Document | None = None
+
+    def __enter__(self) -> 'DocumentSession':
+        return self
+
+    def __exit__(self, *exc_info) -> bool:
+        self.close()
+        return False
+
+    @property
+    def is_pdf(self) -> bool:
+        return is_pdf_file(self.file_path)
+
+    @property
+    def doc(self) -> fitz.Document | None:
+        """The parsed PDF, opened on first use. None for folders of images."""
+        if self._doc is None and self.is_pdf:
+            with PYMUPDF_LOCK:
+                self._doc = fitz.open(self.file_path)
+        return self._doc
+
+    def classify(self) -> PdfClassification:
+        """Classify the input; folders of images are always mangas."""
+        if not self.is_pdf:
+            return PdfClassification(MANGA, 1.0)
+        # The cached verdict is looked up by file identity, the open document is only inspected on a cache miss
+        with instrumentation.file_stage('classification'):
+            return classify_pdf(self.file_path, doc=self.doc)
+
+    def process(self, destiny_folder_path: str) -> FileProcessingResult:
+        """Classify the input and hand the open document to the matching processor."""
+        classification = self.classify()
+        logger.info(f'Processing {self.file_path} as {classification.document_type} '
+                    f'(confidence {classification.confidence:.2f}).')
+        # Processors are imported on first use, a run of text books never loads the image libraries
+        if classification.is_book:
+            from book_manager.book_manager import process_book
+            return process_book(self.file_path, destiny_folder_path, doc=self.doc)
+        from manga_manager.manga_processor import process_manga
+        return process_manga(self.file_path, destiny_folder_path, doc=self.doc)
+
+    def close(self) -> None:
+        with PYMUPDF_LOCK:
+            if self._doc is not None and not self._doc.is_closed:
+                self._doc.close()
+        self._doc = None
@@ -1,110 +1,342 @@
+import argparse
 import concurrent.futures
 import logging
 import os
+import signal
+import threading
 from datetime import datetime
+from typing import Callable
 from logging.handlers import RotatingFileHandler
 
-from book_manager.book_manager import process_book
-from common.files_operations import compare_file_sizes, is_pdf_file, folder_contains_only_images
-from common.pdf_operations import is_text_pdf
-from settings import INPUT_MANGAS_FOLDER_PATH, OUTPUT_MANGAS_FOLDER_PATH, file_size_comparison
-from manga_manager.manga_processor import process_manga
+from common import instrumentation
+from common.input_watcher import InputWatcher
+from common.job_scheduler import SchedulePlan, available_cores, plan_schedule
+from common.memory_budget import create_shared_budget_state, install_shared_budget
+from common.files_operations import is_archive_file, is_pdf_file, folder_contains_only_images
+from common.processing_results import FileProcessingResult
+from common.run_statistics import StatisticsRun
+from settings import (
+    INPUT_MANGAS_FOLDER_PATH, OUTPUT_MANGAS_FOLDER_PATH, EXECUTION_MODE, MAX_FILES_PER_WORKER, PAGE_WORKERS,
+    WATCH_POLL_SECONDS, log_configuration
+)
 
-# Set up logger with rotating file handler
 logger = logging.getLogger('_books_manager_')
-# 5MB log file with 2 backups
-log_handler = RotatingFileHandler('manga_manager.log', maxBytes=5 * 1024 * 1024, backupCount=2)
-log_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-logger.addHandler(log_handler)
-logger.setLevel(logging.ERROR)  # Set to ERROR to minimize cron job log output
+
+
+def configure_logging():
+    """
+    Set up the logger with a rotating file handler.
+
+    It is also used as initializer of worker processes, which do not inherit the handlers of the main process.
+    """
+    if logger.handlers:
+        return
+    # 5MB log file with 2 backups
+    log_handler = RotatingFileHandler('manga_manager.log', maxBytes=5 * 1024 * 1024, backupCount=2)
+    log_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    logger.addHandler(log_handler)
+    logger.setLevel(logging.ERROR)  # Set to ERROR to minimize cron job log output
+
+
+def initialize_worker_process(budget_state: tuple | None) -> None:
+    """
+    Initializer of worker processes: configure their logging and join the memory budget of the main process.
+
+    Ctrl+C and a service stop signal the whole process group, workers ignore them so that only the main process
+    decides to stop, and the files in progress are completed.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    configure_logging()
+    install_shared_budget(budget_state)
+
+
+def create_executor(
+        *,
+        execution_mode: str,
+        max_workers: int,
+        max_files_per_worker: int
+) -> concurrent.futures.Executor:
+    """
+    Create the executor used to process files.
+
+    :param execution_mode: 'thread' for a thread pool or 'process' for a process pool.
+    :param max_workers: Maximum number of workers.
+    :param max_files_per_worker: Number of files after which a worker process is replaced by a fresh one
+                                 (0 keeps workers alive for the whole run). Ignored in thread mode.
+
+    Worker processes share a single memory budget, threads share the budget of the process.
+    """
+    if execution_mode == 'process':
+        executor_kwargs = {
+            'max_workers': max_workers,
+            'initializer': initialize_worker_process,
+            'initargs': (create_shared_budget_state(),),
+        }
+        if max_files_per_worker > 0:
+            executor_kwargs['max_tasks_per_child'] = max_files_per_worker
+        return concurrent.futures.ProcessPoolExecutor(**executor_kwargs)
+    if execution_mode == 'thread':
+        return concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    raise ValueError(f"Invalid execution mode '{execution_mode}'. Expected 'thread' or 'process'.")
+
+
+def process_file(file_path: str, destiny_folder_path: str) -> FileProcessingResult:
+    """
+    Classify a file and process it as a book or a manga, parsing it only once.
+
+    Runs inside the workers, so classifying a file does not delay the submission of the others. The document
+    libraries are imported here, on the first file, so an idle run starts and exits without loading them.
+    """
+    from document_session import DocumentSession
+
+    with instrumentation.file_scope(file_path) as file_instrumentation:
+        with DocumentSession(file_path) as session:
+            result = session.process(destiny_folder_path)
+        if file_instrumentation is not None:
+            file_instrumentation.complete(result)
+    return result
 
 
 def process_files_concurrently(
         *,
         file_paths_to_process: list[str],
         destiny_folder_path: str,
-        max_workers=2
-):
+        max_workers=2,
+        execution_mode: str = EXECUTION_MODE,
+        max_files_per_worker: int = MAX_FILES_PER_WORKER,
+        on_result: Callable[[FileProcessingResult], None] | None = None
+) -> list[FileProcessingResult]:
     """
-    Processes a list of files concurrently using a thread pool.
+    Processes a list of files concurrently using a thread or process pool.
 
     :param file_paths_to_process: List of file paths to be processed.
     :param destiny_folder_path: Destination folder path where the processed files will be saved.
-    :param max_workers: Maximum number of threads to use.
+    :param max_workers: Maximum number of workers to use.
+    :param execution_mode: 'thread' or 'process'.
+    :param max_files_per_worker: Files processed by a worker process before it is recycled (0 disables recycling).
+    :param on_result: Optional callback invoked with the result of each file as soon as it completes.
+    :return: The result of every processed file.
     """
     if not file_paths_to_process:
         logger.warning('No files provided for processing. Exiting.')
-        return
+        return []
 
     if not os.path.exists(destiny_folder_path):
         logger.warning(f'Destination folder does not exist: {destiny_folder_path}. Creating it.')
         os.makedirs(destiny_folder_path)
 
-    logger.info(f'Starting concurrent processing of {len(file_paths_to_process)} files with {max_workers} workers.')
+    logger.info(
+        f'Starting concurrent processing of {len(file_paths_to_process)} files '
+        f'with {max_workers} {execution_mode} workers.'
+    )
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = []
+    results: list[FileProcessingResult] = []
+    with create_executor(
+            execution_mode=execution_mode,
+            max_workers=max_workers,
+            max_files_per_worker=max_files_per_worker
+    ) as executor:
+        futures = {}
         for file_path in file_paths_to_process:
-            if is_text_pdf(file_path):
-                futures.append(executor.submit(process_book, file_path, destiny_folder_path))
-            else:
-                futures.append(executor.submit(process_manga, file_path, destiny_folder_path))
+            futures[executor.submit(process_file, file_path, destiny_folder_path)] = file_path
 
         # Wait for all futures to complete and handle any exceptions
-        for future in concurrent.futures.as_completed(futures):
-            try:
-                result = future.result()  # Get the result of the file processing
-                logger.info(f'File processed successfully: {result}')
-            except Exception as exc:
-                logger.error(f'File processing generated an exception: {exc}')
-                logger.warning('There was an issue processing one of the files. Continuing with other files.')
-
-
-start_time = datetime.now()
-
-# Define number of workers based on CPU count
-workers = os.cpu_count() // 2
-if workers < 2:
-    logger.warning(f'Low CPU core count detected: {workers} cores. Processing may be slower.')
-else:
-    logger.info(f'Detected {workers} CPU cores. Using this for max workers.')
-
-# Ensure input and output folders are absolute paths
-input_folder = os.path.abspath(INPUT_MANGAS_FOLDER_PATH)
-output_folder = os.path.abspath(OUTPUT_MANGAS_FOLDER_PATH)
-
-# List all valid file paths (PDF files and folders with images) from the input folder
-if not os.path.exists(input_folder):
-    logger.warning(f'Input folder does not exist: {input_folder}. Exiting.')
-else:
-    file_paths = [
-        os.path.join(input_folder, item)
-        for item in os.listdir(input_folder)
-        if (folder_contains_only_images(os.path.join(input_folder, item))) or (is_pdf_file(os.path.join(input_folder, item)))
-    ]
-
-    if not file_paths:
-        logger.warning(f'No valid PDFs or folders with images found in the input folder: {input_folder}. Exiting.')
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                results.append(collect_result(future, futures.pop(future), on_result))
+        except KeyboardInterrupt:
+            logger.info('Processing interrupted, finishing the files in progress.')
+            executor.shutdown(wait=True, cancel_futures=True)
+            for future, file_path in futures.items():
+                if future.done() and not future.cancelled():
+                    results.append(collect_result(future, file_path, on_result))
+
+    return results
+
+
+def collect_result(future: concurrent.futures.Future, file_path: str,
+                   on_result: Callable[[FileProcessingResult], None] | None = None) -> FileProcessingResult:
+    """Get the result of a completed file, turning an exception raised by the worker into a failed result."""
+    try:
+        result = future.result()  # Get the result of the file processing
+    except Exception as exc:
+        logger.error(f'File processing generated an exception: {exc}')
+        logger.warning('There was an issue processing one of the files. Continuing with other files.')
+        result = FileProcessingResult(file_path=file_path, name=os.path.basename(file_path), error=str(exc))
+
+    if result.succeeded:
+        logger.info(f'File processed successfully: {result}')
     else:
-        logger.info(
-            f'Found {len(file_paths)} valid items (PDFs or folders with images) in the input folder: {input_folder}')
+        logger.warning(f'File {file_path} could not be processed: {result.error}')
+    if on_result is not None:
+        on_result(result)
+    return result
 
-        try:
-            process_files_concurrently(
-                file_paths_to_process=file_paths,
-                destiny_folder_path=output_folder,
-                max_workers=workers
+
+def watch_input_folder(
+        *,
+        input_folder: str,
+        destiny_folder_path: str,
+        max_workers: int,
+        execution_mode: str = EXECUTION_MODE,
+        max_files_per_worker: int = MAX_FILES_PER_WORKER,
+        poll_seconds: float = WATCH_POLL_SECONDS,
+        stop_event: threading.Event | None = None,
+        on_result: Callable[[FileProcessingResult], None] | None = None
+) -> list[FileProcessingResult]:
+    """
+    Process inputs as they appear in the input folder, until `stop_event` is set.
+
+    The executor is created once and kept for the whole session, so workers stay warm between inputs. The
+    folder is scanned every `poll_seconds`; inputs that stopped changing are submitted at once, largest first
+    when several become ready together.
+
+    :param input_folder: Folder watched for new PDFs and folders of images.
+    :param destiny_folder_path: Destination folder path where the processed files will be saved.
+    :param max_workers: Maximum number of workers to use.
+    :param execution_mode: 'thread' or 'process'.
+    :param max_files_per_worker: Files processed by a worker process before it is recycled (0 disables recycling).
+    :param poll_seconds: Interval between scans of the input folder.
+    :param stop_event: Event that ends the session. Pending inputs are cancelled, running ones are completed.
+    :param on_result: Optional callback invoked with the result of each file as soon as it completes.
+    :return: The result of every processed file.
+    """
+    stop_event = stop_event if stop_event is not None else threading.Event()
+    os.makedirs(destiny_folder_path, exist_ok=True)
+    watcher = InputWatcher(input_folder)
+    results: list[FileProcessingResult] = []
+    futures: dict[concurrent.futures.Future, str] = {}
+    logger.info(f'Watching {input_folder} with {max_workers} {execution_mode} workers.')
+
+    executor = create_executor(
+        execution_mode=execution_mode,
+        max_workers=max_workers,
+        max_files_per_worker=max_files_per_worker
+    )
+    try:
+        while not stop_event.is_set():
+            ready_paths = watcher.poll()
+            if ready_paths:
+                logger.info(f'Queuing {len(ready_paths)} new inputs: {ready_paths}')
+                for file_path in plan_schedule(ready_paths, workers=max_workers).file_paths:
+                    futures[executor.submit(process_file, file_path, destiny_folder_path)] = file_path
+
+            if not futures:
+                stop_event.wait(poll_seconds)
+                continue
+            done, _ = concurrent.futures.wait(
+                futures, timeout=poll_seconds, return_when=concurrent.futures.FIRST_COMPLETED
             )
-            logger.info('All files processed successfully.')
-        except Exception as e:
-            logger.error(f'An error occurred during concurrent file processing: {e}')
-
-# Calculate and log execution time
-time_of_execution = datetime.now() - start_time
-logger.info(f'Execution time: {time_of_execution}')
-
-# Print and log file size comparisons
-size_comparison = compare_file_sizes(file_size_comparison)
-print('Files sizes comparison per series')
-print(size_comparison)
-logger.info(f'File sizes comparison: {size_comparison}')
+            for future in done:
+                file_path = futures.pop(future)
+                results.append(collect_result(future, file_path, on_result))
+                watcher.mark_done(file_path)
+    except KeyboardInterrupt:
+        logger.info('Watch interrupted, finishing the inputs in progress.')
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        for future, file_path in futures.items():
+            if future.done() and not future.cancelled():
+                results.append(collect_result(future, file_path, on_result))
+    return results
+
+
+def parse_arguments(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Optimize the mangas and books of the input folder for e-readers.')
+    parser.add_argument('--plan', action='store_true',
+                        help='Print the estimated cost and ETA of every input, in processing order, and exit.')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep running and process new inputs as soon as they stop changing.')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of files processed at once (chosen from the estimates and the cores if omitted).')
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None):
+    args = parse_arguments(argv)
+    configure_logging()
+    log_configuration()
+    start_time = datetime.now()
+
+    cores = available_cores()
+    if cores < 2:
+        logger.warning(f'Low CPU core count detected: {cores} cores. Processing may be slower.')
+
+    # Ensure input and output folders are absolute paths
+    input_folder = os.path.abspath(INPUT_MANGAS_FOLDER_PATH)
+    output_folder = os.path.abspath(OUTPUT_MANGAS_FOLDER_PATH)
+
+    results: list[FileProcessingResult] = []
+    statistics_run: StatisticsRun | None = None
+
+    if args.watch:
+        # A service stop (SIGTERM) ends the session like Ctrl+C, once the inputs in progress are done
+        stop_event = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+        instrumentation.start_run()
+        statistics_run = StatisticsRun()
+        results = watch_input_folder(
+            input_folder=input_folder,
+            destiny_folder_path=output_folder,
+            max_workers=args.workers or max(1, cores // PAGE_WORKERS),
+            stop_event=stop_event,
+            on_result=statistics_run.record
+        )
+
+    # List all valid file paths (PDF files, CBZ/ZIP archives and folders with images) from the input folder
+    elif not os.path.exists(input_folder):
+        logger.warning(f'Input folder does not exist: {input_folder}. Exiting.')
+    else:
+        file_paths = [
+            os.path.join(input_folder, item)
+            for item in os.listdir(input_folder)
+            if folder_contains_only_images(os.path.join(input_folder, item))
+            or is_pdf_file(os.path.join(input_folder, item))
+            or is_archive_file(os.path.join(input_folder, item))
+        ]
+
+        if not file_paths:
+            logger.warning(f'No valid PDFs, archives or folders with images found in the input folder: '
+                           f'{input_folder}. Exiting.')
+        else:
+            logger.info(
+                f'Found {len(file_paths)} valid items (PDFs, archives or folders with images) '
+                f'in the input folder: {input_folder}')
+
+            # Largest inputs are submitted first, the number of workers follows the estimated costs
+            plan: SchedulePlan = plan_schedule(file_paths, workers=args.workers)
+            if args.plan:
+                print(plan.format())
+                return
+
+            # A service stop (SIGTERM) interrupts the run like Ctrl+C, once the files in progress are done
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            instrumentation.start_run()
+            statistics_run = StatisticsRun()
+            try:
+                results = process_files_concurrently(
+                    file_paths_to_process=plan.file_paths,
+                    destiny_folder_path=output_folder,
+                    max_workers=plan.workers,
+                    on_result=statistics_run.record
+                )
+                logger.info('All files processed successfully.')
+            except Exception as e:
+                logger.error(f'An error occurred during concurrent file processing: {e}')
+
+    # Calculate and log execution time
+    time_of_execution = datetime.now() - start_time
+    logger.info(f'Execution time: {time_of_execution}')
+    instrumentation.write_run_summary(results, time_of_execution.total_seconds())
+
+    # Print and log the size, throughput and regressions of every series, recorded in the statistics history
+    if statistics_run is not None:
+        series_report = statistics_run.finish()
+        print('Files sizes comparison per series')
+        print(series_report)
+        logger.info(f'File sizes comparison: {series_report}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+import logging
+import os
+import zipfile
+
+from natsort import natsorted
+
+from settings import IMAGE_EXTENSIONS
+
+logger = logging.getLogger('_books_manager_')
+
+
+def archive_image_members(archive: zipfile.ZipFile) -> list[zipfile.ZipInfo]:
+    """
+    Image members of an archive, in natural order of their path.
+
+    Folders, hidden files and the resource forks macOS adds to archives (__MACOSX) are skipped.
+    """
+    members = [
+        member for member in archive.infolist()
+        if not member.is_dir()
+        and member.filename.lower().endswith(IMAGE_EXTENSIONS)
+        and not member.filename.startswith('__MACOSX/')
+        and not os.path.basename(member.filename).startswith('.')
+    ]
+    return natsorted(members, key=lambda member: member.filename)
+
+
+def archive_pages_generator(archive: zipfile.ZipFile, members: list[zipfile.ZipInfo]):
+    """
+    Generator to read and yield the encoded images of an archive, one member at a time.
+
+    Members are decompressed in memory, nothing is written to disk. The pipeline runs this generator in its
+    extract thread and zlib releases the GIL while inflating, so decompression overlaps with image processing.
+    """
+    for image_index, member in enumerate(members):
+        try:
+            image_data = archive.read(member)
+            # Archive images are standalone pages, so they are all processed as the first image of a page
+            yield 0, image_index, member.filename, image_data
+        except Exception as e:
+            logger.error(f"Failed to read {member.filename} from the archive: {e}")
+            continue
+
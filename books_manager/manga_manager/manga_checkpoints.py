@@ -0,0 +1,133 @@
+import json
+import logging
+import os
+import shutil
+
+from common.input_watcher import folder_signature
+from manga_manager.manga_segment_cache import SegmentCache, processing_settings_fingerprint
+
+logger = logging.getLogger('_books_manager_')
+
+MANIFEST_FILE_NAME = 'manifest.jsonl'
+
+
+class DocumentCheckpoint:
+    """
+    Records the pages of a document whose segments were already written, so an interrupted run can resume.
+
+    The checkpoint lives in a hidden folder next to the output PDF. It holds an append-only JSON lines manifest:
+    the first line identifies the source file and the settings, every following line describes one completed
+    page. Pages whose segments are in the segment cache only record their cache key, the segments of the other
+    pages are stored in the checkpoint folder and their files are listed. A page whose cache entry was evicted
+    is processed again. A torn last line, left by a killed run, is ignored on load.
+    """
+
+    def __init__(self, source_path: str, output_pdf_path: str, segment_cache: SegmentCache | None = None):
+        self.source_path = source_path
+        self.segment_cache = segment_cache
+        output_folder_path, output_file_name = os.path.split(output_pdf_path)
+        self.folder_path = os.path.join(output_folder_path, f'.{output_file_name}.checkpoint')
+        self.manifest_path = os.path.join(self.folder_path, MANIFEST_FILE_NAME)
+        self.completed: dict[int, dict] = {}
+        self._manifest_handler = None
+        self._load()
+
+    def _source_identity(self) -> dict:
+        """
+        Source path, size, modification time and settings fingerprint. Folders of images are identified by the
+        number, total size and latest modification time of their files, so an image replaced in place is noticed.
+        """
+        if os.path.isdir(self.source_path):
+            signature = folder_signature(self.source_path)
+            source_files, source_size, source_mtime_ns = signature.files, signature.size_bytes, signature.mtime_ns
+        else:
+            source_stat = os.stat(self.source_path)
+            source_files, source_size, source_mtime_ns = 1, source_stat.st_size, source_stat.st_mtime_ns
+        return {
+            'source': os.path.abspath(self.source_path),
+            'source_files': source_files,
+            'source_size': source_size,
+            'source_mtime_ns': source_mtime_ns,
+            'settings': processing_settings_fingerprint(),
+        }
+
+    def _load(self) -> None:
+        """Load the completed pages of a previous run if the checkpoint matches the source and settings."""
+        if not os.path.exists(self.manifest_path):
+            return
+        try:
+            with open(self.manifest_path, encoding='utf-8') as manifest_handler:
+                lines = manifest_handler.read().splitlines()
+            if not lines or json.loads(lines[0]) != self._source_identity():
+                logger.warning(f"Discarding outdated checkpoint {self.folder_path}.")
+                self.discard()
+                return
+            for line in lines[1:]:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                self.completed[record['sequence']] = record
+            logger.info(f"Resuming {self.source_path} from checkpoint with {len(self.completed)} completed pages.")
+        except Exception as e:
+            logger.error(f"Error loading checkpoint {self.folder_path}: {e}. Starting over.")
+            self.completed = {}
+            self.discard()
+
+    def completed_segments(self, sequence: int, page_num: int, img_index: int) -> list[bytes] | None:
+        """Return the segments recorded for a page, or None if the page was not completed."""
+        record = self.completed.get(sequence)
+        if record is None or record['page_num'] != page_num or record['img_index'] != img_index:
+            return None
+        if 'segments_key' in record:
+            return self.segment_cache.get(record['segments_key']) if self.segment_cache is not None else None
+        segments = []
+        try:
+            for segment_file in record['segments']:
+                with open(os.path.join(self.folder_path, segment_file), 'rb') as segment_handler:
+                    segments.append(segment_handler.read())
+        except FileNotFoundError:
+            return None
+        return segments
+
+    def record(self, sequence: int, page_num: int, img_index: int, segments: list[bytes],
+               segments_key: str | None = None) -> None:
+        """
+        Append a completed page to the manifest.
+
+        :param segments_key: Key of the segment cache entry holding `segments`, recorded instead of a copy of them.
+        """
+        if sequence in self.completed:
+            return
+        if self._manifest_handler is None:
+            os.makedirs(self.folder_path, exist_ok=True)
+            is_new_manifest = not os.path.exists(self.manifest_path)
+            self._manifest_handler = open(self.manifest_path, 'a', encoding='utf-8')
+            if is_new_manifest:
+                self._manifest_handler.write(json.dumps(self._source_identity()) + '\n')
+
+        record = {'sequence': sequence, 'page_num': page_num, 'img_index': img_index}
+        if segments_key is not None and self.segment_cache is not None:
+            record['segments_key'] = segments_key
+        else:
+            segment_files = []
+            for segment_index, segment in enumerate(segments):
+                segment_file = f'{sequence}_{segment_index}.jpg'
+                with open(os.path.join(self.folder_path, segment_file), 'wb') as segment_handler:
+                    segment_handler.write(segment)
+                segment_files.append(segment_file)
+            record['segments'] = segment_files
+        # The manifest line is written after the segments, so a listed page always has its files on disk
+        self._manifest_handler.write(json.dumps(record) + '\n')
+        self._manifest_handler.flush()
+        self.completed[sequence] = record
+
+    def close(self) -> None:
+        if self._manifest_handler is not None:
+            self._manifest_handler.close()
+            self._manifest_handler = None
+
+    def discard(self) -> None:
+        """Remove the checkpoint, once the output has been committed or when it cannot be used."""
+        self.close()
+        shutil.rmtree(self.folder_path, ignore_errors=True)
@@ -2,16 +2,153 @@ import io
 import logging
 import os
 
-import cv2
 import numpy as np
 from PIL import Image, ImageFilter, ImageEnhance
 from PIL.ImageFile import ImageFile
 
+from common import instrumentation
+from manga_manager.manga_denoise_operations import (
+    denoise_image_array, downsample_for_estimation, estimate_noise, is_grayscale_array
+)
+from manga_manager.manga_page_analysis import (
+    PageAnalysis, analyze_page, background_for_brightness, blank_or_dark_rows_mask, content_bounding_box,
+    corner_brightness, detect_blank_or_dark_bands
+)
 from settings import FINAL_DOCUMENT_WIDTH, FINAL_DOCUMENT_HEIGHT, USE_SATURATION_FILTER, \
-    SATURATION_FACTOR, NOISE_THRESHOLD
+    SATURATION_FACTOR, NOISE_THRESHOLD, USE_GRAYSCALE_PIPELINE, NOISE_ESTIMATION_MAX_SIDE
 
 logger = logging.getLogger('_books_manager_')
 
+# Modes holding a single luminance channel
+_SINGLE_CHANNEL_MODES = ('1', 'L', 'LA', 'I', 'I;16', 'F')
+
+
+def is_monochrome_image(image: Image.Image) -> bool:
+    """
+    Checks whether an image only holds shades of gray, either because of its mode or because its color
+    channels are (nearly) identical. Color channels are compared on a downsampled copy.
+    """
+    if image.mode in _SINGLE_CHANNEL_MODES:
+        return True
+    if image.mode == 'CMYK':
+        return False
+    scale = min(1.0, NOISE_ESTIMATION_MAX_SIDE / max(image.size))
+    sample_size = (max(1, int(image.width * scale)), max(1, int(image.height * scale)))
+    sample = image.resize(sample_size, Image.Resampling.NEAREST).convert('RGB')
+    return is_grayscale_array(downsample_for_estimation(np.asarray(sample)))
+
+
+def convert_for_processing(
+        image: Image.Image,
+        image_mode: str | None = None,
+        use_grayscale_pipeline: bool = USE_GRAYSCALE_PIPELINE,
+        monochrome: bool | None = None
+) -> Image.Image:
+    """
+    Converts a decoded image to the mode it is processed and encoded in.
+
+    Monochrome images are carried as single channel 'L' images when the grayscale pipeline is enabled, so
+    cropping, splitting, resizing, filtering and encoding work on a third of the data. Color images are
+    converted to `image_mode`, or kept in their decoded mode if it is None.
+
+    :param monochrome: Whether the image is monochrome, if already known. Detected from the image otherwise.
+    """
+    if monochrome is None:
+        monochrome = use_grayscale_pipeline and is_monochrome_image(image)
+    if use_grayscale_pipeline and monochrome:
+        return image if image.mode == 'L' else image.convert('L')
+    if image_mode is not None and image.mode != image_mode:
+        return image.convert(image_mode)
+    return image
+
+
+def reduce_on_decode(image: ImageFile, target_size: tuple[int, int]) -> float:
+    """
+    Configures a JPEG that is not decoded yet to be decoded at the smallest DCT scale (1/2, 1/4 or 1/8) whose
+    size still covers `target_size`, which cuts decode time and memory for high resolution scans.
+
+    Other formats are decoded at full size. Returns the reduction factor, 1.0 when the image is not reduced.
+    """
+    if image.format != 'JPEG':
+        return 1.0
+    full_width = image.width
+    image.draft(image.mode, target_size)
+    return full_width / image.width
+
+
+def estimate_decoded_bytes(size: tuple[int, int], mode: str) -> int:
+    """Estimated bytes of an image once decoded: width x height x channels. Palette images are counted as RGB."""
+    channels = 3 if mode == 'P' else Image.getmodebands(mode)
+    return size[0] * size[1] * channels
+
+
+def needs_full_resolution(box: tuple[int, int, int, int], scale: float, screen_width=FINAL_DOCUMENT_WIDTH,
+                          screen_height=FINAL_DOCUMENT_HEIGHT) -> bool:
+    """Checks whether a region of an image decoded at reduced size would be upscaled when fit to the screen."""
+    if scale <= 1.0:
+        return False
+    left, top, right, bottom = box
+    return min(screen_width / max(1, right - left), screen_height / max(1, bottom - top)) > 1
+
+
+class FullResolutionSource:
+    """
+    Encoded image whose full resolution version is only decoded when a region of its reduced version is too
+    small to fill the screen.
+
+    Boxes are given in the coordinates of the reduced image. The full resolution image is decoded once, converted
+    with `prepare` (to the same mode as the reduced image) and reused for every later crop. `reserve`, if given,
+    is called with the estimated decoded size of the full resolution image before it is decoded.
+    """
+
+    def __init__(self, image_data: bytes, reduced_size: tuple[int, int], scale: float, prepare=None,
+                 screen_width=FINAL_DOCUMENT_WIDTH, screen_height=FINAL_DOCUMENT_HEIGHT, reserve=None):
+        self.image_data = image_data
+        self.reduced_size = reduced_size
+        self.scale = scale
+        self.prepare = prepare
+        self.reserve = reserve
+        self.screen_width = screen_width
+        self.screen_height = screen_height
+        self._image: Image.Image | None = None
+
+    def crop(self, image: Image.Image, box: tuple[int, int, int, int]) -> Image.Image:
+        """Crop a box of the reduced `image`, from the full resolution image if the reduced region is too small."""
+        if not needs_full_resolution(box, self.scale, self.screen_width, self.screen_height):
+            return image.crop(box)
+        if self._image is None:
+            logger.info("Decoding image at full resolution for a small region.")
+            full_image = Image.open(io.BytesIO(self.image_data))
+            if self.reserve is not None:
+                self.reserve(estimate_decoded_bytes(full_image.size, full_image.mode))
+            self._image = self.prepare(full_image) if self.prepare is not None else full_image
+        scale_x = self._image.width / self.reduced_size[0]
+        scale_y = self._image.height / self.reduced_size[1]
+        left, top, right, bottom = box
+        return self._image.crop((
+            int(left * scale_x), int(top * scale_y),
+            min(self._image.width, round(right * scale_x)), min(self._image.height, round(bottom * scale_y))
+        ))
+
+    def close(self) -> None:
+        if self._image is not None:
+            self._image.close()
+            self._image = None
+
+
+def crop_region(image: Image.Image, box: tuple[int, int, int, int],
+                full_resolution: FullResolutionSource | None = None) -> Image.Image:
+    """Crop a box of an image, going back to the full resolution source when the image was decoded reduced."""
+    with instrumentation.stage('split'):
+        if full_resolution is not None:
+            return full_resolution.crop(image, box)
+        return image.crop(box)
+
+
+def grayscale_array(image: Image.Image) -> np.ndarray:
+    """Returns the luminance of an image as a 2D array, without a conversion for 'L' images."""
+    return np.asarray(image if image.mode == 'L' else image.convert('L'), dtype=np.uint8)
+
 
 def average_brightness(region: Image.Image) -> float:
     """
@@ -19,11 +156,7 @@ def average_brightness(region: Image.Image) -> float:
 
     Brightness is computed as the mean of the grayscale values.
     """
-    grayscale = region.convert("L")
-    histogram = grayscale.histogram()
-    pixels = sum(histogram)
-    brightness = sum(i * histogram[i] for i in range(256)) / pixels
-    return brightness
+    return float(grayscale_array(region).mean())
 
 
 def best_background_for_image(image: Image.Image, corner_size: int = 50) -> tuple[int, int, int]:
@@ -39,44 +172,22 @@ def best_background_for_image(image: Image.Image, corner_size: int = 50) -> tupl
     - (0, 0, 0) for black background.
     - (255, 255, 255) for white background.
     """
-    width, height = image.size
-
-    # Define the four corner boxes (left-top, right-top, left-bottom, right-bottom)
-    corners = [
-        image.crop((0, 0, corner_size, corner_size)),  # Top-left
-        image.crop((width - corner_size, 0, width, corner_size)),  # Top-right
-        image.crop((0, height - corner_size, corner_size, height)),  # Bottom-left
-        image.crop((width - corner_size, height - corner_size, width, height))  # Bottom-right
-    ]
-
-    # Calculate average brightness for each corner and then average the results
-    avg_brightness = sum(average_brightness(corner) for corner in corners) / len(corners)
-
-    # Calculate contrast with white and black backgrounds
-    contrast_with_white = abs(255 - avg_brightness)  # White background contrast
-    contrast_with_black = avg_brightness  # Black background contrast
-
-    # Choose the background that provides better contrast
-    if contrast_with_white > contrast_with_black:
-        return 0, 0, 0  # Image looks better on a black background
-    else:
-        return 255, 255, 255  # Image looks better on a white background
+    # Average brightness of the four corners, read from a single grayscale array
+    return background_for_brightness(corner_brightness(grayscale_array(image), corner_size))
 
 
 def calculate_noise(image_cv: np.ndarray) -> float:
     """
-    Calculate the noise level of the image using variance of the Laplacian.
+    Calculate the noise level of the image using variance of the Laplacian, measured on a downsampled copy.
     """
-    gray = cv2.cvtColor(image_cv, cv2.COLOR_BGR2GRAY)
-    laplacian_var = cv2.Laplacian(gray, cv2.CV_64F).var()
-    return laplacian_var
+    return estimate_noise(image_cv).laplacian_variance
 
 
 def is_image_good_quality(image: Image) -> bool:
     """
     Determine if the image quality is good based on noise level and sharpness.
     """
-    image_cv = np.array(image)
+    image_cv = np.asarray(image)
     noise_level = calculate_noise(image_cv)
 
     logger.debug(f'Noise level: {noise_level}')
@@ -105,14 +216,16 @@ def denoise_and_sharpen_image(
             enhancer = ImageEnhance.Color(image_saturated)
             image_saturated = enhancer.enhance(saturation_factor)
 
-        # Check if the image is of good quality
-        if is_image_good_quality(image_saturated):
+        # Check if the image is of good quality, the estimate is reused to choose the denoise strength
+        image_cv = np.asarray(image_saturated)
+        noise = estimate_noise(image_cv)
+        logger.debug(f'Noise level: {noise.laplacian_variance}')
+        if noise.laplacian_variance < NOISE_THRESHOLD:
             logger.info('Image quality is good; skipping denoising.')
             return image_saturated
 
-        # 1. Denoise the image using OpenCV (fastNlMeansDenoisingColored)
-        image_cv = np.array(image_saturated)
-        denoised_image = cv2.fastNlMeansDenoisingColored(image_cv, None, 10, 10, 7, 21)
+        # 1. Denoise the image using OpenCV non-local means (single channel path for grayscale pages)
+        denoised_image = denoise_image_array(image_cv, noise)
 
         # Convert back to PIL for further processing
         image_denoised = Image.fromarray(denoised_image)
@@ -129,30 +242,16 @@ def denoise_and_sharpen_image(
 
 def is_not_manga(image: ImageFile) -> bool:
     """
-    Detect if an image is likely from a manga or a web-comic/manhwa based on its aspect ratio and color content.
+    Detect if an image is likely from a manga or a web-comic/manhwa based on its color content.
+
+    Colored images are web-comics/manhwa, grayscale ones are manga. Channels are compared on a downsampled copy.
     """
     try:
-        width, height = image.size
-        aspect_ratio = width / height
-        img_np = np.array(image, dtype=np.uint8)
-
-        is_colored = True
-
-        if len(img_np.shape) == 2:
-            is_colored = False
-        elif len(img_np.shape) == 3:
-            if np.all(img_np[:, :, 0] == img_np[:, :, 1]) and np.all(img_np[:, :, 1] == img_np[:, :, 2]):
-                is_colored = False
-
-        if aspect_ratio > 1.5 and is_colored:
-            logger.info("Image classified as manga.")
-            return True
-        elif not is_colored:
+        if is_monochrome_image(image):
             logger.info("Image classified as non-manga (grayscale).")
             return False
-        else:
-            logger.info("Image classified as manga (non-grayscale).")
-            return True
+        logger.info("Image classified as manga (non-grayscale).")
+        return True
     except Exception as e:
         logger.error(f"Error in is_not_manga: {e}", exc_info=True)
         return False
@@ -163,15 +262,8 @@ def detect_blank_or_dark_spaces(image, threshold_light=240, threshold_dark=15):
     Detects horizontal blank or dark spaces in an image by checking each row of pixels.
     """
     try:
-        spaces = []
-        width, height = image.size
-        grayscale_img = image.convert("L")
-
-        for y in range(height):
-            row = grayscale_img.crop((0, y, width, y + 1))
-            if all(pixel > threshold_light for pixel in row.getdata()) or all(
-                    pixel < threshold_dark for pixel in row.getdata()):
-                spaces.append(y)
+        grayscale = grayscale_array(image)
+        spaces = np.flatnonzero(blank_or_dark_rows_mask(grayscale, threshold_light, threshold_dark)).tolist()
 
         logger.info(f"Detected {len(spaces)} blank or dark spaces.")
         return spaces
@@ -180,23 +272,27 @@ def detect_blank_or_dark_spaces(image, threshold_light=240, threshold_dark=15):
         return []
 
 
-def crop_image_by_blank_or_dark_space(image, blank_threshold=240, dark_threshold=30) -> ImageFile:
+def crop_image_by_blank_or_dark_space(
+        image,
+        blank_threshold=240,
+        dark_threshold=30,
+        grayscale: np.ndarray | None = None,
+        bounding_box: tuple[int, int, int, int] | None = None
+) -> ImageFile:
     """
     Crops the image by detecting regions of blank (white) or dark (black) space.
+
+    If the grayscale array of the image is already available it can be passed as `grayscale` to avoid
+    converting the image again, and if the content box is already known it can be passed as `bounding_box`.
     """
     try:
-        grayscale_image = image.convert('L')
-        np_image = np.array(grayscale_image, dtype=np.uint8)
-
-        blank_mask = np_image > blank_threshold
-        dark_mask = np_image < dark_threshold
-        crop_mask = ~(blank_mask | dark_mask)
-
-        coords = np.argwhere(crop_mask)
-        if coords.size > 0:
-            y0, x0 = coords.min(axis=0)
-            y1, x1 = coords.max(axis=0) + 1
-            cropped_image = image.crop((x0, y0, x1, y1))
+        if bounding_box is None:
+            if grayscale is None:
+                grayscale = grayscale_array(image)
+            bounding_box = content_bounding_box(grayscale, blank_threshold, dark_threshold)
+
+        if bounding_box is not None:
+            cropped_image = image.crop(bounding_box)
             logger.info("Image cropped by blank or dark spaces.")
         else:
             logger.warning("No valid cropping region found, returning original image.")
@@ -207,9 +303,12 @@ def crop_image_by_blank_or_dark_space(image, blank_threshold=240, dark_threshold
         return image
 
 
-def enhance_image_for_screen(img, screen_width=FINAL_DOCUMENT_WIDTH, screen_height=FINAL_DOCUMENT_HEIGHT) -> Image:
+def enhance_image_for_screen(img, screen_width=FINAL_DOCUMENT_WIDTH, screen_height=FINAL_DOCUMENT_HEIGHT,
+                             background_color: tuple[int, int, int] | None = None) -> Image:
     """
     Enhances an image to fit a screen with given resolution pixels while maintaining the aspect ratio.
+
+    The background is chosen from the corners of the image, unless `background_color` is given.
     """
     try:
         img_width, img_height = img.size
@@ -235,10 +334,14 @@ def enhance_image_for_screen(img, screen_width=FINAL_DOCUMENT_WIDTH, screen_heig
 
         resized_img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
 
-        # Create a new image with the screen size and background color matching the best background for the image
-        new_img = Image.new(
-            mode="RGB", size=(screen_width, screen_height), color=best_background_for_image(resized_img)
-        )
+        # Create a new image with the screen size and background color matching the best background for the image,
+        # grayscale images keep a single channel canvas
+        if background_color is None:
+            background_color = best_background_for_image(resized_img)
+        if resized_img.mode == 'L':
+            new_img = Image.new(mode="L", size=(screen_width, screen_height), color=background_color[0])
+        else:
+            new_img = Image.new(mode="RGB", size=(screen_width, screen_height), color=background_color)
 
         # Center the resized image on the screen
         paste_x = (screen_width - new_width) // 2
@@ -257,27 +360,44 @@ def split_image_by_blank_or_dark_spaces(
         image,
         threshold_light=240,
         threshold_dark=15,
-        min_gap=20
+        min_gap=20,
+        analysis: PageAnalysis | None = None,
+        full_resolution: FullResolutionSource | None = None
 ) -> list[ImageFile]:
     """
     Splits an image into segments wherever horizontal blank spaces are found
+
+    With the `analysis` of the image, its bands and grayscale array are reused instead of being computed again.
+    If the image was decoded at reduced size, segments too small to fill the screen are cropped from
+    `full_resolution`.
     """
     try:
-        blank_spaces = detect_blank_or_dark_spaces(image, threshold_light, threshold_dark)
-        split_positions = [0] + blank_spaces + [image.height]
+        if analysis is not None:
+            grayscale, bands = analysis.grayscale, analysis.bands
+        else:
+            grayscale = grayscale_array(image)
+            bands = detect_blank_or_dark_bands(grayscale, threshold_light, threshold_dark, min_gap)
+        logger.info(f"Detected {len(bands)} bands between blank or dark spaces.")
 
         cropped_images = []
 
-        for i in range(1, len(split_positions)):
-            try:
-                if split_positions[i] - split_positions[i - 1] > min_gap:
-                    segment = image.crop((0, split_positions[i - 1], image.width, split_positions[i]))
-
-                    segment_cropped = crop_image_by_blank_or_dark_space(segment)
-                    segment_enhanced = enhance_image_for_screen(segment_cropped)
-                    cropped_images.append(segment_enhanced)
-            except IndexError:
-                break
+        for top, bottom in bands:
+            # Reuse the rows of the grayscale array instead of converting the segment again
+            segment_box = content_bounding_box(grayscale[top:bottom])
+            if segment_box is not None:
+                left, box_top, right, box_bottom = segment_box
+                region = (left, top + box_top, right, top + box_bottom)
+                logger.info("Image cropped by blank or dark spaces.")
+            else:
+                logger.warning("No valid cropping region found, returning original image.")
+                region = (0, top, image.width, bottom)
+            segment_cropped = crop_region(image, region, full_resolution)
+            background_color = None
+            if analysis is not None and segment_box is not None:
+                background_color = analysis.background_for_box(region)
+            with instrumentation.stage('resize'):
+                segment_enhanced = enhance_image_for_screen(segment_cropped, background_color=background_color)
+            cropped_images.append(segment_enhanced)
 
         logger.info(f"Split image into {len(cropped_images)} segments.")
         return cropped_images
@@ -286,19 +406,73 @@ def split_image_by_blank_or_dark_spaces(
         return []
 
 
-def split_and_crop_image(image: ImageFile, page_num: int, img_index: int) -> list[ImageFile]:
+def can_pass_through(
+        image: ImageFile,
+        page_num: int,
+        screen_width=FINAL_DOCUMENT_WIDTH,
+        screen_height=FINAL_DOCUMENT_HEIGHT,
+        use_saturation_filter: bool = USE_SATURATION_FILTER,
+        analysis: PageAnalysis | None = None
+) -> bool:
+    """
+    Checks whether `split_and_crop_image` would leave a decoded JPEG unchanged, so its encoded bytes can be
+    written to the output as-is instead of being re-encoded.
+
+    That is the case when the image already has the screen size, is not split, has nothing to crop, is not
+    saturated and does not need denoising.
+    """
+    try:
+        if image.format != 'JPEG' or image.mode not in ('RGB', 'L'):
+            return False
+        if image.size != (screen_width, screen_height) or use_saturation_filter:
+            return False
+        if analysis is None:
+            analysis = analyze_page(image)
+        if page_num != 0 and analysis.is_not_manga:
+            return False
+        if analysis.content_box != (0, 0, image.width, image.height):
+            return False
+        return analysis.is_good_quality
+    except Exception as e:
+        logger.error(f"Error in can_pass_through: {e}", exc_info=True)
+        return False
+
+
+def split_and_crop_image(image: ImageFile, page_num: int, img_index: int,
+                         analysis: PageAnalysis | None = None,
+                         full_resolution: FullResolutionSource | None = None) -> list[ImageFile]:
+    """
+    Split (web-comics/manhwa), crop, fit to the screen, denoise and sharpen an image.
+
+    Every decision reads from the `analysis` of the image, computed here if not given. If the image was decoded
+    at reduced size, regions too small to fill the screen are cropped from `full_resolution` instead.
+    """
     images: list[ImageFile] = []
     try:
         logger.info(f"Processing image from page {page_num + 1}, index {img_index + 1}.")
-        if page_num != 0 and is_not_manga(image):
-            for image_segment in split_image_by_blank_or_dark_spaces(image=image):
+        if analysis is None:
+            analysis = analyze_page(image)
+        if page_num != 0 and analysis.is_not_manga:
+            for image_segment in split_image_by_blank_or_dark_spaces(
+                    image=image, analysis=analysis, full_resolution=full_resolution
+            ):
                 # Apply denoising and sharpening after cropping
-                denoised_sharpened_image = denoise_and_sharpen_image(image_segment)
+                with instrumentation.stage('denoise'):
+                    denoised_sharpened_image = denoise_and_sharpen_image(image_segment)
                 images.append(denoised_sharpened_image)
         else:
-            image_cropped = enhance_image_for_screen(crop_image_by_blank_or_dark_space(image))
+            # A page without a content box (uniform or all background) is kept whole
+            if analysis.content_box is not None:
+                image_cropped = crop_region(image, analysis.content_box, full_resolution)
+            else:
+                image_cropped = image
+            with instrumentation.stage('resize'):
+                image_enhanced = enhance_image_for_screen(
+                    image_cropped, background_color=analysis.background_for_box(analysis.content_box)
+                )
             # Apply denoising and sharpening after cropping
-            denoised_sharpened_image = denoise_and_sharpen_image(image_cropped)
+            with instrumentation.stage('denoise'):
+                denoised_sharpened_image = denoise_and_sharpen_image(image_enhanced)
             images.append(denoised_sharpened_image)
     except Exception as e:
         logger.error(f"Error processing image on page {page_num + 1}: {e}", exc_info=True)
@@ -359,7 +533,7 @@ def load_images_list_by_path(
     try:
         for image_path in image_files_paths:
             full_path = os.path.join(image_folder_path, image_path)
-            images.append(Image.open(full_path).convert('RGB'))
+            images.append(convert_for_processing(Image.open(full_path), 'RGB'))
             logger.info(f"Loaded image: {image_path}")
     except Exception as e:
         logger.error(f"Error loading images from path {image_folder_path}: {e}", exc_info=True)
@@ -368,12 +542,18 @@ def load_images_list_by_path(
 
 def load_image_by_path(
         image_file_path: str,
+        target_size: tuple[int, int] | None = None
 ) -> Image:
     """
     Load a single image by its path.
+
+    With `target_size`, JPEG images are decoded at the smallest reduced size that still covers it.
     """
     try:
-        image = Image.open(image_file_path).convert('RGB')
+        image = Image.open(image_file_path)
+        if target_size is not None:
+            reduce_on_decode(image, target_size)
+        image = convert_for_processing(image, 'RGB')
         logger.info(f"Loaded image: {image_file_path}")
         return image
     except Exception as e:
@@ -381,12 +561,16 @@ def load_image_by_path(
         return None
 
 
-def load_image_by_str_data(image_data) -> ImageFile | None:
+def load_image_by_str_data(image_data, target_size: tuple[int, int] | None = None) -> ImageFile | None:
     """
     Load an image from byte data.
+
+    With `target_size`, JPEG images are decoded at the smallest reduced size that still covers it.
     """
     try:
         image = Image.open(io.BytesIO(image_data))
+        if target_size is not None:
+            reduce_on_decode(image, target_size)
         logger.info("Loaded image from byte data.")
         return image
     except Exception as e:
@@ -394,6 +578,15 @@ def load_image_by_str_data(image_data) -> ImageFile | None:
         return None
 
 
+def encode_image_to_jpeg(image: Image.Image, quality: int = 75) -> bytes:
+    """
+    Encode an image as JPEG and return the encoded bytes.
+    """
+    with io.BytesIO() as image_buffer:
+        image.save(image_buffer, format='JPEG', optimize=True, quality=quality)
+        return image_buffer.getvalue()
+
+
 def save_image_to_path(image: ImageFile, path_to_save: str, quality=75):
     """
     Save an image to a specified path with a given quality.
@@ -0,0 +1,211 @@
+import logging
+from dataclasses import dataclass, field
+from functools import cached_property
+
+import numpy as np
+from PIL import Image
+
+from manga_manager.manga_denoise_operations import NoiseEstimate, estimate_noise, is_grayscale_array
+from settings import NOISE_THRESHOLD, BLANK_PAGE_CONTENT_RATIO
+
+logger = logging.getLogger('_books_manager_')
+
+# Thresholds shared by the cropping and splitting decisions
+CROP_BLANK_THRESHOLD = 240
+CROP_DARK_THRESHOLD = 30
+SPLIT_LIGHT_THRESHOLD = 240
+SPLIT_DARK_THRESHOLD = 15
+SPLIT_MIN_GAP = 20
+
+# Side of the square read at each corner to choose the background color
+CORNER_SIZE = 50
+
+# Brightness difference with the page background from which a pixel counts as content for the blank detection.
+# Well above scanner noise and JPEG ringing, well below the contrast of ink on paper (or text on a dark page).
+BLANK_CONTENT_DIFFERENCE = 64
+
+# Longest side of the downsampled copy the color statistics are measured on
+COLOR_SAMPLE_MAX_SIDE = 256
+
+BLACK_BACKGROUND = (0, 0, 0)
+WHITE_BACKGROUND = (255, 255, 255)
+
+
+def _rgb_sample(image: Image.Image, max_side: int = COLOR_SAMPLE_MAX_SIDE) -> np.ndarray:
+    """Return a downsampled RGB array of an image, for the color statistics."""
+    scale = min(1.0, max_side / max(image.size))
+    sample_size = (max(1, int(image.width * scale)), max(1, int(image.height * scale)))
+    return np.asarray(image.resize(sample_size, Image.Resampling.NEAREST).convert('RGB'))
+
+
+def colorfulness(rgb_array: np.ndarray) -> float:
+    """Colorfulness metric of Hasler and Suesstrunk (2003): 0 for grayscale images, above ~15 for colored ones."""
+    rgb = rgb_array.astype(np.float32)
+    red_green = rgb[:, :, 0] - rgb[:, :, 1]
+    yellow_blue = 0.5 * (rgb[:, :, 0] + rgb[:, :, 1]) - rgb[:, :, 2]
+    deviation = np.hypot(red_green.std(), yellow_blue.std())
+    mean = np.hypot(red_green.mean(), yellow_blue.mean())
+    return float(deviation + 0.3 * mean)
+
+
+def corner_brightness(grayscale: np.ndarray, corner_size: int = CORNER_SIZE) -> float:
+    """Average brightness of the four corner squares of a grayscale array."""
+    height, width = grayscale.shape
+    if height == 0 or width == 0:
+        return 255.0
+    size_y, size_x = min(corner_size, height), min(corner_size, width)
+    corners = (
+        grayscale[:size_y, :size_x],
+        grayscale[:size_y, width - size_x:],
+        grayscale[height - size_y:, :size_x],
+        grayscale[height - size_y:, width - size_x:],
+    )
+    return float(sum(corner.mean() for corner in corners) / len(corners))
+
+
+def background_for_brightness(brightness: float) -> tuple[int, int, int]:
+    """Choose the background that gives the most contrast with the given brightness."""
+    return BLACK_BACKGROUND if abs(255 - brightness) > brightness else WHITE_BACKGROUND
+
+
+def content_bounding_box(
+        grayscale: np.ndarray,
+        blank_threshold=CROP_BLANK_THRESHOLD,
+        dark_threshold=CROP_DARK_THRESHOLD
+) -> tuple[int, int, int, int] | None:
+    """
+    Computes the (left, top, right, bottom) box enclosing every pixel that is neither blank nor dark.
+
+    Returns None when the whole array is blank or dark.
+    """
+    content_mask = (grayscale <= blank_threshold) & (grayscale >= dark_threshold)
+    rows = np.flatnonzero(content_mask.any(axis=1))
+    if rows.size == 0:
+        return None
+    cols = np.flatnonzero(content_mask.any(axis=0))
+    return int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+
+
+def background_content_ratio(grayscale: np.ndarray, background_brightness: float,
+                             difference: int = BLANK_CONTENT_DIFFERENCE) -> float:
+    """
+    Share of the pixels of a grayscale array that differ from the background brightness by more than `difference`.
+
+    Unlike the content box, it does not rely on mid-tones: the strokes of a bilevel scan and the white text of a
+    dark page count as content.
+    """
+    if grayscale.size == 0:
+        return 0.0
+    content_mask = np.abs(grayscale.astype(np.int16) - int(round(background_brightness))) > difference
+    return float(np.count_nonzero(content_mask)) / content_mask.size
+
+
+def blank_or_dark_rows_mask(grayscale: np.ndarray, threshold_light=240, threshold_dark=15) -> np.ndarray:
+    """
+    Computes a boolean mask marking the rows of a grayscale array that are entirely blank (light) or dark.
+
+    Row-wise minimum and maximum are computed as whole-array reductions, so no Python loop runs per pixel.
+    """
+    if grayscale.shape[0] == 0 or grayscale.shape[1] == 0:
+        return np.zeros(grayscale.shape[0], dtype=bool)
+    light_rows = grayscale.min(axis=1) > threshold_light
+    dark_rows = grayscale.max(axis=1) < threshold_dark
+    return light_rows | dark_rows
+
+
+def detect_blank_or_dark_bands(
+        grayscale: np.ndarray,
+        threshold_light=SPLIT_LIGHT_THRESHOLD,
+        threshold_dark=SPLIT_DARK_THRESHOLD,
+        min_gap=SPLIT_MIN_GAP
+) -> list[tuple[int, int]]:
+    """
+    Computes the (top, bottom) bands between horizontal blank or dark rows of a grayscale array.
+
+    A band spans from one blank/dark row (or the top of the image) to the next one (or the bottom of the image)
+    and is only kept when it is taller than `min_gap` rows.
+    """
+    height = grayscale.shape[0]
+    spaces = np.flatnonzero(blank_or_dark_rows_mask(grayscale, threshold_light, threshold_dark))
+    split_positions = np.concatenate(([0], spaces, [height]))
+    tops, bottoms = split_positions[:-1], split_positions[1:]
+    keep = (bottoms - tops) > min_gap
+    return [(int(top), int(bottom)) for top, bottom in zip(tops[keep], bottoms[keep])]
+
+
+@dataclass
+class PageAnalysis:
+    """
+    Every per-image statistic the processing decisions need, computed once from a single grayscale array.
+
+    The grayscale array is kept so that crops and splits can measure their own regions without converting
+    the image again. The noise estimate is only needed by a few decisions, so it is computed on first use.
+    """
+    width: int
+    height: int
+    colorfulness: float
+    is_colored: bool
+    corner_brightness: float
+    background_color: tuple[int, int, int]
+    content_box: tuple[int, int, int, int] | None
+    content_ratio: float
+    bands: list[tuple[int, int]]
+    is_blank: bool
+    grayscale: np.ndarray = field(repr=False)
+
+    @cached_property
+    def noise(self) -> NoiseEstimate:
+        return estimate_noise(self.grayscale)
+
+    @property
+    def is_not_manga(self) -> bool:
+        """Colored images are web-comics/manhwa, split in segments instead of shown as a page."""
+        return self.is_colored
+
+    @property
+    def is_good_quality(self) -> bool:
+        return self.noise.laplacian_variance < NOISE_THRESHOLD
+
+    def background_for_box(self, box: tuple[int, int, int, int] | None) -> tuple[int, int, int]:
+        """Best background for a region of the image, from the brightness of its own corners."""
+        if box is None:
+            return self.background_color
+        left, top, right, bottom = box
+        return background_for_brightness(corner_brightness(self.grayscale[top:bottom, left:right]))
+
+
+def analyze_page(image: Image.Image, blank_page_content_ratio: float = BLANK_PAGE_CONTENT_RATIO) -> PageAnalysis:
+    """
+    Analyse a decoded image in a single pass over its grayscale array.
+
+    Color statistics are measured on a downsampled copy, the geometry (content box and bands) at full
+    resolution. A page whose share of pixels differing from its background (the brightness of its corners) is
+    under `blank_page_content_ratio` is flagged as blank.
+    """
+    grayscale = np.asarray(image if image.mode == 'L' else image.convert('L'), dtype=np.uint8)
+    height, width = grayscale.shape
+
+    if image.mode in ('1', 'L', 'LA', 'I', 'I;16', 'F'):
+        image_colorfulness, is_colored = 0.0, False
+    else:
+        rgb_sample = _rgb_sample(image)
+        image_colorfulness = colorfulness(rgb_sample)
+        is_colored = not is_grayscale_array(rgb_sample)
+
+    brightness = corner_brightness(grayscale)
+    content_ratio = background_content_ratio(grayscale, brightness)
+    analysis = PageAnalysis(
+        width=width,
+        height=height,
+        colorfulness=image_colorfulness,
+        is_colored=is_colored,
+        corner_brightness=brightness,
+        background_color=background_for_brightness(brightness),
+        content_box=content_bounding_box(grayscale),
+        content_ratio=content_ratio,
+        bands=detect_blank_or_dark_bands(grayscale),
+        is_blank=content_ratio < blank_page_content_ratio,
+        grayscale=grayscale,
+    )
+    logger.debug(f'Page analysis: {analysis}')
+    return analysis
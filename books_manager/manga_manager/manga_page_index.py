@@ -0,0 +1,280 @@
+import io
+import logging
+import os
+import sqlite3
+import threading
+from dataclasses import dataclass, field
+
+import numpy as np
+from PIL import Image
+
+from manga_manager.manga_segment_cache import processing_settings_fingerprint
+from settings import (
+    SERIES_PAGE_INDEX_POLICY,
+    SERIES_PAGE_INDEX_PATH,
+    SERIES_PAGE_INDEX_MAX_DISTANCE,
+    SERIES_PAGE_INDEX_MAX_CELL_DIFFERENCE
+)
+
+logger = logging.getLogger('_books_manager_')
+
+SERIES_PAGE_INDEX_POLICIES = ('off', 'keep', 'reuse', 'skip')
+
+# The coarse hash (8x8 bits) finds candidates through its four 16 bit bands, the detailed hash (16x16 bits)
+# decides whether a candidate is the same page. Two coarse hashes differing in up to 3 bits share a band.
+COARSE_HASH_SIZE = 8
+DETAIL_HASH_SIZE = 16
+BANDS = 4
+BAND_BITS = COARSE_HASH_SIZE * COARSE_HASH_SIZE // BANDS
+# Nearly uniform pages have almost no gradients, their hashes would match each other
+MIN_HASH_BITS = 8
+# Side of the grayscale thumbnail compared cell by cell to confirm a match before reusing or skipping a page
+THUMBNAIL_SIZE = 32
+
+_SCHEMA = f'''
+CREATE TABLE IF NOT EXISTS pages (
+    id INTEGER PRIMARY KEY,
+    series TEXT NOT NULL,
+    volume TEXT NOT NULL,
+    sequence INTEGER NOT NULL,
+    detail BLOB NOT NULL,
+    segments_key TEXT,
+    settings_fingerprint TEXT,
+    thumbnail BLOB,
+    seen_count INTEGER NOT NULL DEFAULT 1,
+    {', '.join(f'b{band} INTEGER NOT NULL' for band in range(BANDS))}
+);
+CREATE INDEX IF NOT EXISTS pages_volume ON pages (series, volume);
+{''.join(f'CREATE INDEX IF NOT EXISTS pages_b{band} ON pages (series, b{band});' for band in range(BANDS))}
+'''
+
+_FIND_QUERY = ' UNION '.join(
+    f'SELECT id, volume, detail, segments_key, settings_fingerprint, thumbnail FROM pages '
+    f'WHERE series = ? AND b{band} = ?'
+    for band in range(BANDS)
+)
+# Columns added after the first version of the index, with their type
+_ADDED_COLUMNS = {'settings_fingerprint': 'TEXT', 'thumbnail': 'BLOB'}
+
+
+def difference_hash(grayscale: Image.Image, size: int) -> int:
+    """dHash of a grayscale image: one bit per pair of horizontally adjacent cells of a (size + 1) x size grid."""
+    cells = np.asarray(grayscale.resize((size + 1, size), Image.Resampling.BOX), dtype=np.int16)
+    bits = np.packbits(cells[:, 1:] > cells[:, :-1])
+    return int.from_bytes(bits.tobytes(), 'big')
+
+
+@dataclass(frozen=True)
+class PageHashes:
+    """Perceptual hashes of a page, and its grayscale thumbnail to confirm the matches found with them."""
+    coarse_hash: int
+    detail_hash: int
+    thumbnail: bytes
+
+
+def page_hashes(image_data: bytes) -> PageHashes | None:
+    """
+    Coarse and detailed perceptual hashes and thumbnail of an encoded image, or None for nearly uniform images.
+
+    JPEG images are decoded in grayscale at 1/8 of their size, so hashing costs a fraction of a full decode.
+    """
+    with Image.open(io.BytesIO(image_data)) as image:
+        image.draft('L', (DETAIL_HASH_SIZE * 8, DETAIL_HASH_SIZE * 8))
+        grayscale = image.convert('L')
+    coarse_hash = difference_hash(grayscale, COARSE_HASH_SIZE)
+    if not MIN_HASH_BITS <= coarse_hash.bit_count() <= COARSE_HASH_SIZE ** 2 - MIN_HASH_BITS:
+        return None
+    thumbnail = grayscale.resize((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.Resampling.BOX).tobytes()
+    return PageHashes(coarse_hash, difference_hash(grayscale, DETAIL_HASH_SIZE), thumbnail)
+
+
+def thumbnail_difference(thumbnail: bytes, other_thumbnail: bytes) -> int:
+    """Largest difference of brightness between the same cell of two thumbnails."""
+    cells = np.frombuffer(thumbnail, dtype=np.uint8).astype(np.int16)
+    other_cells = np.frombuffer(other_thumbnail, dtype=np.uint8).astype(np.int16)
+    return int(np.abs(cells - other_cells).max())
+
+
+def _bands(coarse_hash: int) -> list[int]:
+    mask = (1 << BAND_BITS) - 1
+    return [(coarse_hash >> (band * BAND_BITS)) & mask for band in range(BANDS)]
+
+
+def _detail_bytes(detail_hash: int) -> bytes:
+    return detail_hash.to_bytes(DETAIL_HASH_SIZE * DETAIL_HASH_SIZE // 8, 'big')
+
+
+@dataclass
+class PageMatch:
+    """
+    A page of an earlier volume recognized for a page being processed.
+
+    The hashes only tell pages with a similar layout, such as chapter title pages with different titles. A match
+    is `confirmed` when no cell of the thumbnails of both pages differs by more than the maximum cell difference
+    of the index, only confirmed matches are reused or skipped. Its segments key is None when the earlier page was
+    processed with other settings, its segments do not fit the current output.
+    """
+    page_id: int
+    volume: str
+    distance: int
+    segments_key: str | None
+    confirmed: bool = False
+
+
+@dataclass
+class IndexedPage:
+    """A page of the volume being processed, added to the index once the volume is committed."""
+    sequence: int
+    hashes: PageHashes
+    segments_key: str | None
+
+
+class SeriesPageIndex:
+    """
+    Persistent index of the perceptual hashes of every page processed, by series.
+
+    It is a SQLite database in WAL mode, so worker threads and processes can read it while another one adds a
+    volume. Lookups only read the rows sharing a band of the coarse hash, through one index per band, so their
+    cost does not grow with the number of pages of the series.
+
+    Segments keys are stored with the fingerprint of the processing settings they were produced with, and only
+    handed out for reuse under the same settings.
+    """
+
+    def __init__(self, db_path: str = SERIES_PAGE_INDEX_PATH, max_distance: int = SERIES_PAGE_INDEX_MAX_DISTANCE,
+                 settings_fingerprint: str | None = None,
+                 max_cell_difference: int = SERIES_PAGE_INDEX_MAX_CELL_DIFFERENCE):
+        self.db_path = os.path.abspath(db_path)
+        self.max_distance = max_distance
+        self.max_cell_difference = max_cell_difference
+        self.settings_fingerprint = settings_fingerprint or processing_settings_fingerprint()
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        self._connection = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript(_SCHEMA)
+        columns = [row[1] for row in self._connection.execute('PRAGMA table_info(pages)')]
+        # Pages of an index created by an earlier version have neither, their matches are never reused or skipped
+        with self._connection:
+            for column, column_type in _ADDED_COLUMNS.items():
+                if column not in columns:
+                    self._connection.execute(f'ALTER TABLE pages ADD COLUMN {column} {column_type}')
+
+    def find(self, series: str, volume: str, hashes: PageHashes) -> PageMatch | None:
+        """
+        The closest page of another volume of the series within `max_distance` bits, or None.
+
+        Confirmed matches are preferred over closer unconfirmed ones.
+        """
+        parameters = []
+        for band_value in _bands(hashes.coarse_hash):
+            parameters += [series, band_value]
+        with self._lock:
+            rows = self._connection.execute(_FIND_QUERY, parameters).fetchall()
+        best_match = None
+        for page_id, page_volume, detail, segments_key, settings_fingerprint, thumbnail in rows:
+            if page_volume == volume:
+                continue
+            distance = (int.from_bytes(detail, 'big') ^ hashes.detail_hash).bit_count()
+            if distance > self.max_distance:
+                continue
+            confirmed = thumbnail is not None and \
+                thumbnail_difference(thumbnail, hashes.thumbnail) <= self.max_cell_difference
+            if best_match is None or (not confirmed, distance) < (not best_match.confirmed, best_match.distance):
+                if settings_fingerprint != self.settings_fingerprint:
+                    segments_key = None
+                best_match = PageMatch(page_id, page_volume, distance, segments_key, confirmed)
+        return best_match
+
+    def add_volume(self, series: str, volume: str, pages: list[IndexedPage],
+                   matched: list[tuple[int, str | None]]) -> None:
+        """
+        Replace the pages of a volume in one transaction, and count the pages of earlier volumes it repeated.
+
+        Repeated pages (confirmed matches) are not added again, the page they matched stands for them. It takes
+        the segments key of the repeat when there is one, the latest segments are the most likely to still be cached
+        and were produced with the current settings.
+
+        :param matched: Id of the matched page and segments key of the repeat, for every repeated page.
+        """
+        rows = [
+            (series, volume, page.sequence, _detail_bytes(page.hashes.detail_hash), page.segments_key,
+             self.settings_fingerprint, page.hashes.thumbnail, *_bands(page.hashes.coarse_hash))
+            for page in pages
+        ]
+        columns = ', '.join(f'b{band}' for band in range(BANDS))
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM pages WHERE series = ? AND volume = ?', (series, volume))
+            self._connection.executemany(
+                f'INSERT INTO pages (series, volume, sequence, detail, segments_key, settings_fingerprint, thumbnail, '
+                f'{columns}) VALUES (?, ?, ?, ?, ?, ?, ?, {", ".join("?" * BANDS)})',
+                rows
+            )
+            self._connection.executemany(
+                'UPDATE pages SET seen_count = seen_count + 1, segments_key = COALESCE(?, segments_key), '
+                'settings_fingerprint = COALESCE(?, settings_fingerprint) WHERE id = ?',
+                [
+                    (segments_key, None if segments_key is None else self.settings_fingerprint, page_id)
+                    for page_id, segments_key in matched
+                ]
+            )
+
+
+@dataclass
+class SeriesPages:
+    """
+    Lookups and additions of the pages of one volume, made by the pipeline processing it.
+
+    :param policy: What to do with pages seen in earlier volumes (confirmed matches): 'keep' them (only count
+                   them), 'reuse' the segments cached for the earlier page, or 'skip' them.
+    """
+    index: SeriesPageIndex
+    series: str
+    volume: str
+    policy: str
+    pages: list[IndexedPage] = field(default_factory=list)
+    matched: list[tuple[int, str | None]] = field(default_factory=list)
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def match(self, image_data: bytes) -> tuple[PageHashes | None, PageMatch | None]:
+        """Hash a source image and look it up. Returns its hashes (None if it can not be indexed) and match."""
+        hashes = page_hashes(image_data)
+        if hashes is None:
+            return None, None
+        return hashes, self.index.find(self.series, self.volume, hashes)
+
+    def record(self, sequence: int, hashes: PageHashes, match: PageMatch | None, segments_key: str | None) -> None:
+        """Record a written page, added to the index by `commit`. Pages only similar to an earlier one are added."""
+        with self.lock:
+            if match is not None and match.confirmed:
+                self.matched.append((match.page_id, segments_key))
+            else:
+                self.pages.append(IndexedPage(sequence, hashes, segments_key))
+
+    def commit(self) -> None:
+        """Add the recorded pages once the volume has been written."""
+        try:
+            self.index.add_volume(self.series, self.volume, self.pages, self.matched)
+        except sqlite3.Error as e:
+            logger.error(f"Error adding {self.volume} to the page index of {self.series}: {e}")
+            return
+        logger.info(f"Indexed {len(self.pages)} pages of {self.volume} ({self.series}), "
+                    f"{len(self.matched)} pages were seen in earlier volumes ({self.policy}).")
+
+
+_series_page_index: SeriesPageIndex | None = None
+_series_page_index_lock = threading.Lock()
+
+
+def get_series_pages(series: str | None, volume: str, policy: str = SERIES_PAGE_INDEX_POLICY) -> SeriesPages | None:
+    """Index view for a volume of a series, or None when the index is disabled or the series is unknown."""
+    global _series_page_index
+    if policy not in SERIES_PAGE_INDEX_POLICIES:
+        raise ValueError(f"Invalid series page index policy '{policy}'. Expected one of {SERIES_PAGE_INDEX_POLICIES}.")
+    if policy == 'off' or not series:
+        return None
+    with _series_page_index_lock:
+        if _series_page_index is None:
+            _series_page_index = SeriesPageIndex()
+        return SeriesPages(_series_page_index, series, volume, policy)
@@ -1,31 +1,50 @@
-import gc
 import logging
 import os
-from io import BytesIO
+import zipfile
+from collections import Counter
 
-import fitz
 from natsort import natsorted
 from pymupdf import Document
-from reportlab.lib.utils import ImageReader
-from reportlab.pdfgen import canvas
 
-from manga_manager.manga_images_operations import (
-    load_image_by_str_data, split_and_crop_image, load_image_by_path
-)
+from common import instrumentation
+from common.epub_operations import EpubImageWriter
+from common.files_operations import is_archive_file
+from common.memory_budget import get_memory_budget
+from common.pymupdf_access import PYMUPDF_LOCK, open_pdf_document
+from manga_manager.manga_archive_operations import archive_image_members, archive_pages_generator
+from manga_manager.manga_checkpoints import DocumentCheckpoint
+from manga_manager.manga_page_index import get_series_pages
+from manga_manager.manga_pdf_writers import create_pdf_writer
+from manga_manager.manga_segment_cache import get_segment_cache
+from manga_manager.manga_pipeline import run_manga_pipeline
 from settings import (
     FINAL_DOCUMENT_WIDTH,
     FINAL_DOCUMENT_HEIGHT,
-    IMAGE_QUALITY
+    IMAGE_QUALITY,
+    PAGE_WORKERS,
+    USE_CHECKPOINTS
 )
 
 logger = logging.getLogger('_books_manager_')
 
 
 def doc_pages_generator(doc: Document):
-    """Generator to extract and yield images from the PDF."""
-    for page_num in range(len(doc)):
-        page = doc.load_page(page_num)
-        images = page.get_images(full=True)
+    """
+    Generator to extract and yield images from the PDF.
+
+    An image object drawn on several pages (watermarks, filler or credit pages) is extracted once: its data is
+    kept until its last use and the same bytes are yielded for every occurrence.
+
+    It runs in the pipeline extract thread, its PyMuPDF calls hold `PYMUPDF_LOCK` but never across a yield.
+    """
+    with PYMUPDF_LOCK:
+        page_count = len(doc)
+        remaining_uses = Counter(img[0] for page_num in range(page_count) for img in doc.get_page_images(page_num))
+    extracted: dict[int, bytes] = {}
+
+    for page_num in range(page_count):
+        with PYMUPDF_LOCK:
+            images = doc.load_page(page_num).get_images(full=True)
 
         if not images:
             logger.warning(f"No images found on page {page_num}.")
@@ -35,70 +54,145 @@ def doc_pages_generator(doc: Document):
         for img_index, img in enumerate(images):
             try:
                 xref = img[0]
-                base_image = doc.extract_image(xref)
-                image_data = base_image["image"]
+                remaining_uses[xref] -= 1
+                image_data = extracted.pop(xref, None) if remaining_uses[xref] == 0 else extracted.get(xref)
+                if image_data is None:
+                    with PYMUPDF_LOCK:
+                        base_image = doc.extract_image(xref)
+                    image_data = base_image["image"]
+                    if remaining_uses[xref] > 0:
+                        extracted[xref] = image_data
                 yield page_num, img_index, image_data
             except Exception as e:
                 logger.error(f"Failed to extract image {img_index} on page {page_num}: {e}")
                 continue
 
 
-def process_pdf(pdf_path: str, new_pdf_path: str, screen_width=FINAL_DOCUMENT_WIDTH,
-                screen_height=FINAL_DOCUMENT_HEIGHT, image_quality_=IMAGE_QUALITY):
-    """
-    Process PDF file: Extract images, split, crop and save them into a new PDF.
+def image_folder_pages_generator(image_folder_path: str, image_files: list[str]):
+    """Generator to read and yield the encoded images of a folder, in the given order."""
+    for image_index, image_file in enumerate(image_files):
+        image_path = os.path.join(image_folder_path, image_file)
+        try:
+            with open(image_path, 'rb') as image_file_handler:
+                image_data = image_file_handler.read()
+            # Folder images are standalone pages, so they are all processed as the first image of a page
+            yield 0, image_index, image_file, image_data
+        except Exception as e:
+            logger.error(f"Failed to read image {image_file}: {e}")
+            continue
+
+
+def write_pages_to_pdf(source, source_path: str, new_pdf_path: str, screen_width: int, screen_height: int,
+                       image_mode: str | None, image_quality_: int, page_workers: int,
+                       epub_path: str | None = None, series_name: str | None = None) -> tuple[int, int]:
     """
-    try:
-        if not os.path.exists(pdf_path):
-            logger.error(f"PDF file does not exist: {pdf_path}")
-            raise FileNotFoundError(f"{pdf_path} not found.")
+    Run the pages of a source through the pipeline and commit the resulting PDF atomically.
 
-        logger.info(f"Starting image extraction from PDF: {pdf_path}")
-        with fitz.open(pdf_path) as doc:
-            if doc.page_count == 0:
-                logger.warning(f"PDF {pdf_path} has no pages.")
-                return
+    If `epub_path` is given, the EPUB is written from the same stream of processed segments as the PDF.
 
-            c = canvas.Canvas(new_pdf_path, pagesize=(screen_width, screen_height))
+    If `series_name` is given, pages are looked up in the page index of the series, and the pages of the source
+    are added to it once the PDF has been committed.
 
-            for page_num, img_index, image_data in doc_pages_generator(doc):
-                logger.info(f"Processing image {img_index} on page {page_num}.")
-                try:
-                    with load_image_by_str_data(image_data=image_data) as image:
-                        split_images = split_and_crop_image(image, page_num, img_index)
-                        for split_image in split_images:
-                            # Create an in-memory bytes object
-                            image_buffer = BytesIO()
-                            # Save the PIL image to buffer in JPEG format (or appropriate format)
-                            split_image.save(image_buffer, format='JPEG', optimize=True, quality=image_quality_)
-                            image_buffer.seek(0)  # Seek to the start of the BytesIO object
+    The PDF is written to a temporary file that replaces `new_pdf_path` only once it is complete. While the
+    document is in progress, completed pages are recorded in a checkpoint, so a restarted run resumes from the
+    last completed page. The checkpoint is removed once the PDF has been committed.
 
-                            # Convert the BytesIO object to an ImageReader object that ReportLab can understand
-                            image_reader = ImageReader(image_buffer)
+    :return: Number of source images read and of pages written.
+    """
+    temporary_pdf_path = f'{new_pdf_path}.part'
+    segment_cache = get_segment_cache()
+    checkpoint = pdf_writer = epub_writer = None
+    written_pages = 0
+
+    def write_segment(jpeg_data: bytes) -> None:
+        nonlocal written_pages
+        pdf_writer.add_jpeg_page(jpeg_data)
+        if epub_writer is not None:
+            epub_writer.add_jpeg_page(jpeg_data)
+        written_pages += 1
 
-                            # Draw the image on the PDF at position (x, y) with specified width and height
-                            c.drawImage(image_reader, x=0, y=0, width=screen_width, height=screen_height)
+    try:
+        checkpoint = DocumentCheckpoint(source_path, new_pdf_path, segment_cache) if USE_CHECKPOINTS else None
+        pdf_writer = create_pdf_writer(temporary_pdf_path, screen_width, screen_height)
+        epub_writer = EpubImageWriter(epub_path) if epub_path is not None else None
+        series_pages = get_series_pages(series_name, os.path.basename(os.path.normpath(source_path)))
+
+        report = run_manga_pipeline(
+            source,
+            write_segment,
+            image_mode=image_mode,
+            image_quality_=image_quality_,
+            transform_workers=page_workers,
+            segment_cache=segment_cache,
+            checkpoint=checkpoint,
+            memory_budget=get_memory_budget(),
+            series_pages=series_pages
+        )
+
+        # Save the PDF and the EPUB, the PDF is moved into place last as it marks the source as done
+        with instrumentation.file_stage('write'):
+            pdf_writer.close()
+            if epub_writer is not None:
+                epub_writer.close()
+            os.replace(temporary_pdf_path, new_pdf_path)
+    except BaseException:
+        if pdf_writer is not None:
+            pdf_writer.abort()
+        if epub_writer is not None:
+            epub_writer.abort()
+        raise
+    finally:
+        if checkpoint is not None:
+            checkpoint.close()
+        if os.path.exists(temporary_pdf_path):
+            os.remove(temporary_pdf_path)
 
-                            # Start a new page after each image
-                            c.showPage()
+    if checkpoint is not None:
+        checkpoint.discard()
+    if series_pages is not None:
+        series_pages.commit()
+    return report['extract']['items'], written_pages
 
-                            # Close the image buffer
-                            image_buffer.close()
 
-                            # Close the split image
-                            split_image.close()
+def process_pdf(pdf_path: str, new_pdf_path: str, screen_width=FINAL_DOCUMENT_WIDTH,
+                screen_height=FINAL_DOCUMENT_HEIGHT, image_quality_=IMAGE_QUALITY, page_workers=PAGE_WORKERS,
+                doc: Document | None = None, epub_path: str | None = None, series_name: str | None = None):
+    """
+    Process PDF file: Extract images, split, crop and save them into a new PDF.
 
-                        image.close()
-                except Exception as e:
-                    logger.error(f"Error processing image {img_index} on page {page_num}: {e}")
+    Pages go through the staged pipeline, `page_workers` threads transform them and the segments are written
+    in page and segment order.
 
-                # Trigger garbage collection after processing each image to free up memory
-                gc.collect()
+    :param doc: The PDF already opened, to avoid parsing it again. Opened from `pdf_path` if not provided.
+    :param epub_path: Path of an EPUB to write along with the PDF, or None.
+    :param series_name: Name of the series of the manga, to recognize pages seen in its earlier volumes.
+    :return: Number of source images read and of pages written.
+    """
+    try:
+        if not os.path.exists(pdf_path):
+            logger.error(f"PDF file does not exist: {pdf_path}")
+            raise FileNotFoundError(f"{pdf_path} not found.")
 
-            # Save the PDF
-            c.save()
+        logger.info(f"Starting image extraction from PDF: {pdf_path}")
+        with open_pdf_document(pdf_path, doc) as doc:
+            with PYMUPDF_LOCK:
+                page_count = doc.page_count
+            if page_count == 0:
+                logger.warning(f"PDF {pdf_path} has no pages.")
+                return 0, 0
+
+            pages_source = (
+                (page_num, img_index, f'{img_index} on page {page_num}', image_data)
+                for page_num, img_index, image_data in doc_pages_generator(doc)
+            )
+            page_counts = write_pages_to_pdf(
+                pages_source, pdf_path, new_pdf_path, screen_width, screen_height,
+                image_mode=None, image_quality_=image_quality_, page_workers=page_workers, epub_path=epub_path,
+                series_name=series_name
+            )
 
         logger.info(f"Image extraction completed for PDF: {pdf_path}")
+        return page_counts
 
     except Exception as e:
         logger.error(f"Error occurred while extracting images from PDF: {pdf_path} - {e}")
@@ -106,62 +200,83 @@ def process_pdf(pdf_path: str, new_pdf_path: str, screen_width=FINAL_DOCUMENT_WI
 
 
 def process_image_folder(image_folder_path: str, new_pdf_path: str, screen_width=FINAL_DOCUMENT_WIDTH,
-                         screen_height=FINAL_DOCUMENT_HEIGHT, image_quality_=IMAGE_QUALITY):
+                         screen_height=FINAL_DOCUMENT_HEIGHT, image_quality_=IMAGE_QUALITY, page_workers=PAGE_WORKERS,
+                         epub_path: str | None = None, series_name: str | None = None):
     """
     Process a folder of images and save them into a new PDF.
+
+    Images go through the same staged pipeline as PDF pages and are written in file and segment order.
+
+    :param epub_path: Path of an EPUB to write along with the PDF, or None.
+    :param series_name: Name of the series of the manga, to recognize pages seen in its earlier volumes.
+    :return: Number of source images read and of pages written.
     """
     image_files = [f for f in os.listdir(image_folder_path) if f.lower().endswith(('png', 'jpg', 'jpeg', 'bmp'))]
 
     if not image_files:
         logger.warning(f"No images found in the folder: {image_folder_path}")
-        return
+        return 0, 0
 
     # Human sort the image paths using natsorted
     image_files = natsorted(image_files)
 
-    c = canvas.Canvas(new_pdf_path, pagesize=(screen_width, screen_height))
-
-    for image_file in image_files:
-        image_path = os.path.join(image_folder_path, image_file)
-        try:
-            with load_image_by_path(image_path) as img:
-                img = img.convert("RGB")
-
-                # Split and crop the image if needed
-                split_images = split_and_crop_image(img, 0, 0)
-                for split_image in split_images:
-                    image_buffer = BytesIO()
-                    split_image.save(image_buffer, format='JPEG', optimize=True, quality=image_quality_)
-                    image_buffer.seek(0)
-
-                    image_reader = ImageReader(image_buffer)
-                    c.drawImage(image_reader, x=0, y=0, width=screen_width, height=screen_height)
-                    c.showPage()
-
-                    image_buffer.close()
-                    split_image.close()
-
-            img.close()
-
-        except Exception as e:
-            logger.error(f"Error processing image {image_file}: {e}")
+    page_counts = write_pages_to_pdf(
+        image_folder_pages_generator(image_folder_path, image_files), image_folder_path, new_pdf_path,
+        screen_width, screen_height, image_mode='RGB', image_quality_=image_quality_, page_workers=page_workers,
+        epub_path=epub_path, series_name=series_name
+    )
+    logger.info(f"Image folder processed and saved to PDF: {new_pdf_path}")
+    return page_counts
 
-        gc.collect()  # Trigger garbage collection after each image
 
-    c.save()
-    logger.info(f"Image folder processed and saved to PDF: {new_pdf_path}")
+def process_archive(archive_path: str, new_pdf_path: str, screen_width=FINAL_DOCUMENT_WIDTH,
+                    screen_height=FINAL_DOCUMENT_HEIGHT, image_quality_=IMAGE_QUALITY, page_workers=PAGE_WORKERS,
+                    epub_path: str | None = None, series_name: str | None = None):
+    """
+    Process a CBZ/ZIP archive of images and save them into a new PDF, without unpacking it.
 
+    Images are streamed from the archive members through the same staged pipeline as folders of images and are
+    written in natural member and segment order.
 
-def split_crop_save_images_to_pdf(input_path: str, new_pdf_path: str):
+    :param epub_path: Path of an EPUB to write along with the PDF, or None.
+    :param series_name: Name of the series of the manga, to recognize pages seen in its earlier volumes.
+    :return: Number of source images read and of pages written.
+    """
+    with zipfile.ZipFile(archive_path) as archive:
+        members = archive_image_members(archive)
+        if not members:
+            logger.warning(f"No images found in the archive: {archive_path}")
+            return 0, 0
+
+        page_counts = write_pages_to_pdf(
+            archive_pages_generator(archive, members), archive_path, new_pdf_path,
+            screen_width, screen_height, image_mode='RGB', image_quality_=image_quality_, page_workers=page_workers,
+            epub_path=epub_path, series_name=series_name
+        )
+    logger.info(f"Archive processed and saved to PDF: {new_pdf_path}")
+    return page_counts
+
+
+def split_crop_save_images_to_pdf(input_path: str, new_pdf_path: str, doc: Document | None = None,
+                                  epub_path: str | None = None, series_name: str | None = None) -> tuple[int, int]:
     """
-    Determine if the input path is a folder (with images) or a PDF file,
+    Determine if the input path is a folder (with images), a CBZ/ZIP archive or a PDF file,
     and process it accordingly.
+
+    :param doc: The PDF already opened, if the input is a PDF.
+    :param epub_path: Path of an EPUB to write along with the PDF, or None.
+    :param series_name: Name of the series of the manga, to recognize pages seen in its earlier volumes.
+    :return: Number of source images read and of pages written.
     """
     if os.path.isdir(input_path):
         logger.info(f"Processing folder with images: {input_path}")
-        process_image_folder(input_path, new_pdf_path)
+        return process_image_folder(input_path, new_pdf_path, epub_path=epub_path, series_name=series_name)
+    elif is_archive_file(input_path):
+        logger.info(f"Processing archive: {input_path}")
+        return process_archive(input_path, new_pdf_path, epub_path=epub_path, series_name=series_name)
     elif os.path.isfile(input_path) and input_path.lower().endswith('.pdf'):
         logger.info(f"Processing PDF file: {input_path}")
-        process_pdf(input_path, new_pdf_path)
+        return process_pdf(input_path, new_pdf_path, doc=doc, epub_path=epub_path, series_name=series_name)
     else:
-        logger.error(f"Invalid input path: {input_path}. Must be a folder with images or a PDF file.")
+        logger.error(f"Invalid input path: {input_path}. Must be a folder with images, an archive or a PDF file.")
+        return 0, 0
@@ -0,0 +1,118 @@
+import hashlib
+import logging
+from io import BytesIO
+
+import fitz  # PyMuPDF
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfgen import canvas
+
+from common.pymupdf_access import PYMUPDF_LOCK
+from settings import FINAL_DOCUMENT_WIDTH, FINAL_DOCUMENT_HEIGHT, PDF_WRITER_BACKEND
+
+logger = logging.getLogger('_books_manager_')
+
+
+class ReportlabPdfWriter:
+    """
+    Writes every JPEG on its own page through a ReportLab canvas.
+
+    ReportLab parses each JPEG again through an `ImageReader` before embedding it. Identical JPEGs are embedded
+    once, ReportLab names image objects after the digest of their data.
+    """
+
+    def __init__(self, pdf_path: str, page_width: int = FINAL_DOCUMENT_WIDTH, page_height: int = FINAL_DOCUMENT_HEIGHT):
+        self.pdf_path = pdf_path
+        self.page_width = page_width
+        self.page_height = page_height
+        self.canvas = canvas.Canvas(pdf_path, pagesize=(page_width, page_height))
+
+    def add_jpeg_page(self, jpeg_data: bytes) -> None:
+        """Draw an encoded JPEG on a new page, stretched to the page size."""
+        with BytesIO(jpeg_data) as image_buffer:
+            # Convert the BytesIO object to an ImageReader object that ReportLab can understand
+            image_reader = ImageReader(image_buffer)
+
+            # Draw the image on the PDF at position (x, y) with specified width and height
+            self.canvas.drawImage(image_reader, x=0, y=0, width=self.page_width, height=self.page_height)
+
+            # Start a new page after each image
+            self.canvas.showPage()
+
+    def close(self) -> None:
+        """Write the PDF to disk."""
+        self.canvas.save()
+
+    def abort(self) -> None:
+        """Discard the pages added so far, the canvas only writes the PDF when it is saved."""
+        self.canvas = None
+
+
+class PyMuPdfWriter:
+    """
+    Writes every JPEG on its own page with PyMuPDF.
+
+    The encoded JPEG stream is embedded as-is (DCTDecode), without being decoded or re-wrapped. Pages with
+    identical JPEGs, such as repeated credit pages, all reference the image object of the first one.
+
+    The writer runs in the pipeline writer thread while the extract thread reads the source PDF with PyMuPDF,
+    which is not thread-safe. Every PyMuPDF call of the writer holds `PYMUPDF_LOCK`, as the extraction does.
+    """
+
+    def __init__(self, pdf_path: str, page_width: int = FINAL_DOCUMENT_WIDTH, page_height: int = FINAL_DOCUMENT_HEIGHT):
+        self.pdf_path = pdf_path
+        self.page_width = page_width
+        self.page_height = page_height
+        with PYMUPDF_LOCK:
+            self.doc = fitz.open()
+        self._image_xrefs: dict[bytes, int] = {}
+
+    def add_jpeg_page(self, jpeg_data: bytes) -> None:
+        """Insert an encoded JPEG on a new page, stretched to the page size."""
+        digest = hashlib.blake2b(jpeg_data, digest_size=20).digest()
+        xref = self._image_xrefs.get(digest)
+        with PYMUPDF_LOCK:
+            page = self.doc.new_page(width=self.page_width, height=self.page_height)
+            if xref is not None:
+                page.insert_image(page.rect, xref=xref, keep_proportion=False)
+            else:
+                self._image_xrefs[digest] = page.insert_image(page.rect, stream=jpeg_data, keep_proportion=False)
+
+    def close(self) -> None:
+        """Write the PDF to disk."""
+        with PYMUPDF_LOCK:
+            try:
+                self.doc.save(self.pdf_path, garbage=1, deflate=True)
+            finally:
+                self.doc.close()
+
+    def abort(self) -> None:
+        """Close the document without writing it, so nothing keeps the output open."""
+        with PYMUPDF_LOCK:
+            if not self.doc.is_closed:
+                self.doc.close()
+
+
+PDF_WRITER_BACKENDS = {
+    'reportlab': ReportlabPdfWriter,
+    'pymupdf': PyMuPdfWriter,
+}
+
+
+def create_pdf_writer(
+        pdf_path: str,
+        page_width: int = FINAL_DOCUMENT_WIDTH,
+        page_height: int = FINAL_DOCUMENT_HEIGHT,
+        backend: str = PDF_WRITER_BACKEND
+) -> ReportlabPdfWriter | PyMuPdfWriter:
+    """
+    Create the writer that assembles the output PDF from encoded JPEG pages.
+
+    :param pdf_path: Path of the PDF to write.
+    :param page_width: Width of every page.
+    :param page_height: Height of every page.
+    :param backend: 'reportlab' or 'pymupdf'.
+    """
+    if backend not in PDF_WRITER_BACKENDS:
+        raise ValueError(f"Invalid PDF writer backend '{backend}'. Expected one of {list(PDF_WRITER_BACKENDS)}.")
+    logger.info(f"Writing {pdf_path} with the {backend} backend.")
+    return PDF_WRITER_BACKENDS[backend](pdf_path, page_width, page_height)
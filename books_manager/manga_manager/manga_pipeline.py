@@ -0,0 +1,552 @@
+import hashlib
+import logging
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Iterable
+
+from PIL import Image
+
+from common import instrumentation
+from common.memory_budget import BudgetLease, MemoryBudget
+from manga_manager.manga_images_operations import (
+    FullResolutionSource, can_pass_through, convert_for_processing, encode_image_to_jpeg, estimate_decoded_bytes,
+    load_image_by_str_data, reduce_on_decode, split_and_crop_image
+)
+from manga_manager.manga_checkpoints import DocumentCheckpoint
+from manga_manager.manga_page_analysis import analyze_page
+from manga_manager.manga_page_index import PageHashes, PageMatch, SeriesPages
+from manga_manager.manga_segment_cache import SegmentCache
+from settings import (
+    IMAGE_QUALITY,
+    PAGE_WORKERS,
+    ENCODE_WORKERS,
+    PIPELINE_QUEUE_SIZE,
+    DROP_BLANK_PAGES,
+    DEDUPLICATE_IMAGES,
+    DECODE_AT_TARGET_RESOLUTION,
+    FINAL_DOCUMENT_WIDTH,
+    FINAL_DOCUMENT_HEIGHT
+)
+
+logger = logging.getLogger('_books_manager_')
+
+# Marker put on a queue to tell the next stage that no more items will come
+_END_OF_STREAM = object()
+
+
+@dataclass
+class PipelineItem:
+    """A source image travelling through the pipeline, identified by its position in the document."""
+    sequence: int
+    page_num: int
+    img_index: int
+    label: str
+    source_data: bytes | None = None
+    images: list[Image.Image] = field(default_factory=list)
+    segments: list[bytes] = field(default_factory=list)
+    cache_key: str | None = None
+    completed: bool = False
+    resumed: bool = False
+    error: Exception | None = None
+    # Seconds per stage and encoded size of the source, reported when instrumentation is enabled
+    timings: dict[str, float] = field(default_factory=dict)
+    bytes_in: int = 0
+    # Bytes of the memory budget held by the item, from its decoding until its split images are encoded
+    reserved_bytes: int = 0
+    # Sequence of the earlier item with the same source image, whose segments are written again for this one
+    duplicate_of: int | None = None
+    # Perceptual hashes of the source and the page of an earlier volume it matched, in the series page index
+    page_hashes: PageHashes | None = None
+    page_match: PageMatch | None = None
+    # Key of the segment cache entry holding the segments of the item, recorded in the series page index and in
+    # the checkpoint
+    segments_key: str | None = None
+
+
+@dataclass
+class StageStats:
+    """Occupancy counters of a pipeline stage, accumulated by all of its workers."""
+    name: str
+    workers: int
+    items: int = 0
+    busy_seconds: float = 0.0
+    starved_seconds: float = 0.0
+    blocked_seconds: float = 0.0
+    queue_depth_total: int = 0
+    queue_depth_samples: int = 0
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def record(self, busy: float, starved: float = 0.0, blocked: float = 0.0, queue_depth: int | None = None):
+        with self.lock:
+            self.items += 1
+            self.busy_seconds += busy
+            self.starved_seconds += starved
+            self.blocked_seconds += blocked
+            if queue_depth is not None:
+                self.queue_depth_total += queue_depth
+                self.queue_depth_samples += 1
+
+    def as_dict(self, elapsed_seconds: float) -> dict:
+        capacity = max(elapsed_seconds * self.workers, 1e-9)
+        return {
+            'workers': self.workers,
+            'items': self.items,
+            'busy_seconds': round(self.busy_seconds, 3),
+            'starved_seconds': round(self.starved_seconds, 3),
+            'blocked_seconds': round(self.blocked_seconds, 3),
+            'occupancy': round(self.busy_seconds / capacity, 3),
+            'mean_input_queue_depth': round(self.queue_depth_total / max(self.queue_depth_samples, 1), 2),
+        }
+
+
+class DocumentImageMemo:
+    """
+    Recognizes the source images repeated within a document, so only their first occurrence is processed.
+
+    Images are keyed by a hash of their encoded data and of what changes their processing (first page, first
+    image, image mode). The writer resolves a repeat to the segments of the first occurrence, which are only kept
+    for occurrences that have repeats. If the first occurrence was already written and released when a repeat is
+    extracted, the repeat is processed and becomes the occurrence later repeats refer to.
+    """
+
+    _NOT_WRITTEN = object()
+
+    def __init__(self):
+        self.repeats = 0
+        self._first: dict[bytes, int] = {}
+        self._retained: dict[int, object] = {}
+        self._released: set[int] = set()
+        self._lock = threading.Lock()
+
+    def register(self, item: PipelineItem, image_mode: str | None = None) -> int | None:
+        """Record the source image of an item. Returns the sequence of its first occurrence if it is a repeat."""
+        digest = hashlib.blake2b(item.source_data, digest_size=20)
+        digest.update(f'|{item.page_num == 0}|{item.sequence == 0}|{image_mode}'.encode())
+        key = digest.digest()
+        with self._lock:
+            original = self._first.get(key)
+            if original is None or original in self._released:
+                self._first[key] = item.sequence
+                return None
+            self._retained.setdefault(original, self._NOT_WRITTEN)
+            self.repeats += 1
+            return original
+
+    def written(self, sequence: int, segments: list[bytes] | None) -> None:
+        """Called by the writer for every item, with its segments or None if it failed."""
+        with self._lock:
+            if sequence in self._retained:
+                self._retained[sequence] = segments
+            else:
+                self._released.add(sequence)
+
+    def segments_of(self, original: int) -> list[bytes] | None:
+        """Segments of a first occurrence, already written since items are written in order. None if it failed."""
+        with self._lock:
+            return self._retained[original]
+
+
+class PipelineStopped(Exception):
+    """Raised inside a stage when the pipeline was stopped because another stage failed."""
+
+
+def _put(target_queue: queue.Queue, item, stop_event: threading.Event) -> float:
+    """Put an item on a bounded queue, waiting while it is full. Returns the seconds spent blocked."""
+    start = time.perf_counter()
+    while True:
+        if stop_event.is_set():
+            raise PipelineStopped()
+        try:
+            target_queue.put(item, timeout=0.1)
+            return time.perf_counter() - start
+        except queue.Full:
+            continue
+
+
+def _get(source_queue: queue.Queue, stop_event: threading.Event) -> tuple[object, float, int]:
+    """Get an item from a queue, waiting while it is empty. Returns the item, seconds starved and queue depth."""
+    start = time.perf_counter()
+    while True:
+        if stop_event.is_set():
+            raise PipelineStopped()
+        try:
+            depth = source_queue.qsize()
+            item = source_queue.get(timeout=0.1)
+            return item, time.perf_counter() - start, depth
+        except queue.Empty:
+            continue
+
+
+def _reserve_committed(item: PipelineItem, lease: BudgetLease, nbytes: int) -> None:
+    """Account memory an item is about to use without waiting, it already holds part of the budget."""
+    lease.acquire(nbytes, block=False)
+    item.reserved_bytes += nbytes
+
+
+def _settle_reservation(item: PipelineItem, lease: BudgetLease) -> None:
+    """Once an item is transformed, keep only the reservation of the split images it holds until encoding."""
+    images_bytes = sum(estimate_decoded_bytes(image.size, image.mode) for image in item.images)
+    if item.reserved_bytes > images_bytes:
+        lease.release(item.reserved_bytes - images_bytes)
+        item.reserved_bytes = images_bytes
+
+
+def transform_item(item: PipelineItem, image_mode: str | None = None, segment_cache: SegmentCache | None = None,
+                   drop_blank_pages: bool = DROP_BLANK_PAGES,
+                   decode_at_target_resolution: bool = DECODE_AT_TARGET_RESOLUTION,
+                   lease: BudgetLease | None = None, should_stop: Callable[[], bool] | None = None,
+                   series_pages: SeriesPages | None = None) -> None:
+    """
+    Decode the source image of an item, then split, crop and denoise it.
+
+    Sources whose segments are cached, and JPEG sources that need no processing at all, skip the image work
+    and the encode stage. Blank images are dropped, except the first one of the document.
+
+    With `decode_at_target_resolution`, oversized JPEG sources are decoded at the smallest DCT scale that still
+    covers the screen. Analysis and splitting run on that reduced image, and only regions too small to fill the
+    screen are cropped from the full resolution image.
+
+    With a memory budget `lease`, decoding waits until the estimated decoded size of the image fits in the budget,
+    or until `should_stop` returns True. The item keeps the reservation of its split images until they are encoded.
+
+    With `series_pages`, sources other than the first one (the cover) are looked up in the series page index
+    from a cheap perceptual hash, before the segment cache so that cached pages are indexed too. Pages seen in an
+    earlier volume (matches confirmed by their thumbnails) are skipped, or reuse the segments cached for the
+    earlier page when it was processed with the current settings, according to the policy of the index.
+    """
+    if series_pages is not None and item.sequence != 0:
+        with instrumentation.stage('page_hash'):
+            item.page_hashes, item.page_match = series_pages.match(item.source_data)
+        if item.page_match is not None and item.page_match.confirmed:
+            cached_segments = None
+            if series_pages.policy == 'reuse' and segment_cache is not None and item.page_match.segments_key:
+                cached_segments = segment_cache.get(item.page_match.segments_key)
+            if series_pages.policy == 'skip' or cached_segments is not None:
+                logger.info(f"Image {item.label} was seen in {item.page_match.volume}, "
+                            f"{'skipping' if cached_segments is None else 'reusing'} it.")
+                item.segments = cached_segments or []
+                item.segments_key = item.page_match.segments_key if cached_segments is not None else None
+                item.cache_key = None
+                item.source_data = None
+                item.completed = True
+                return
+
+    if segment_cache is not None:
+        item.cache_key = segment_cache.key_for(item.source_data, item.page_num, image_mode)
+        cached_segments = segment_cache.get(item.cache_key)
+        if cached_segments is not None:
+            item.segments = cached_segments
+            item.segments_key = item.cache_key
+            item.cache_key = None
+            item.source_data = None
+            item.completed = True
+            return
+
+    try:
+        with load_image_by_str_data(image_data=item.source_data) as image:
+            scale = 1.0
+            if decode_at_target_resolution:
+                scale = reduce_on_decode(image, (FINAL_DOCUMENT_WIDTH, FINAL_DOCUMENT_HEIGHT))
+            if lease is not None:
+                # Wait until the decoded image fits in the memory budget shared with the other documents
+                decoded_bytes = estimate_decoded_bytes(image.size, image.mode)
+                with instrumentation.stage('memory_wait'):
+                    admitted = lease.acquire(decoded_bytes, should_stop)
+                if not admitted:
+                    raise PipelineStopped()
+                item.reserved_bytes = decoded_bytes
+            with instrumentation.stage('decode'):
+                image.load()
+            # Every later decision reads from this single analysis of the image
+            with instrumentation.stage('analysis'):
+                analysis = analyze_page(image)
+            if drop_blank_pages and analysis.is_blank and item.sequence != 0:
+                logger.info(f"Image {item.label} is blank, dropping it.")
+                item.cache_key = None
+                item.source_data = None
+                item.completed = True
+                return
+            if scale == 1.0 and can_pass_through(image, item.page_num, analysis=analysis):
+                logger.info(f"Image {item.label} needs no processing, passing it through.")
+                item.segments = [item.source_data]
+                item.cache_key = None
+                item.source_data = None
+                item.completed = True
+                return
+            # Monochrome sources are carried as single channel images up to the JPEG encoding
+            monochrome = not analysis.is_colored
+            image = convert_for_processing(image, image_mode, monochrome=monochrome)
+            full_resolution = None
+            if scale > 1.0:
+                full_resolution = FullResolutionSource(
+                    item.source_data, image.size, scale,
+                    prepare=lambda full_image: convert_for_processing(full_image, image_mode, monochrome=monochrome),
+                    reserve=None if lease is None else lambda nbytes: _reserve_committed(item, lease, nbytes)
+                )
+            try:
+                item.images = split_and_crop_image(image, item.page_num, item.img_index, analysis, full_resolution)
+            finally:
+                if full_resolution is not None:
+                    full_resolution.close()
+            image.close()
+        # The encoded source is not needed anymore, release it as soon as possible
+        item.source_data = None
+    finally:
+        if lease is not None:
+            _settle_reservation(item, lease)
+
+
+def encode_item(item: PipelineItem, image_quality_: int = IMAGE_QUALITY, segment_cache: SegmentCache | None = None,
+                lease: BudgetLease | None = None) -> None:
+    """Encode every split image of an item as JPEG, storing the segments in the cache if needed."""
+    for split_image in item.images:
+        with instrumentation.stage('encode'):
+            item.segments.append(encode_image_to_jpeg(split_image, image_quality_))
+        split_image.close()
+    item.images = []
+    if lease is not None:
+        lease.release(item.reserved_bytes)
+        item.reserved_bytes = 0
+    if segment_cache is not None and item.cache_key is not None:
+        segment_cache.put(item.cache_key, item.segments)
+        item.segments_key = item.cache_key
+
+
+def run_manga_pipeline(
+        source: Iterable[tuple[int, int, str, bytes]],
+        write_segment: Callable[[bytes], None],
+        *,
+        image_mode: str | None = None,
+        image_quality_: int = IMAGE_QUALITY,
+        transform_workers: int = PAGE_WORKERS,
+        encode_workers: int = ENCODE_WORKERS,
+        queue_size: int = PIPELINE_QUEUE_SIZE,
+        segment_cache: SegmentCache | None = None,
+        checkpoint: DocumentCheckpoint | None = None,
+        after_item: Callable[[PipelineItem], None] | None = None,
+        memory_budget: MemoryBudget | None = None,
+        deduplicate_images: bool = DEDUPLICATE_IMAGES,
+        series_pages: SeriesPages | None = None
+) -> dict:
+    """
+    Run source images through bounded extract -> transform -> encode -> write stages.
+
+    The extract stage iterates `source` (page number, image index, label, encoded image) in its own thread,
+    so the next pages are read while previous ones are analysed. Transform and encode stages are thread
+    pools connected by queues of `queue_size` items. The writer runs in the calling thread and hands the
+    JPEG segments to `write_segment` in source and segment order.
+
+    The number of items between the extract stage and the writer is capped, so memory stays bounded
+    regardless of the document size.
+
+    :param source: Iterable of (page_num, img_index, label, image_data) tuples.
+    :param write_segment: Called with the JPEG bytes of every output segment, in order.
+    :param image_mode: PIL mode to convert decoded color images to, or None to keep their original mode.
+                       Monochrome images are processed as 'L' images when the grayscale pipeline is enabled.
+    :param image_quality_: JPEG quality of the encoded segments.
+    :param transform_workers: Threads decoding, splitting, cropping and denoising images.
+    :param encode_workers: Threads encoding split images as JPEG.
+    :param queue_size: Capacity of each queue between stages.
+    :param segment_cache: Optional cache of encoded segments, looked up before transforming each source image.
+    :param checkpoint: Optional checkpoint of the document. Items it lists as completed are read back from it
+                       instead of being processed, and every newly written item is recorded in it.
+    :param after_item: Optional callback invoked by the writer after each item has been written.
+    :param memory_budget: Optional budget of decoded image bytes, shared with the other documents being processed.
+                          Images are only decoded once their estimated size fits in it.
+    :param deduplicate_images: Process the images repeated within the document once, and write the segments of
+                               their first occurrence again for the repeats.
+    :param series_pages: Optional view of the series page index for the document. Pages seen in earlier volumes
+                         are handled according to its policy, and every written page is recorded in it.
+    :return: The occupancy report of each stage.
+    """
+    # Pages are reported to the file processed by the calling thread, the writer
+    file_instrumentation = instrumentation.current_file()
+    transform_workers = max(1, transform_workers)
+    encode_workers = max(1, encode_workers)
+    queue_size = max(1, queue_size)
+
+    transform_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+    encode_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+    write_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+    stop_event = threading.Event()
+    lease = BudgetLease(memory_budget) if memory_budget is not None else None
+    memo = DocumentImageMemo() if deduplicate_images else None
+    # Caps items between extraction and writing, including the ones waiting for reordering in the writer
+    in_flight = threading.BoundedSemaphore(2 * queue_size + transform_workers + encode_workers)
+
+    stats = {
+        'extract': StageStats('extract', 1),
+        'transform': StageStats('transform', transform_workers),
+        'encode': StageStats('encode', encode_workers),
+        'write': StageStats('write', 1),
+    }
+    failures: list[BaseException] = []
+    remaining_workers = {'transform': transform_workers, 'encode': encode_workers}
+    remaining_lock = threading.Lock()
+
+    def extract_stage():
+        try:
+            sequence = 0
+            source_iterator = iter(source)
+            while True:
+                while not in_flight.acquire(timeout=0.1):
+                    if stop_event.is_set():
+                        raise PipelineStopped()
+                start = time.perf_counter()
+                try:
+                    page_num, img_index, label, image_data = next(source_iterator)
+                except StopIteration:
+                    in_flight.release()
+                    break
+                item = PipelineItem(sequence, page_num, img_index, label, source_data=image_data,
+                                    bytes_in=len(image_data))
+                item.timings['extraction'] = time.perf_counter() - start
+                if memo is not None:
+                    item.duplicate_of = memo.register(item, image_mode)
+                    if item.duplicate_of is not None:
+                        item.source_data = None
+                        item.completed = True
+                if checkpoint is not None:
+                    resumed_segments = checkpoint.completed_segments(sequence, page_num, img_index)
+                    if resumed_segments is not None:
+                        if series_pages is not None and sequence != 0:
+                            # Resumed pages are not transformed, they are hashed here to be indexed with the others
+                            with instrumentation.recording(item.timings), instrumentation.stage('page_hash'):
+                                item.page_hashes, item.page_match = series_pages.match(image_data)
+                        item.segments = resumed_segments
+                        item.source_data = None
+                        item.completed = item.resumed = True
+                busy = time.perf_counter() - start
+                blocked = _put(transform_queue, item, stop_event)
+                stats['extract'].record(busy, blocked=blocked)
+                sequence += 1
+            for _ in range(transform_workers):
+                _put(transform_queue, _END_OF_STREAM, stop_event)
+        except PipelineStopped:
+            pass
+        except BaseException as e:
+            failures.append(e)
+            stop_event.set()
+
+    def worker_stage(name: str, input_queue: queue.Queue, output_queue: queue.Queue, downstream_workers: int,
+                     work: Callable[[PipelineItem], None]):
+        try:
+            while True:
+                item, starved, depth = _get(input_queue, stop_event)
+                if item is _END_OF_STREAM:
+                    break
+                start = time.perf_counter()
+                if item.error is None and not item.completed:
+                    try:
+                        with instrumentation.recording(item.timings):
+                            work(item)
+                    except Exception as e:
+                        item.error = e
+                busy = time.perf_counter() - start
+                blocked = _put(output_queue, item, stop_event)
+                stats[name].record(busy, starved, blocked, depth)
+            with remaining_lock:
+                remaining_workers[name] -= 1
+                last_worker = remaining_workers[name] == 0
+            if last_worker:
+                for _ in range(downstream_workers):
+                    _put(output_queue, _END_OF_STREAM, stop_event)
+        except PipelineStopped:
+            pass
+        except BaseException as e:
+            failures.append(e)
+            stop_event.set()
+
+    threads = [threading.Thread(target=extract_stage, name='pipeline_extract', daemon=True)]
+    threads += [
+        threading.Thread(
+            target=worker_stage, name=f'pipeline_transform_{i}', daemon=True,
+            args=('transform', transform_queue, encode_queue, encode_workers,
+                  lambda item: transform_item(item, image_mode, segment_cache, lease=lease,
+                                              should_stop=stop_event.is_set, series_pages=series_pages))
+        )
+        for i in range(transform_workers)
+    ]
+    threads += [
+        threading.Thread(
+            target=worker_stage, name=f'pipeline_encode_{i}', daemon=True,
+            args=('encode', encode_queue, write_queue, 1,
+                  lambda item: encode_item(item, image_quality_, segment_cache, lease))
+        )
+        for i in range(encode_workers)
+    ]
+
+    start_time = time.perf_counter()
+    for thread in threads:
+        thread.start()
+
+    # Single ordered writer: items may finish out of order, they are buffered until their turn comes
+    pending: dict[int, PipelineItem] = {}
+    next_sequence = 0
+    try:
+        while True:
+            item, starved, depth = _get(write_queue, stop_event)
+            if item is _END_OF_STREAM:
+                break
+            pending[item.sequence] = item
+            while next_sequence in pending:
+                ready = pending.pop(next_sequence)
+                start = time.perf_counter()
+                if ready.duplicate_of is not None and not ready.resumed:
+                    ready.segments = memo.segments_of(ready.duplicate_of)
+                    if ready.segments is None:
+                        ready.segments = []
+                        ready.error = RuntimeError('the first occurrence of this repeated image failed')
+                if memo is not None:
+                    memo.written(ready.sequence, None if ready.error is not None else ready.segments)
+                if ready.error is not None:
+                    logger.error(f"Error processing image {ready.label}: {ready.error}")
+                else:
+                    for segment in ready.segments:
+                        write_segment(segment)
+                    if checkpoint is not None and not ready.resumed:
+                        checkpoint.record(ready.sequence, ready.page_num, ready.img_index, ready.segments,
+                                          ready.segments_key)
+                    if series_pages is not None and ready.page_hashes is not None:
+                        series_pages.record(ready.sequence, ready.page_hashes, ready.page_match, ready.segments_key)
+                if file_instrumentation is not None:
+                    ready.timings['write'] = time.perf_counter() - start
+                    file_instrumentation.record_page(
+                        sequence=ready.sequence, page_num=ready.page_num, img_index=ready.img_index,
+                        label=ready.label, timings=ready.timings, bytes_in=ready.bytes_in,
+                        bytes_out=sum(len(segment) for segment in ready.segments), segments=len(ready.segments),
+                        resumed=ready.resumed, error=None if ready.error is None else str(ready.error)
+                    )
+                ready.segments = []
+                if after_item is not None:
+                    after_item(ready)
+                stats['write'].record(time.perf_counter() - start, starved, queue_depth=depth)
+                starved = 0.0
+                next_sequence += 1
+                in_flight.release()
+    except PipelineStopped:
+        pass
+    except BaseException:
+        stop_event.set()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+        if lease is not None:
+            # Give back the reservations of items dropped when the pipeline stopped
+            lease.close()
+
+    if failures:
+        raise failures[0]
+
+    elapsed_seconds = time.perf_counter() - start_time
+    report = {name: stage.as_dict(elapsed_seconds) for name, stage in stats.items()}
+    if lease is not None:
+        report['memory_budget'] = {'waited_seconds': round(lease.waited_seconds, 3)}
+    if memo is not None:
+        report['repeated_images'] = memo.repeats
+    bottleneck = max(stats, key=lambda name: report[name]['occupancy'])
+    logger.info(f"Pipeline finished in {elapsed_seconds:.2f}s, bottleneck stage: {bottleneck}. Stages: {report}")
+    return report
@@ -1,9 +1,13 @@
 import logging
 import os
+import time
 
-from common.epub_operations import convert_pdf_to_epub
-from common.files_operations import get_file_size
-from settings import file_size_comparison, CREATE_EPUB_FILES
+import fitz  # PyMuPDF
+
+from common.files_operations import get_file_size, is_archive_file
+from common.processing_results import FileProcessingResult
+from common.pymupdf_access import PYMUPDF_LOCK
+from settings import CREATE_EPUB_FILES
 from manga_manager.manga_pdf_operations import split_crop_save_images_to_pdf
 from manga_manager.manga_str_operations import (
     extract_manga_name,
@@ -13,16 +17,25 @@ from manga_manager.manga_str_operations import (
 logger = logging.getLogger('_books_manager_')
 
 
-def process_manga(file_path: str, destiny_folder_path: str) -> None:
-    try:
-        # Create output folder path, file name and extracts manga name from file name
-        file_name_with_extension = os.path.basename(file_path)
+def process_manga(file_path: str, destiny_folder_path: str, doc: fitz.Document | None = None) -> FileProcessingResult:
+    """
+    Process a PDF file, a CBZ/ZIP archive or a folder of images considered as a manga.
 
-        # Extract the manga name from the file name or folder name
-        manga_name = extract_manga_name(file_name_with_extension.replace('.pdf', ''))
+    :param file_path: Path to the input PDF file, CBZ/ZIP archive or folder of images.
+    :param destiny_folder_path: Path to the output folder where the processed manga will be saved.
+    :param doc: The input PDF already opened, to avoid parsing it again. It is closed before the input is deleted.
+    :return: The sizes, timing and error (if any) of the processed manga.
+    """
+    start_time = time.perf_counter()
+    # Create output folder path, file name and extracts manga name from file name
+    file_name_with_extension = os.path.basename(file_path)
 
+    # Extract the manga name from the file name or folder name
+    manga_name = extract_manga_name(file_name_with_extension.replace('.pdf', ''))
+    result = FileProcessingResult(file_path=file_path, name=manga_name, kind='manga')
+    try:
         # Record the original file size for comparison
-        file_size_comparison[f'{manga_name} original'] = file_size_comparison.get(f'{manga_name} original', 0) + get_file_size(file_path)
+        result.original_size = get_file_size(file_path)
 
         # Handle explicit content by placing it in a separate folder
         if has_explicit_content(file_name_with_extension):
@@ -32,6 +45,11 @@ def process_manga(file_path: str, destiny_folder_path: str) -> None:
 
         # Create the new PDF path (can be the same for both PDFs and images converted to PDFs)
         new_pdf_path = os.path.join(output_folder_path, file_name_with_extension)
+        if is_archive_file(file_path):
+            new_pdf_path = f'{os.path.splitext(new_pdf_path)[0]}.pdf'
+        elif not new_pdf_path.lower().endswith('.pdf'):
+            # Folders of images have no extension, the EPUB path must not collide with the PDF one
+            new_pdf_path = f'{new_pdf_path}.pdf'
 
         # Create output folders if they don't exist
         os.makedirs(output_folder_path, exist_ok=True)
@@ -39,11 +57,24 @@ def process_manga(file_path: str, destiny_folder_path: str) -> None:
         logger.info(f'Starting image extraction and processing for {file_name_with_extension}')
 
         # Extract, split, crop images from the PDF or folder of images, and save them as a new PDF
-        split_crop_save_images_to_pdf(
+        # The EPUB, if requested, is written from the same processed segments as the PDF
+        result.pages, result.output_pages = split_crop_save_images_to_pdf(
             input_path=file_path,  # Can be a PDF file or a folder containing images
             new_pdf_path=new_pdf_path,
+            doc=doc,
+            epub_path=f'{os.path.splitext(new_pdf_path)[0]}.epub' if CREATE_EPUB_FILES else None,
+            series_name=manga_name,
         )
 
+        # The output is committed atomically, keep the original if it was not produced
+        if not os.path.isfile(new_pdf_path):
+            raise RuntimeError(f'Output {new_pdf_path} was not created, keeping the original {file_path}.')
+
+        # Release the input before deleting it, open files cannot be removed on Windows
+        if doc is not None:
+            with PYMUPDF_LOCK:
+                doc.close()
+
         # Clean up: delete original file (PDF or folder)
         if os.path.isfile(file_path):
             os.remove(file_path)
@@ -52,13 +83,14 @@ def process_manga(file_path: str, destiny_folder_path: str) -> None:
                 os.remove(os.path.join(file_path, file))
             os.rmdir(file_path)
 
-        if CREATE_EPUB_FILES:
-            convert_pdf_to_epub(new_pdf_path, new_pdf_path.replace('.pdf', '.epub'))
-
         # Update the new file size for comparison
-        file_size_comparison[f'{manga_name} new'] = file_size_comparison.get(f'{manga_name} new', 0) + get_file_size(new_pdf_path)
+        result.new_size = get_file_size(new_pdf_path)
 
         logger.info(f'Successfully processed {file_name_with_extension} and cleaned up temporary files.')
 
     except Exception as e:
         logger.error(f'Error processing {file_path}: {e}', exc_info=True)
+        result.error = str(e)
+
+    result.elapsed_seconds = time.perf_counter() - start_time
+    return result
@@ -0,0 +1,209 @@
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from settings import (
+    BLANK_PAGE_CONTENT_RATIO,
+    DECODE_AT_TARGET_RESOLUTION,
+    DENOISE_MODE,
+    DROP_BLANK_PAGES,
+    FINAL_DOCUMENT_WIDTH,
+    FINAL_DOCUMENT_HEIGHT,
+    IMAGE_QUALITY,
+    NOISE_ESTIMATION_MAX_SIDE,
+    NOISE_THRESHOLD,
+    SATURATION_FACTOR,
+    USE_GRAYSCALE_PIPELINE,
+    USE_SATURATION_FILTER,
+    USE_SEGMENT_CACHE,
+    SEGMENT_CACHE_FOLDER_PATH,
+    SEGMENT_CACHE_MAX_SIZE_MB
+)
+
+logger = logging.getLogger('_books_manager_')
+
+# File of an entry holding its number of segments, written last: an entry without it is incomplete
+MANIFEST_NAME = 'segments'
+# Temporary folders older than this were left by a crashed run, they are removed on eviction
+STALE_TEMP_SECONDS = 3600
+
+
+def processing_settings_fingerprint() -> str:
+    """
+    Build a string with every setting that changes the encoded output of a source image.
+
+    Changing any of them invalidates the cached segments.
+    """
+    return '|'.join(str(value) for value in (
+        FINAL_DOCUMENT_WIDTH,
+        FINAL_DOCUMENT_HEIGHT,
+        IMAGE_QUALITY,
+        USE_SATURATION_FILTER,
+        SATURATION_FACTOR,
+        NOISE_THRESHOLD,
+        NOISE_ESTIMATION_MAX_SIDE,
+        DENOISE_MODE,
+        USE_GRAYSCALE_PIPELINE,
+        DROP_BLANK_PAGES,
+        BLANK_PAGE_CONTENT_RATIO,
+        DECODE_AT_TARGET_RESOLUTION,
+    ))
+
+
+class SegmentCache:
+    """
+    On-disk, content-addressed cache of the encoded segments produced for a source image.
+
+    Each entry is a folder named after the key, holding one JPEG file per segment and a manifest with their
+    count. Entries are written to a temporary folder and renamed into place, and evicted entries are renamed to a
+    temporary folder before being deleted, so readers never see a partial entry. An entry whose manifest is
+    missing or does not match its segments is a miss. Reading an entry refreshes its modification time, which is
+    used to evict the least recently used entries once the cache grows over its size cap.
+    """
+
+    def __init__(self, folder_path: str = SEGMENT_CACHE_FOLDER_PATH, max_size_mb: int = SEGMENT_CACHE_MAX_SIZE_MB):
+        self.folder_path = os.path.abspath(folder_path)
+        self.max_size_bytes = max_size_mb * 1024 * 1024
+        self._total_size: int | None = None
+        self._lock = threading.Lock()
+        os.makedirs(self.folder_path, exist_ok=True)
+
+    def key_for(self, source_data: bytes, page_num: int, image_mode: str | None = None) -> str:
+        """
+        Compute the key of a source image for the current settings.
+
+        The first page of a document is never split, so whether the image is a first page is part of the key.
+        """
+        digest = hashlib.blake2b(source_data, digest_size=20)
+        digest.update(f'|{processing_settings_fingerprint()}|{page_num == 0}|{image_mode}'.encode())
+        return digest.hexdigest()
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.folder_path, key[:2], key)
+
+    def get(self, key: str) -> list[bytes] | None:
+        """Return the cached segments of a key in segment order, or None on a cache miss."""
+        entry_path = self._entry_path(key)
+        try:
+            with open(os.path.join(entry_path, MANIFEST_NAME)) as manifest_handler:
+                segment_count = int(manifest_handler.read())
+            segments = []
+            for segment_index in range(segment_count):
+                with open(os.path.join(entry_path, f'{segment_index}.jpg'), 'rb') as segment_handler:
+                    segments.append(segment_handler.read())
+            # Mark the entry as recently used
+            os.utime(entry_path)
+        except (FileNotFoundError, NotADirectoryError, ValueError):
+            return None
+        logger.info(f"Segment cache hit for {key}.")
+        return segments
+
+    def put(self, key: str, segments: list[bytes]) -> None:
+        """Store the encoded segments of a key, evicting old entries if the cache grows over its cap."""
+        entry_path = self._entry_path(key)
+        if os.path.isfile(os.path.join(entry_path, MANIFEST_NAME)):
+            return
+        if os.path.isdir(entry_path):
+            # Entry of an older version of the cache, without manifest
+            self._discard(entry_path)
+        temp_path = self._temp_path()
+        try:
+            os.makedirs(temp_path)
+            for segment_index, segment in enumerate(segments):
+                with open(os.path.join(temp_path, f'{segment_index}.jpg'), 'wb') as segment_handler:
+                    segment_handler.write(segment)
+            with open(os.path.join(temp_path, MANIFEST_NAME), 'w') as manifest_handler:
+                manifest_handler.write(str(len(segments)))
+            os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+            os.rename(temp_path, entry_path)
+        except OSError as e:
+            # Another worker may have stored the same entry first
+            shutil.rmtree(temp_path, ignore_errors=True)
+            if not os.path.isdir(entry_path):
+                logger.error(f"Error storing segments in cache for {key}: {e}")
+            return
+
+        with self._lock:
+            if self._total_size is None:
+                self._total_size = self._scan()[0]
+            else:
+                self._total_size += sum(len(segment) for segment in segments)
+            if self._total_size > self.max_size_bytes:
+                self._evict()
+
+    def _temp_path(self) -> str:
+        return os.path.join(self.folder_path, f'.tmp_{uuid.uuid4().hex}')
+
+    def _discard(self, entry_path: str) -> bool:
+        """
+        Remove an entry, renaming it out of place first so no reader sees it partially deleted.
+
+        Returns False if the entry was already gone, removed by another worker.
+        """
+        temp_path = self._temp_path()
+        try:
+            os.rename(entry_path, temp_path)
+        except FileNotFoundError:
+            return False
+        shutil.rmtree(temp_path, ignore_errors=True)
+        return True
+
+    def _remove_stale_temp_folders(self) -> None:
+        """Remove the temporary folders left by runs that crashed while storing or evicting an entry."""
+        now = time.time()
+        for entry in os.scandir(self.folder_path):
+            try:
+                if entry.name.startswith('.tmp_') and now - entry.stat().st_mtime > STALE_TEMP_SECONDS:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+            except FileNotFoundError:
+                continue
+
+    def _scan(self) -> tuple[int, list[tuple[float, int, str]]]:
+        """Return the total size of the cache and its entries as (mtime, size, path)."""
+        total_size = 0
+        entries = []
+        for prefix_entry in os.scandir(self.folder_path):
+            if not prefix_entry.is_dir() or prefix_entry.name.startswith('.tmp_'):
+                continue
+            for entry in os.scandir(prefix_entry.path):
+                try:
+                    entry_size = sum(segment.stat().st_size for segment in os.scandir(entry.path))
+                    entries.append((entry.stat().st_mtime, entry_size, entry.path))
+                    total_size += entry_size
+                except FileNotFoundError:
+                    continue
+        return total_size, entries
+
+    def _evict(self) -> None:
+        """Remove the least recently used entries until the cache is under 90% of its cap."""
+        total_size, entries = self._scan()
+        target_size = self.max_size_bytes * 0.9
+        evicted = 0
+        for _, entry_size, entry_path in sorted(entries):
+            if total_size <= target_size:
+                break
+            if self._discard(entry_path):
+                evicted += 1
+            total_size -= entry_size
+        self._total_size = total_size
+        self._remove_stale_temp_folders()
+        logger.info(f"Evicted {evicted} entries from the segment cache.")
+
+
+_segment_cache: SegmentCache | None = None
+_segment_cache_lock = threading.Lock()
+
+
+def get_segment_cache() -> SegmentCache | None:
+    """Return the process-wide segment cache, or None when it is disabled."""
+    global _segment_cache
+    if not USE_SEGMENT_CACHE:
+        return None
+    with _segment_cache_lock:
+        if _segment_cache is None:
+            _segment_cache = SegmentCache()
+        return _segment_cache
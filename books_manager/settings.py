@@ -1,3 +1,4 @@
+import logging
 import os
 
 from dotenv import load_dotenv
@@ -8,6 +9,9 @@ load_dotenv()
 # Define image extensions
 IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tiff', '.bmp')
 
+# Comic book archives read as mangas (RAR based .cbr/.rar archives are not supported)
+ARCHIVE_EXTENSIONS = ('.cbz', '.zip')
+
 
 # Function to safely retrieve and cast environment variables with default values
 def get_env_var(var_name: str, default: str, cast_type: type):
@@ -24,6 +28,21 @@ NOISE_THRESHOLD: int = get_env_var('NOISE_THRESHOLD', '10', int)
 
 TEXT_THRESHOLD: int = get_env_var('TEXT_THRESHOLD', '100', int)
 
+# Denoising: 'quality', 'balanced' or 'fast' trade output quality for speed
+DENOISE_MODE: str = get_env_var('DENOISE_MODE', 'balanced', str).strip().lower()
+if DENOISE_MODE not in ('quality', 'balanced', 'fast'):
+    raise ValueError(f"Invalid DENOISE_MODE '{DENOISE_MODE}'. Expected 'quality', 'balanced' or 'fast'.")
+# Threads denoising the strips of a large image, and pixels above which an image is split in strips
+DENOISE_THREADS: int = max(1, get_env_var('DENOISE_THREADS', '2', int))
+DENOISE_TILE_PIXELS: int = max(1, get_env_var('DENOISE_TILE_PIXELS', '262144', int))
+# Longest side of the downsampled copy used to estimate the noise of an image
+NOISE_ESTIMATION_MAX_SIDE: int = max(16, get_env_var('NOISE_ESTIMATION_MAX_SIDE', '1024', int))
+
+# Pages sampled to classify a PDF as book or manga, file where the verdicts are cached and verdicts kept in it
+CLASSIFICATION_SAMPLE_PAGES: int = max(1, get_env_var('CLASSIFICATION_SAMPLE_PAGES', '8', int))
+CLASSIFICATION_CACHE_PATH: str = get_env_var('CLASSIFICATION_CACHE_PATH', '../books/.classification_cache.json', str)
+CLASSIFICATION_CACHE_MAX_ENTRIES: int = max(1, get_env_var('CLASSIFICATION_CACHE_MAX_ENTRIES', '1000', int))
+
 # Access the environment variables with fallback/default values
 INPUT_MANGAS_FOLDER_PATH: str = get_env_var('INPUT_MANGAS_FOLDER_PATH', '../books/pending_to_process', str)
 OUTPUT_MANGAS_FOLDER_PATH: str = get_env_var('OUTPUT_MANGAS_FOLDER_PATH', '../books/', str)
@@ -39,21 +58,170 @@ USE_SATURATION_FILTER: bool = (
 )
 SATURATION_FACTOR: float = get_env_var('SATURATION_FACTOR', '1.5', float)
 
+# Process monochrome pages as single channel images and write them as grayscale JPEGs
+USE_GRAYSCALE_PIPELINE: bool = (
+    os.getenv('USE_GRAYSCALE_PIPELINE', 'true').strip().lower() in ['true', '1', 't', 'y', 'yes']
+)
+
+# Drop pages whose share of pixels differing from the page background is under BLANK_PAGE_CONTENT_RATIO
+DROP_BLANK_PAGES: bool = (
+    os.getenv('DROP_BLANK_PAGES', 'false').strip().lower() in ['true', '1', 't', 'y', 'yes']
+)
+BLANK_PAGE_CONTENT_RATIO: float = get_env_var('BLANK_PAGE_CONTENT_RATIO', '0.002', float)
+
+# Decode oversized JPEG pages at a reduced size close to the screen, full resolution only where it is needed
+DECODE_AT_TARGET_RESOLUTION: bool = (
+    os.getenv('DECODE_AT_TARGET_RESOLUTION', 'true').strip().lower() in ['true', '1', 't', 'y', 'yes']
+)
+
 # Control creating extra epub file version
 CREATE_EPUB_FILES: bool = (
     os.getenv('CREATE_EPUB_FILES', 'false').strip().lower() in ['true', '1', 't', 'y', 'yes']
 )
 
-# Initialize a dictionary for file size comparison
-file_size_comparison: dict[str, int] = {}
+# Deflate level (0-9) of the XHTML and metadata entries of EPUB files, images are always stored as-is
+EPUB_COMPRESSION_LEVEL: int = min(9, max(0, get_env_var('EPUB_COMPRESSION_LEVEL', '6', int)))
+
+# Book optimization: garbage-collected, deflated and deduplicated output, embedded images downsampled to the
+# resolution they are displayed at on the screen (times BOOK_IMAGE_RESOLUTION_FACTOR, to leave room for zoom)
+OPTIMIZE_BOOKS: bool = (
+    os.getenv('OPTIMIZE_BOOKS', 'true').strip().lower() in ['true', '1', 't', 'y', 'yes']
+)
+BOOK_IMAGE_RESOLUTION_FACTOR: float = get_env_var('BOOK_IMAGE_RESOLUTION_FACTOR', '1.5', float)
+# Remove the text and drawings hidden by the margin crop instead of only hiding them (images are kept whole)
+REMOVE_CONTENT_OUTSIDE_CROP: bool = (
+    os.getenv('REMOVE_CONTENT_OUTSIDE_CROP', 'false').strip().lower() in ['true', '1', 't', 'y', 'yes']
+)
+
+# Control how files are processed concurrently: 'thread' (shared memory, good for small machines)
+# or 'process' (one interpreter per worker, avoids the GIL on CPU heavy image processing)
+EXECUTION_MODE: str = get_env_var('EXECUTION_MODE', 'thread', str).strip().lower()
+if EXECUTION_MODE not in ('thread', 'process'):
+    raise ValueError(f"Invalid EXECUTION_MODE '{EXECUTION_MODE}'. Expected 'thread' or 'process'.")
+
+# Recycle each worker process after this many files to contain memory growth (0 disables recycling)
+MAX_FILES_PER_WORKER: int = get_env_var('MAX_FILES_PER_WORKER', '0', int)
+
+# Number of threads processing the pages of a single document, independent of the file-level workers
+PAGE_WORKERS: int = max(1, get_env_var('PAGE_WORKERS', '2', int))
+
+# Number of threads encoding the split pages of a single document as JPEG
+ENCODE_WORKERS: int = max(1, get_env_var('ENCODE_WORKERS', '1', int))
+
+# Budget, in MB, of the decoded images held at once by all the documents being processed (0 disables it).
+# Pages wait to be decoded while their estimated size (width x height x channels) does not fit in it
+MAX_MEMORY_MB: int = max(0, get_env_var('MAX_MEMORY_MB', '1024', int))
+
+# Capacity of the queues between pipeline stages, bounds the pages held in memory per document
+PIPELINE_QUEUE_SIZE: int = max(1, get_env_var('PIPELINE_QUEUE_SIZE', '4', int))
+
+# Backend writing the output PDF: 'reportlab' or 'pymupdf' (embeds the encoded JPEGs as-is)
+PDF_WRITER_BACKEND: str = get_env_var('PDF_WRITER_BACKEND', 'reportlab', str).strip().lower()
+if PDF_WRITER_BACKEND not in ('reportlab', 'pymupdf'):
+    raise ValueError(f"Invalid PDF_WRITER_BACKEND '{PDF_WRITER_BACKEND}'. Expected 'reportlab' or 'pymupdf'.")
+
+# Process images repeated within a document (same data, e.g. watermarks or credit pages) once and reuse the result
+DEDUPLICATE_IMAGES: bool = (
+    os.getenv('DEDUPLICATE_IMAGES', 'true').strip().lower() in ['true', '1', 't', 'y', 'yes']
+)
+
+# Cache the encoded segments of every source image on disk, so re-processing a volume skips the image work
+USE_SEGMENT_CACHE: bool = (
+    os.getenv('USE_SEGMENT_CACHE', 'true').strip().lower() in ['true', '1', 't', 'y', 'yes']
+)
+SEGMENT_CACHE_FOLDER_PATH: str = get_env_var('SEGMENT_CACHE_FOLDER_PATH', '../books/.segments_cache', str)
+SEGMENT_CACHE_MAX_SIZE_MB: int = get_env_var('SEGMENT_CACHE_MAX_SIZE_MB', '2048', int)
+
+# Index of the perceptual hashes of the pages of every series, to recognize the pages seen in earlier volumes
+# (credits, recruitment and ad pages): 'off', 'keep' (only index them), 'reuse' (write the segments cached for
+# the earlier page) or 'skip' (leave them out of the output). Reusing and skipping pages is opt-in.
+SERIES_PAGE_INDEX_POLICY: str = get_env_var('SERIES_PAGE_INDEX_POLICY', 'keep', str).strip().lower()
+if SERIES_PAGE_INDEX_POLICY not in ('off', 'keep', 'reuse', 'skip'):
+    raise ValueError(f"Invalid SERIES_PAGE_INDEX_POLICY '{SERIES_PAGE_INDEX_POLICY}'. "
+                     f"Expected 'off', 'keep', 'reuse' or 'skip'.")
+SERIES_PAGE_INDEX_PATH: str = get_env_var('SERIES_PAGE_INDEX_PATH', '../books/.series_pages.sqlite3', str)
+# Bits, out of 256, in which the detailed hashes of two pages may differ for them to be the same page
+SERIES_PAGE_INDEX_MAX_DISTANCE: int = get_env_var('SERIES_PAGE_INDEX_MAX_DISTANCE', '10', int)
+# Largest brightness difference of a cell of the 32x32 thumbnails of two matched pages for the match to be
+# confirmed, only confirmed matches are reused or skipped
+SERIES_PAGE_INDEX_MAX_CELL_DIFFERENCE: int = get_env_var('SERIES_PAGE_INDEX_MAX_CELL_DIFFERENCE', '8', int)
+
+# Record completed pages of in-progress documents, so an interrupted run resumes where it stopped
+USE_CHECKPOINTS: bool = (
+    os.getenv('USE_CHECKPOINTS', 'true').strip().lower() in ['true', '1', 't', 'y', 'yes']
+)
+
+# Watch mode (main.py --watch): interval between scans of the input folder, and seconds an input must stay
+# unchanged before it is processed, so files still being copied are not picked up
+WATCH_POLL_SECONDS: float = max(0.1, get_env_var('WATCH_POLL_SECONDS', '2', float))
+WATCH_SETTLE_SECONDS: float = max(0.0, get_env_var('WATCH_SETTLE_SECONDS', '5', float))
+
+# Record per-file and per-page stage timings, sizes and memory as a JSON-lines event stream and a run summary
+USE_INSTRUMENTATION: bool = (
+    os.getenv('USE_INSTRUMENTATION', 'false').strip().lower() in ['true', '1', 't', 'y', 'yes']
+)
+INSTRUMENTATION_EVENTS_PATH: str = get_env_var('INSTRUMENTATION_EVENTS_PATH', '../books/.run_events.jsonl', str)
+INSTRUMENTATION_SUMMARY_PATH: str = get_env_var('INSTRUMENTATION_SUMMARY_PATH', '../books/.run_summary.json', str)
+
+# History of every processed file (sizes, pages, time) across runs, to follow compression and throughput per series
+USE_RUN_STATISTICS: bool = (
+    os.getenv('USE_RUN_STATISTICS', 'true').strip().lower() in ['true', '1', 't', 'y', 'yes']
+)
+RUN_STATISTICS_PATH: str = get_env_var('RUN_STATISTICS_PATH', '../books/.run_statistics.sqlite3', str)
+# Files of earlier runs a series is compared with, and worsening (0.2 = 20%) reported as a regression
+RUN_STATISTICS_HISTORY_FILES: int = max(1, get_env_var('RUN_STATISTICS_HISTORY_FILES', '20', int))
+RUN_STATISTICS_REGRESSION_TOLERANCE: float = get_env_var('RUN_STATISTICS_REGRESSION_TOLERANCE', '0.2', float)
+
+# Log loaded configuration
+def log_configuration() -> None:
+    """
+    Log the loaded configuration. Called by the entry point, importing the settings has no side effect.
 
-# Log loaded configuration (optional)
-print(f"Loaded configuration:\n"
-      f"  INPUT_MANGAS_FOLDER_PATH: {INPUT_MANGAS_FOLDER_PATH}\n"
-      f"  OUTPUT_MANGAS_FOLDER_PATH: {OUTPUT_MANGAS_FOLDER_PATH}\n"
-      f"  NOISE_THRESHOLD: {NOISE_THRESHOLD}\n"
-      f"  FINAL_DOCUMENT_WIDTH: {FINAL_DOCUMENT_WIDTH}\n"
-      f"  FINAL_DOCUMENT_HEIGHT: {FINAL_DOCUMENT_HEIGHT}\n"
-      f"  IMAGE_QUALITY: {IMAGE_QUALITY}\n"
-      f"  USE_SATURATION_FILTER: {USE_SATURATION_FILTER}\n"
-      f"  SATURATION_FACTOR: {SATURATION_FACTOR}\n")
+    It is logged at the level of the logger, never below INFO, so a log configured for errors only still records
+    the configuration of every run.
+    """
+    logger = logging.getLogger('_books_manager_')
+    logger.log(
+        max(logging.INFO, logger.getEffectiveLevel()),
+        f"Loaded configuration:\n"
+        f"  INPUT_MANGAS_FOLDER_PATH: {INPUT_MANGAS_FOLDER_PATH}\n"
+        f"  OUTPUT_MANGAS_FOLDER_PATH: {OUTPUT_MANGAS_FOLDER_PATH}\n"
+        f"  NOISE_THRESHOLD: {NOISE_THRESHOLD}\n"
+        f"  DENOISE_MODE: {DENOISE_MODE}\n"
+        f"  CLASSIFICATION_SAMPLE_PAGES: {CLASSIFICATION_SAMPLE_PAGES}\n"
+        f"  CLASSIFICATION_CACHE_MAX_ENTRIES: {CLASSIFICATION_CACHE_MAX_ENTRIES}\n"
+        f"  FINAL_DOCUMENT_WIDTH: {FINAL_DOCUMENT_WIDTH}\n"
+        f"  FINAL_DOCUMENT_HEIGHT: {FINAL_DOCUMENT_HEIGHT}\n"
+        f"  IMAGE_QUALITY: {IMAGE_QUALITY}\n"
+        f"  OPTIMIZE_BOOKS: {OPTIMIZE_BOOKS}\n"
+        f"  BOOK_IMAGE_RESOLUTION_FACTOR: {BOOK_IMAGE_RESOLUTION_FACTOR}\n"
+        f"  REMOVE_CONTENT_OUTSIDE_CROP: {REMOVE_CONTENT_OUTSIDE_CROP}\n"
+        f"  USE_SATURATION_FILTER: {USE_SATURATION_FILTER}\n"
+        f"  SATURATION_FACTOR: {SATURATION_FACTOR}\n"
+        f"  USE_GRAYSCALE_PIPELINE: {USE_GRAYSCALE_PIPELINE}\n"
+        f"  DROP_BLANK_PAGES: {DROP_BLANK_PAGES}\n"
+        f"  DECODE_AT_TARGET_RESOLUTION: {DECODE_AT_TARGET_RESOLUTION}\n"
+        f"  EXECUTION_MODE: {EXECUTION_MODE}\n"
+        f"  MAX_FILES_PER_WORKER: {MAX_FILES_PER_WORKER}\n"
+        f"  PAGE_WORKERS: {PAGE_WORKERS}\n"
+        f"  ENCODE_WORKERS: {ENCODE_WORKERS}\n"
+        f"  MAX_MEMORY_MB: {MAX_MEMORY_MB}\n"
+        f"  PIPELINE_QUEUE_SIZE: {PIPELINE_QUEUE_SIZE}\n"
+        f"  PDF_WRITER_BACKEND: {PDF_WRITER_BACKEND}\n"
+        f"  DEDUPLICATE_IMAGES: {DEDUPLICATE_IMAGES}\n"
+        f"  USE_SEGMENT_CACHE: {USE_SEGMENT_CACHE}\n"
+        f"  SEGMENT_CACHE_FOLDER_PATH: {SEGMENT_CACHE_FOLDER_PATH}\n"
+        f"  SEGMENT_CACHE_MAX_SIZE_MB: {SEGMENT_CACHE_MAX_SIZE_MB}\n"
+        f"  SERIES_PAGE_INDEX_POLICY: {SERIES_PAGE_INDEX_POLICY}\n"
+        f"  SERIES_PAGE_INDEX_PATH: {SERIES_PAGE_INDEX_PATH}\n"
+        f"  SERIES_PAGE_INDEX_MAX_DISTANCE: {SERIES_PAGE_INDEX_MAX_DISTANCE}\n"
+        f"  SERIES_PAGE_INDEX_MAX_CELL_DIFFERENCE: {SERIES_PAGE_INDEX_MAX_CELL_DIFFERENCE}\n"
+        f"  USE_CHECKPOINTS: {USE_CHECKPOINTS}\n"
+        f"  WATCH_POLL_SECONDS: {WATCH_POLL_SECONDS}\n"
+        f"  WATCH_SETTLE_SECONDS: {WATCH_SETTLE_SECONDS}\n"
+        f"  USE_INSTRUMENTATION: {USE_INSTRUMENTATION}\n"
+        f"  USE_RUN_STATISTICS: {USE_RUN_STATISTICS}\n"
+        f"  RUN_STATISTICS_PATH: {RUN_STATISTICS_PATH}\n"
+        f"  RUN_STATISTICS_HISTORY_FILES: {RUN_STATISTICS_HISTORY_FILES}\n"
+        f"  RUN_STATISTICS_REGRESSION_TOLERANCE: {RUN_STATISTICS_REGRESSION_TOLERANCE}\n"
+    )